@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lexing time per lexer over Pygments' example files, with RegexLexer's own
+loop and with mentos' loop, which only tries the rules that can match at the
+character at hand. Every file's tokens are checked to come out the same.
+
+    python bench-lexers.py [runs] [lexer ...]
+
+Exits non-zero if any file's tokens differ.
+"""
+
+import sys, os, glob, time
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, base_dir + "/vendor/pygments-main")
+sys.path.insert(0, base_dir + "/lib/pygments")
+
+from pygments.lexers import get_lexer_for_filename
+from pygments.util import ClassNotFound
+import lexing
+
+def best(runs, lex):
+    times = []
+    for _ in xrange(runs):
+        started = time.time()
+        tokens = lex()
+        times.append(time.time() - started)
+    return min(times), tokens
+
+def main(args):
+    runs = args and int(args.pop(0)) or 3
+    only = set(args)
+
+    files = {}
+    for path in sorted(glob.glob(base_dir + "/vendor/pygments-main/tests/examplefiles/*")):
+        try:
+            lexer = get_lexer_for_filename(path)
+        except ClassNotFound:
+            continue
+        if only and lexer.aliases[0] not in only or not lexing.restartable(lexer):
+            continue
+        text = open(path, 'rb').read()
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            text = text.decode('latin1')
+        files.setdefault(lexer.name, []).append((lexer, path, text))
+
+    print "Benchmarking lexers....\n"
+    print "Runs: %d\n" % runs
+    print "%-24s %6s %10s %12s %12s %8s" % ("lexer", "files", "bytes", "before", "after", "speedup")
+
+    total_before = total_after = 0
+    differ = []
+    for name in sorted(files):
+        before = after = size = 0
+        for lexer, path, text in files[name]:
+            try:
+                seconds, expected = best(runs, lambda: list(lexer.get_tokens(text)))
+            except Exception:
+                continue
+            before += seconds
+            seconds, tokens = best(runs, lambda: list(lexing.lex(lexer, lexing.preprocess(lexer, text))))
+            after += seconds
+            size += len(text)
+            if tokens != expected:
+                differ.append(path)
+        if not size:
+            continue
+        total_before += before
+        total_after += after
+        print "%-24s %6d %10d %9.1f ms %9.1f ms %7.2fx" % (name[:24], len(files[name]), size,
+                                                           before * 1000, after * 1000, before / max(after, 1e-9))
+
+    print "\n%-24s %6s %10s %9.1f ms %9.1f ms %7.2fx" % ("total", "", "", total_before * 1000,
+                                                          total_after * 1000, total_before / max(total_after, 1e-9))
+
+    if differ:
+        print "\nTokens differ for: %s" % ", ".join(differ)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory and time it takes to hold the tokens of Pygments' largest example
+files, as the list of (tokentype, value) pairs get_tokens gives, and as a
+TokenBuffer. The list's time is given with the garbage collector on, and how
+much of it the collector took.
+
+    python bench-memory.py [files]
+
+Memory counts the list, its pairs and their values, or the buffer's arrays;
+not the text, or the token types, which both share.
+"""
+
+import sys, os, glob, gc, time
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, base_dir + "/vendor/pygments-main")
+sys.path.insert(0, base_dir + "/lib/pygments")
+
+from pygments.lexers import get_lexer_for_filename
+from pygments.util import ClassNotFound
+import lexing
+
+def list_bytes(tokens):
+    seen = set()
+    size = sys.getsizeof(tokens)
+    for pair in tokens:
+        size += sys.getsizeof(pair)
+        value = pair[1]
+        if id(value) not in seen:
+            seen.add(id(value))
+            size += sys.getsizeof(value)
+    return size
+
+def timed(lex, collect=True):
+    if not collect:
+        gc.disable()
+    try:
+        started = time.time()
+        result = lex()
+        return time.time() - started, result
+    finally:
+        gc.enable()
+
+def main(args):
+    count = args and int(args[0]) or 10
+
+    paths = glob.glob(base_dir + "/vendor/pygments-main/tests/examplefiles/*")
+    paths.sort(key=os.path.getsize, reverse=True)
+
+    print "Benchmarking token memory....\n"
+    print "%-28s %8s %8s %10s %10s %6s %10s %10s %10s" % ("file", "bytes", "tokens", "list", "buffer", "ratio",
+                                                          "list", "(gc)", "buffer")
+
+    total_list = total_buffer = 0
+    for path in paths:
+        if not count:
+            break
+        try:
+            lexer = get_lexer_for_filename(path)
+        except ClassNotFound:
+            continue
+        if not lexing.restartable(lexer):
+            continue
+
+        text = open(path, 'rb').read()
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            text = text.decode('latin1')
+        text = lexing.preprocess(lexer, text)
+
+        # The first run of each compiles the lexer's regexes and builds its
+        # dispatch tables.
+        try:
+            lexing.lex_buffer(lexer, text)
+        except ValueError:
+            continue
+        list(lexer.get_tokens_unprocessed(text))
+        count -= 1
+
+        def lex_list():
+            return [(ttype, value) for _, ttype, value in lexer.get_tokens_unprocessed(text)]
+
+        gc.collect()
+        list_seconds, tokens = timed(lex_list)
+        list_size = list_bytes(tokens)
+        del tokens
+        gc.collect()
+        nogc_seconds, tokens = timed(lex_list, False)
+        del tokens
+        gc.collect()
+        buffer_seconds, buf = timed(lambda: lexing.lex_buffer(lexer, text))
+        buffer_size = sys.getsizeof(buf.starts) + sys.getsizeof(buf.ids)
+
+        total_list += list_size
+        total_buffer += buffer_size
+        print "%-28s %8d %8d %8.1fMB %8.1fMB %5.1fx %7.1f ms %7.1f ms %7.1f ms" % (
+            os.path.basename(path)[:28], len(text), len(buf), list_size / 1048576.0,
+            buffer_size / 1048576.0, list_size / float(buffer_size), list_seconds * 1000,
+            max(list_seconds - nogc_seconds, 0) * 1000, buffer_seconds * 1000)
+
+    print "\n%-28s %8s %8s %8.1fMB %8.1fMB %5.1fx" % ("total", "", "", total_list / 1048576.0,
+                                                     total_buffer / 1048576.0,
+                                                     total_list / float(max(total_buffer, 1)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,48 @@
+require File.join(File.dirname(__FILE__), '/lib/pygments.rb')
+
+# Time to first response of a freshly started mentos, for a few methods.
+# Each sample starts a new process, so this measures what a respawn costs.
+#
+#   ruby bench-startup.rb [runs] [max_ms]
+#
+# With max_ms, exits non-zero if the median of any method is slower than
+# that, so startup regressions can fail a build.
+
+# number of cold starts per method
+runs = ARGV[0] ? ARGV[0].to_i : 10
+
+# fail if a median exceeds this many milliseconds
+max_ms = ARGV[1] ? ARGV[1].to_f : nil
+
+code = File.open('test/test_data.py').read.to_s
+
+methods = {
+  "highlight"      => lambda { Pygments.highlight(code, :lexer => 'python') },
+  "css"            => lambda { Pygments.css },
+  "lexer_name_for" => lambda { Pygments.lexer_name_for(:filename => 'test.rb') }
+}
+
+puts "Benchmarking startup....\n"
+puts "Runs: " + runs.to_s + "\n\n"
+
+slow = []
+
+methods.each do |name, request|
+  samples = Array.new(runs) do
+    started = Time.now
+    Pygments.start
+    request.call
+    elapsed = (Time.now - started) * 1000
+    Pygments.stop "Benchmark"
+    elapsed
+  end.sort
+
+  median = samples[samples.size / 2]
+  puts "%-16s median %7.1f ms   min %7.1f ms   max %7.1f ms" % [name, median, samples.first, samples.last]
+  slow << name if max_ms && median > max_ms
+end
+
+unless slow.empty?
+  puts "\nSlower than #{max_ms} ms: #{slow.join(', ')}"
+  exit 1
+end
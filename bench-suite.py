@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lexing and formatting time and peak memory for every lexer over its files in
+Pygments' example files, done the way mentos does them, and the round trip
+of a request through the pipe to mentos on its own.
+
+    python bench-suite.py [options] [lexer ...]
+
+Results can be written as JSON with --output, and compared with a stored
+run's with --baseline: any lexer whose lexing, or formatting with any
+formatter, got slower by more than --threshold (10% by default) fails the
+run, which exits non-zero. Differences under --floor milliseconds are noise,
+and never fail it.
+
+Each file is done in a forked process of its own, so the memory it peaks at
+is its own: the growth of the process' peak resident memory while lexing,
+and then while formatting. A lexer's peaks are those of its biggest file.
+"""
+
+import sys, os, glob, time, resource, struct, subprocess
+from optparse import OptionParser
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, base_dir + "/vendor/pygments-main")
+sys.path.insert(0, base_dir + "/lib/pygments")
+
+try:
+    import json
+except ImportError:
+    sys.path.append(base_dir + "/vendor/simplejson")
+    import simplejson as json
+
+import pygments
+from pygments.lexers import get_lexer_for_filename
+from pygments.util import ClassNotFound
+
+from mentos import Mentos, PROTOCOL_MAGIC, PROTOCOL_VERSION
+from metrics import rss_bytes
+
+FORMATTERS = ("html", "terminal256", "latex", "rtf", "svg")
+
+def best(runs, work):
+    times = []
+    for _ in xrange(runs):
+        started = time.time()
+        result = work()
+        times.append(time.time() - started)
+    return min(times), result
+
+def peak_bytes():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return sys.platform == 'darwin' and maxrss or maxrss * 1024
+
+def example_files(only):
+    """
+    Returns the example files of each lexer, by name, as (lexer, text) pairs.
+    """
+    files = {}
+    for path in sorted(glob.glob(base_dir + "/vendor/pygments-main/tests/examplefiles/*")):
+        try:
+            lexer = get_lexer_for_filename(path)
+        except ClassNotFound:
+            continue
+        if only and lexer.aliases[0] not in only:
+            continue
+        text = open(path, 'rb').read()
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            text = text.decode('latin1')
+        files.setdefault(lexer.name, []).append((lexer, text))
+    return files
+
+def bench_file(mentos, lexer, text, formatters, runs):
+    """
+    Returns the results for lexing and formatting a file as mentos would.
+    Lexing is timed as the first formatter has it done, into a TokenBuffer
+    or not.
+
+    Memory is measured on a first go at each, which also compiles what's
+    left to compile and sets up the formatters, and times on the runs after.
+    """
+    result = {"bytes": len(text), "format_seconds": {}}
+    buffers = [getattr(mentos.formatter(name, {}), 'takes_buffers', False) for name in formatters]
+
+    # Whatever a generator yields is kept, so lexing is all timed as such.
+    lex = lambda buffer: _materialize(mentos.lex(text, lexer, buffer))
+
+    started_at = max(peak_bytes(), rss_bytes() or 0)
+    lexed = {}
+    for buffer in buffers:
+        if buffer not in lexed:
+            lexed[buffer] = lex(buffer)
+    result["lex_peak_bytes"] = max(peak_bytes() - started_at, 0)
+
+    started_at = peak_bytes()
+    for name, buffer in zip(formatters, buffers):
+        pygments.format(lexed[buffer], mentos.formatter(name, {}))
+    result["format_peak_bytes"] = max(peak_bytes() - started_at, 0)
+
+    result["lex_seconds"], _ = best(runs, lambda: lex(buffers[0]))
+    for name, buffer in zip(formatters, buffers):
+        formatter = mentos.formatter(name, {})
+        result["format_seconds"][name], _ = best(runs, lambda: pygments.format(lexed[buffer], formatter))
+    return result
+
+def bench_lexer(mentos, files, formatters, runs):
+    """
+    Returns the results for a lexer's files: the total times, and the most
+    memory any one file took. Each file is done in a process of its own.
+    """
+    result = {"files": 0, "bytes": 0, "lex_seconds": 0.0, "lex_peak_bytes": 0,
+              "format_seconds": dict((name, 0.0) for name in formatters), "format_peak_bytes": 0}
+    errors = []
+    for lexer, text in files:
+        done = in_child(lambda: bench_file(mentos, lexer, text, formatters, runs))
+        if "error" in done:
+            errors.append(done["error"])
+            continue
+        result["files"] += 1
+        for key in ("bytes", "lex_seconds"):
+            result[key] += done[key]
+        for key in ("lex_peak_bytes", "format_peak_bytes"):
+            result[key] = max(result[key], done[key])
+        for name, seconds in done["format_seconds"].iteritems():
+            result["format_seconds"][name] += seconds
+
+    if not result["files"]:
+        return {"error": errors and errors[0] or "No files"}
+    return result
+
+def _materialize(tokens):
+    if isinstance(tokens, (list, tuple)) or hasattr(tokens, 'runs'):
+        return tokens
+    return list(tokens)
+
+def in_child(work):
+    """
+    Returns what work returns, having run it in a forked process.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_end)
+            try:
+                out = json.dumps(work())
+            except Exception, e:
+                out = json.dumps({"error": str(e)})
+            os.write(write_end, out)
+        finally:
+            os._exit(0)
+
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return json.loads("".join(chunks))
+
+def bench_pipe(requests):
+    """
+    Returns the round trip times of requests through the pipe to a mentos
+    of its own: an empty one, and one carrying a megabyte, which mentos
+    reads and ignores.
+    """
+    frame = struct.Struct(">II")
+    process = subprocess.Popen([sys.executable, base_dir + "/lib/pygments/mentos.py"],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        process.stdin.write(PROTOCOL_MAGIC + chr(PROTOCOL_VERSION))
+        process.stdin.flush()
+        process.stdout.read(len(PROTOCOL_MAGIC) + 1)
+
+        def round_trip(body):
+            header = json.dumps({"id": 1, "method": "lexer_name_for", "args": [],
+                                 "kwargs": {"lexer": "text"}})
+            started = time.time()
+            process.stdin.write(frame.pack(len(header), len(body)) + header + body)
+            process.stdin.flush()
+            header_bytes, body_bytes = frame.unpack(process.stdout.read(frame.size))
+            process.stdout.read(header_bytes + body_bytes)
+            return time.time() - started
+
+        result = {}
+        for name, body in (("empty", ""), ("1mb", "x" * (1024 * 1024))):
+            round_trip(body)
+            times = sorted(round_trip(body) for _ in xrange(requests))
+            result[name] = {"median_seconds": times[len(times) // 2], "min_seconds": times[0],
+                            "max_seconds": times[-1]}
+        return result
+    finally:
+        process.stdin.close()
+        process.wait()
+
+def regressions(results, baseline, threshold, floor):
+    """
+    Returns a description of each time in results more than threshold slower
+    than the same in baseline, by more than floor seconds.
+    """
+    found = []
+    for name, result in sorted(results["lexers"].iteritems()):
+        before = baseline.get("lexers", {}).get(name)
+        if not before or "error" in result or "error" in before:
+            continue
+        times = [("lexing", result["lex_seconds"], before["lex_seconds"])]
+        for formatter, seconds in sorted(result["format_seconds"].iteritems()):
+            if formatter in before["format_seconds"]:
+                times.append((formatter, seconds, before["format_seconds"][formatter]))
+        for what, after, then in times:
+            if after > then * (1 + threshold) and after - then > floor:
+                found.append("%s %s: %.1f ms, was %.1f ms (+%.0f%%)" % (
+                    name, what, after * 1000, then * 1000, (after / max(then, 1e-9) - 1) * 100))
+    return found
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] [lexer ...]")
+    parser.add_option("-r", "--runs", type="int", default=3,
+                      help="runs of each, of which the fastest counts (3)")
+    parser.add_option("-f", "--formatters", default=",".join(FORMATTERS),
+                      help="formatters to time, comma separated (%default)")
+    parser.add_option("-p", "--pipe-requests", type="int", default=200,
+                      help="round trips through the pipe to time, or 0 for none (200)")
+    parser.add_option("-o", "--output", help="write the results to this JSON file")
+    parser.add_option("-b", "--baseline", help="compare with the results in this JSON file")
+    parser.add_option("-t", "--threshold", type="float", default=0.1,
+                      help="slowdown over the baseline that fails the run (0.1)")
+    parser.add_option("--floor", type="float", default=1.0,
+                      help="milliseconds of slowdown that never fail the run (1.0)")
+    options, only = parser.parse_args(args)
+
+    formatters = tuple(options.formatters.split(","))
+    mentos = Mentos()
+
+    print "Benchmarking lexers and formatters....\n"
+    print "Runs: %d\n" % options.runs
+    print "%-24s %6s %10s %10s %8s %10s %8s" % ("lexer", "files", "bytes", "lex", "peak", "format", "peak")
+
+    results = {"runs": options.runs, "formatters": formatters, "lexers": {}}
+    files = example_files(set(only))
+    for name in sorted(files):
+        result = bench_lexer(mentos, files[name], formatters, options.runs)
+        results["lexers"][name] = result
+        if "error" in result:
+            print "%-24s %s" % (name[:24], result["error"])
+            continue
+        print "%-24s %6d %10d %7.1f ms %6.1fMB %7.1f ms %6.1fMB" % (
+            name[:24], result["files"], result["bytes"], result["lex_seconds"] * 1000,
+            result["lex_peak_bytes"] / 1048576.0, sum(result["format_seconds"].values()) * 1000,
+            result["format_peak_bytes"] / 1048576.0)
+
+    if options.pipe_requests:
+        results["pipe"] = bench_pipe(options.pipe_requests)
+        print
+        for name, times in sorted(results["pipe"].iteritems()):
+            print "pipe round trip, %-6s median %7.3f ms   min %7.3f ms   max %7.3f ms" % (
+                name, times["median_seconds"] * 1000, times["min_seconds"] * 1000,
+                times["max_seconds"] * 1000)
+
+    if options.output:
+        out = open(options.output, 'w')
+        try:
+            json.dump(results, out, indent=2, sort_keys=True)
+        finally:
+            out.close()
+
+    if options.baseline:
+        slower = regressions(results, json.load(open(options.baseline)),
+                             options.threshold, options.floor / 1000.0)
+        if slower:
+            print "\nSlower than the baseline by over %d%%:" % (options.threshold * 100)
+            for line in slower:
+                print "  " + line
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
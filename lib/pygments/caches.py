@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Caches mentos keeps across requests.
+"""
+
+from threading import Lock
+
+# Indexes into the linked list entries of LRUCache.
+_PREV, _NEXT, _KEY, _VALUE, _SIZE = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+    """
+    A least-recently-used cache holding at most max_bytes worth of values.
+    Callers give the size of each value when storing it; once the total goes
+    over budget, the least recently used values are evicted. Callers that
+    give every value a size of 1 get a cache bounded by its number of entries.
+
+    Entries are kept in a circular doubly linked list, most recently used
+    first, so lookups, stores and evictions are all constant time. Safe to use
+    from several threads at once.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = {}
+        self._root = root = [None, None, None, None, 0]
+        root[_PREV] = root[_NEXT] = root
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._unlink(entry)
+            self._link_first(entry)
+            return entry[_VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size):
+        # Values that could never fit would only flush the whole cache.
+        if size > self.max_bytes:
+            return
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.bytes -= entry[_SIZE]
+
+            entry = [None, None, key, value, size]
+            self._entries[key] = entry
+            self._link_first(entry)
+            self.bytes += size
+
+            root = self._root
+            while self.bytes > self.max_bytes:
+                oldest = root[_PREV]
+                self._unlink(oldest)
+                del self._entries[oldest[_KEY]]
+                self.bytes -= oldest[_SIZE]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.bytes -= entry[_SIZE]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns a dict of the cache's counters.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _unlink(self, entry):
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
+
+    def _link_first(self, entry):
+        root = self._root
+        entry[_PREV] = root
+        entry[_NEXT] = root[_NEXT]
+        root[_NEXT][_PREV] = entry
+        root[_NEXT] = entry
+
+
+def freeze(value):
+    """
+    Turn a JSON-ish value (dicts, lists, and scalars) into a hashable one that
+    compares equal for equal input, whatever the order of dict keys.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+# Lexers and formatters that keep per-document state on the instance while
+# they run, so they can't be shared between requests. Subclasses count too.
+_STATEFUL_CLASSES = frozenset(['HttpLexer', 'PostgresBase', 'ImageFormatter'])
+
+class InstanceCache(object):
+    """
+    Constructed lexers and formatters, keyed by class and options, so a hot
+    configuration (an HtmlFormatter, say, whose constructor builds a whole
+    stylesheet) isn't rebuilt for every request.
+
+    Since options like hl_lines and linenostart are part of the key, a cached
+    instance is only ever reused for requests that would have constructed an
+    identical one.
+    """
+    def __init__(self, max_entries=64):
+        self._instances = LRUCache(max_entries)
+        self._shareable = {}
+
+    def get(self, cls, options):
+        """
+        Returns an instance of cls, constructed with the given options.
+        """
+        if not self.shareable(cls):
+            return cls(**options)
+
+        key = (cls, freeze(options))
+        try:
+            hash(key)
+        except TypeError:
+            return cls(**options)
+
+        instance = self._instances.get(key)
+        if instance is None:
+            instance = cls(**options)
+            self._instances.set(key, instance, 1)
+        return instance
+
+    def shareable(self, cls):
+        """
+        Returns whether instances of cls may be shared between requests.
+        """
+        shareable = self._shareable.get(cls)
+        if shareable is None:
+            shareable = not [c for c in cls.__mro__ if c.__name__ in _STATEFUL_CLASSES]
+            self._shareable[cls] = shareable
+        return shareable
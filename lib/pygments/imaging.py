@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+ImageFormatter, with fonts looked up and loaded once per process rather than
+once per formatter, and text drawn a run at a time rather than a token at a
+time.
+"""
+
+import re
+from threading import Lock
+from types import FunctionType
+
+from pygments.formatters import img
+from pygments.formatters.img import ImageFormatter, GifImageFormatter, JpgImageFormatter, \
+     BmpImageFormatter, FontManager
+
+from caches import LRUCache
+
+# Font managers, by font name and size, each holding the font of every
+# style. Fonts are never drawn with outside of PIL's C code, which holds the
+# GIL, so threads can share them.
+_managers = LRUCache(32)
+_managers_lock = Lock()
+
+# Where fc-list found each font name and style, or None where it didn't.
+_paths = {}
+
+# The characters drawn in runs, if the font has them all as wide as an M.
+# Others may be missing from the font, or wider, and are drawn one piece of
+# a token at a time, just where ImageFormatter draws them.
+_RUN_CHARS = u''.join(map(unichr, range(0x20, 0x7f)))
+_unrunnable = re.compile(u'[^\x20-\x7e]').search
+
+class SharedFontManager(FontManager):
+    """
+    FontManager, asking fc-list where a font name and style are only once,
+    whatever the size, and measuring a character once. Its fonts are
+    monospaced if every style has all of _RUN_CHARS as wide as an M.
+    """
+    def __init__(self, font_name, font_size=14):
+        FontManager.__init__(self, font_name, font_size)
+        self.char_size = self.fonts['NORMAL'].getsize('M')
+        width = self.char_size[0]
+        self.monospaced = not [font for font in self.fonts.itervalues()
+                               if font.getsize(_RUN_CHARS)[0] != width * len(_RUN_CHARS)]
+
+    def _get_nix_font_path(self, name, style):
+        key = (name, style)
+        if key not in _paths:
+            _paths[key] = FontManager._get_nix_font_path(self, name, style)
+        return _paths[key]
+
+    def get_char_size(self):
+        return self.char_size
+
+def font_manager(name, size=14):
+    """
+    Returns the SharedFontManager for the font name at size, loading its
+    fonts the first time.
+    """
+    key = (name, size)
+    _managers_lock.acquire()
+    try:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = SharedFontManager(name, size)
+            _managers.set(key, manager, 1)
+        return manager
+    finally:
+        _managers_lock.release()
+
+# ImageFormatter.__init__, making its fonts with font_manager: its own code,
+# looking its globals up in a copy of the img module's with FontManager
+# swapped, so that Pygments' own formatters keep making theirs.
+_init = ImageFormatter.__init__.im_func
+_init_with_shared_fonts = FunctionType(_init.func_code, dict(vars(img), FontManager=font_manager),
+                                       _init.func_name, _init.func_defaults, _init.func_closure)
+
+class FastImageFormatter(ImageFormatter):
+    """
+    ImageFormatter, whose fonts come from font_manager, so a formatter costs
+    no fc-list runs or font loading after the first with its font and size.
+
+    Text is drawn a run at a time: tokens in a row on a line that are drawn
+    in the same font and color are drawn as one, and spaces, which draw
+    nothing, join whatever run they're in. With a monospaced font, glyphs
+    land where they would have a token at a time, so the image is the same
+    but for antialiasing where neighbouring glyphs overlap. Tokens with
+    characters outside of printable ASCII, and all text in other fonts, are
+    drawn a token at a time, as ImageFormatter does.
+    """
+    def __init__(self, **options):
+        _init_with_shared_fonts(self, **options)
+        # The font and color of each token type, as they're needed.
+        self._looks = {}
+
+    def _look(self, ttype):
+        """
+        Returns the font and color tokens of ttype are drawn in.
+        """
+        look = self._looks.get(ttype)
+        if look is None:
+            styled = ttype
+            while styled not in self.styles:
+                styled = styled.parent
+            style = self.styles[styled]
+            look = self._looks[ttype] = (self._get_style_font(style), self._get_text_color(style))
+        return look
+
+    def _create_drawables(self, tokensource):
+        """
+        Create drawables for the token content, a run at a time.
+        """
+        if not self.fonts.monospaced:
+            return ImageFormatter._create_drawables(self, tokensource)
+
+        lineno = charno = maxcharno = 0
+        run = []
+        run_look = run_start = None
+
+        for ttype, value in tokensource:
+            look = self._look(ttype)
+            # Tabs are expanded token by token, as ImageFormatter does.
+            for line in value.expandtabs(4).splitlines(True):
+                temp = line.rstrip('\n')
+                if temp:
+                    blank = not temp.strip(' ')
+                    if run and (blank or look == run_look) and not _unrunnable(temp):
+                        run.append(temp)
+                    elif not blank:
+                        if run:
+                            self._draw_run(run, run_start, lineno, run_look)
+                            run = []
+                        if _unrunnable(temp):
+                            self._draw_run([temp], charno, lineno, look)
+                        else:
+                            run = [temp]
+                            run_look = look
+                            run_start = charno
+                    charno += len(temp)
+                    maxcharno = max(maxcharno, charno)
+                if line.endswith('\n'):
+                    if run:
+                        self._draw_run(run, run_start, lineno, run_look)
+                        run = []
+                    charno = 0
+                    lineno += 1
+
+        if run:
+            self._draw_run(run, run_start, lineno, run_look)
+        self.maxcharno = maxcharno
+        self.maxlineno = lineno
+
+    def _draw_run(self, run, charno, lineno, look):
+        font, fill = look
+        self._draw_text(self._get_text_pos(charno, lineno), u''.join(run), font=font, fill=fill)
+
+class FastGifImageFormatter(FastImageFormatter, GifImageFormatter):
+    """
+    GifImageFormatter, as FastImageFormatter draws it.
+    """
+
+class FastJpgImageFormatter(FastImageFormatter, JpgImageFormatter):
+    """
+    JpgImageFormatter, as FastImageFormatter draws it.
+    """
+
+class FastBmpImageFormatter(FastImageFormatter, BmpImageFormatter):
+    """
+    BmpImageFormatter, as FastImageFormatter draws it.
+    """
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Documents that are highlighted once, then re-highlighted edit by edit.
+"""
+
+from threading import Lock
+
+from lexing import restartable, lex, dispatch
+
+class Document(object):
+    """
+    A document's text, and the highlighted HTML of each of its lines.
+
+    For lexers driven by RegexLexer's own loop, the lexer's state stack at the
+    start of each line is kept as a checkpoint. An edit is then re-lexed from
+    a checkpoint before it, only until the state at the start of a line after
+    it matches what it was before the edit; from there on, the lexer would do
+    exactly what it did last time. Lines that a token runs into have no
+    checkpoint. Other lexers re-lex the whole document.
+
+    Lines with characters no rule matched are noted too, as are lines where
+    a rule failed after matching what it opens with (the /* of a comment,
+    say): what it opens ends nowhere in the rest of the text, and an end
+    added further down would change them, so edits are re-lexed from before
+    the first of them. Rules can also tell the start of the text from that of
+    a line, so the first line never counts as matching.
+
+    Lines are separated by newlines only, and the text always ends with one,
+    so line numbers stay those of the editor the document came from.
+    """
+    def __init__(self, lexer, formatter, code):
+        self.lexer = lexer
+        self.formatter = formatter
+        self.checkpoints = restartable(lexer)
+
+        self.text = u''
+        self.lengths = []
+        self.states = []
+        self.missed = []
+        self.html = []
+        self._stacks = {}
+        self._lock = Lock()
+
+        self.edit(0, 0, code)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def edit(self, first, last, code):
+        """
+        Replace lines first up to (not including) last with the lines of code,
+        which may or may not end with a newline; empty code removes them.
+
+        Returns the line the changed HTML starts at, how many old lines it
+        replaces, and the changed lines of HTML, without line separators.
+        """
+        self._lock.acquire()
+        try:
+            return self._edit(first, last, code)
+        finally:
+            self._lock.release()
+
+    def _edit(self, first, last, code):
+        if not 0 <= first <= last <= len(self.lengths):
+            raise ValueError("Edit range %d-%d is outside lines 0-%d" % (first, last, len(self.lengths)))
+
+        code = code.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+        if self.lexer.tabsize > 0:
+            code = code.expandtabs(self.lexer.tabsize)
+        if code and not code.endswith(u'\n'):
+            code += u'\n'
+        new_lengths = [len(line) + 1 for line in code.split(u'\n')[:-1]]
+
+        # Nothing changes until the edit has been highlighted, so a lexer
+        # that fails on the new text leaves the document as it was.
+        start = sum(self.lengths[:first])
+        end = start + sum(self.lengths[first:last])
+        text = self.text[:start] + code + self.text[end:]
+        lengths = self.lengths[:first] + new_lengths + self.lengths[last:]
+
+        old_states = self.states
+        old_count = len(self.lengths)
+        edited = first + len(new_lengths)
+        delta = edited - last
+
+        if self.checkpoints:
+            # Start over from the last line before the edited ones that
+            # started in the root state. Later checkpoints can depend on the
+            # edited text too: a rule for a string that was never closed, say,
+            # looks for its end all the way through the text, and only once
+            # that fails does the lexer fall back to a state for an unclosed
+            # string. Even a token that ends a line may have been decided by
+            # a peek at the next one, like an INI value that continues onto
+            # indented lines, and a rule can match or look at several whole
+            # lines, like an RST title with a line over and under it.
+            line = max(first - dispatch(self.lexer).lines_ahead(), 0)
+            try:
+                line = self.missed.index(True, 0, line)
+            except ValueError:
+                pass
+            while line > 0 and (line >= old_count or old_states[line] != ('root',)):
+                line -= 1
+            stack = ('root',)
+            tokens, states, missed, stop = self._relex(text, line, sum(lengths[:line]), stack,
+                                                       edited, delta, old_states)
+        else:
+            line, stop, states = 0, len(lengths), [None] * len(lengths)
+            missed = [False] * len(lengths)
+            tokens = text and self.lexer.get_tokens(text) or []
+
+        lsep = len(self.formatter.lineseparator)
+        html = [item[:-lsep] for _, item in self.formatter._format_lines(tokens)]
+
+        # Lines from stop on are as they were, as are any lines at either end
+        # of the re-lexed ones that came out the same.
+        old_stop = stop - delta
+        head = 0
+        while head < len(html) and line + head < old_stop and html[head] == self.html[line + head]:
+            head += 1
+        tail = 0
+        while (tail < len(html) - head and old_stop - tail > line + head and
+               html[-tail - 1] == self.html[old_stop - tail - 1]):
+            tail += 1
+
+        self.text = text
+        self.lengths = lengths
+        self.states[line:old_stop] = states
+        self.missed[line:old_stop] = missed
+        self.html[line:old_stop] = html
+        return line + head, old_stop - tail - line - head, html[head:len(html) - tail]
+
+    def _relex(self, text, line, pos, stack, edited, delta, old_states):
+        """
+        Lex text from pos, the start of the given line, with the given state
+        stack, until the end of the text, or until a line at or after edited
+        starts in the state its old line (delta lines earlier) started in.
+
+        Returns the tokens, the checkpoints of the lines they cover, whether
+        each of those lines has characters no rule matched, and the line they
+        stop at.
+        """
+        stacks = self._stacks
+        old_count = len(old_states)
+        states = []
+        lines = [line]
+
+        def at_line(line_start, statestack):
+            line = lines[0]
+            if statestack is None:
+                states.append(None)
+            else:
+                state = tuple(statestack)
+                old = line - delta
+                # Rules can tell the start of the text from that of a line,
+                # so the first line, old or new, lexes as no other does.
+                if line >= edited and line and 0 < old < old_count and old_states[old] == state:
+                    return True
+                states.append(stacks.setdefault(state, state))
+            lines[0] = line + 1
+
+        misses = []
+        tokens = list(lex(self.lexer, text, pos, stack, at_line, misses=misses))
+
+        missed = [False] * len(states)
+        row = 0
+        for miss in misses:
+            row += text.count(u'\n', pos, miss)
+            pos = miss
+            missed[row] = True
+        return tokens, states, missed, lines[0]
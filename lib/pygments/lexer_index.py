@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+"""
+Indexes from filenames and contents to the lexers that handle them.
+"""
+
+import os, re, sys, fnmatch
+from hashlib import sha1
+from os.path import basename
+from threading import Lock
+
+from pygments.util import ClassNotFound
+
+from caches import LRUCache
+
+_MAGIC = re.compile(r'[*?[]')
+
+def _glob_regex(pattern):
+    """
+    The regex fnmatch uses for pattern, without the anchor and flags
+    fnmatch.translate appends (\Z(?ms) since 2.7, $ before), so it can be
+    combined with others.
+    """
+    regex = fnmatch.translate(pattern)
+    for suffix in ('\\Z(?ms)', '$'):
+        if regex.endswith(suffix):
+            return regex[:-len(suffix)]
+    return regex
+
+def _modules_mentioning(name):
+    """
+    The builtin lexer modules whose source mentions name, or None if the
+    sources can't be read (when running from a zip, say).
+    """
+    from pygments import lexers
+
+    directory = os.path.dirname(lexers.__file__)
+    try:
+        filenames = os.listdir(directory)
+    except OSError:
+        return None
+
+    modules = set()
+    for filename in filenames:
+        if not filename.endswith('.py'):
+            continue
+        f = open(os.path.join(directory, filename))
+        try:
+            if name in f.read():
+                modules.add('pygments.lexers.' + filename[:-3])
+        finally:
+            f.close()
+    return modules
+
+class _LexerTable(object):
+    """
+    Every lexer: the builtin ones in the order guess_lexer and
+    guess_lexer_for_filename go through them, then plugins. Lexers are
+    referred to by their position, and builtin ones aren't imported until
+    their class is needed.
+    """
+    def __init__(self):
+        from pygments.lexers._mapping import LEXERS
+        from pygments.plugin import find_plugin_lexers
+
+        # [module, class name, class] for builtin lexers, whose class is
+        # looked up when first needed, and [None, None, class] for plugins.
+        keys = sorted(LEXERS)
+        self._lexers = [[LEXERS[key][0], key, None] for key in keys]
+        self._lexers.extend([[None, None, cls] for cls in find_plugin_lexers()])
+
+        self.builtin = dict((key, i) for i, key in enumerate(keys))
+        self.plugins = range(len(keys), len(self._lexers))
+
+    def __len__(self):
+        return len(self._lexers)
+
+    def module(self, lexer_id):
+        """
+        The module of a builtin lexer, or None for plugins.
+        """
+        return self._lexers[lexer_id][0]
+
+    def load(self, lexer_id):
+        """
+        The class of the given lexer, importing its module if need be.
+        """
+        lexer = self._lexers[lexer_id]
+        if lexer[2] is None:
+            __import__(lexer[0])
+            lexer[2] = getattr(sys.modules[lexer[0]], lexer[1])
+        return lexer[2]
+
+class _Patterns(object):
+    """
+    Filename patterns, each mapped to the lexers that claim it.
+
+    Patterns fnmatch can answer without a glob are kept in tables: *.ext
+    patterns by extension, plain names by name, so a lookup costs a dict hit
+    per dot in the filename. The rest are also compiled into a single regex,
+    which rules them all out in one search for most filenames.
+    """
+    def __init__(self):
+        self.extensions = {}
+        self.names = {}
+        self.globs = []
+        self.any_glob = None
+
+    def add(self, pattern, entry):
+        pattern = os.path.normcase(pattern)
+
+        if not _MAGIC.search(pattern):
+            self.names.setdefault(pattern, []).append(entry)
+        elif pattern.startswith('*.') and not _MAGIC.search(pattern, 2):
+            self.extensions.setdefault(pattern[1:], []).append(entry)
+        else:
+            self.globs.append((_glob_regex(pattern), entry))
+
+    def compile(self):
+        if self.globs:
+            self.any_glob = re.compile('|'.join(['(?:%s)\\Z' % regex for regex, _ in self.globs]), re.S)
+            self.globs = [(re.compile(regex + '\\Z', re.S), entry) for regex, entry in self.globs]
+
+    def match(self, filename):
+        """
+        The entries of every pattern the (normcased) filename matches.
+        """
+        found = list(self.names.get(filename, ()))
+
+        # *.ext matches any filename ending in .ext, including a bare .ext.
+        dot = filename.find('.')
+        while dot >= 0:
+            found.extend(self.extensions.get(filename[dot:], ()))
+            dot = filename.find('.', dot + 1)
+
+        if self.any_glob is not None and self.any_glob.match(filename):
+            for regex, entry in self.globs:
+                if regex.match(filename):
+                    found.append(entry)
+
+        return found
+
+class FilenameIndex(object):
+    """
+    Resolves filenames to lexer classes the way get_lexer_for_filename and
+    guess_lexer_for_filename do, without their cost: they fnmatch every
+    pattern of every lexer on each call, and the latter imports every lexer
+    module to read their alias_filenames.
+
+    The patterns in pygments.lexers._mapping are indexed the first time
+    they're needed, along with those of plugin lexers, whose lookup would
+    otherwise go through pkg_resources on every call. Only the modules of
+    the lexers a filename matches are imported.
+
+    alias_filenames aren't in _mapping, so they're indexed the first time
+    guess() needs them, by importing just the modules whose source mentions
+    them. A lexer that inherits alias_filenames from a class in another
+    module, without naming them itself, isn't found by that.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._table = None
+        self._filenames = None
+        self._alias_filenames = None
+
+    def build(self):
+        """
+        Index everything now, rather than when it's first needed.
+        """
+        self._primary()
+        self._aliases()
+
+    def lexer_class(self, filename):
+        """
+        Returns the lexer class for filename, as get_lexer_for_filename
+        would pick it without code: the best priority among the lexers
+        whose filenames match, with a bonus for patterns without a *.
+        """
+        fn = basename(filename)
+        best = None
+
+        for _, lexer_id, pattern in sorted(self._primary().match(os.path.normcase(fn))):
+            cls = self._table.load(lexer_id)
+            rating = cls.priority + ('*' not in pattern and 0.5 or 0)
+            # Ties go to the later lexer, as with the stable sort in Pygments.
+            if best is None or rating >= best[0]:
+                best = (rating, cls)
+
+        if best is None:
+            raise ClassNotFound('no lexer for filename %r found' % filename)
+        return best[1]
+
+    def guess(self, filename, code):
+        """
+        Returns the lexer class for filename and its code, as
+        guess_lexer_for_filename would pick it: among the lexers whose
+        filenames or alias_filenames match, the one whose analyse_text
+        rates the code highest. When none of them recognize the code at
+        all, the lexer whose filenames match wins.
+        """
+        fn = basename(filename)
+        normcased = os.path.normcase(fn)
+
+        primary = None
+        candidates = set()
+        for _, lexer_id, _ in self._primary().match(normcased):
+            candidates.add(lexer_id)
+            primary = max(primary, lexer_id)
+        for _, lexer_id, _ in self._aliases().match(normcased):
+            candidates.add(lexer_id)
+
+        if not candidates:
+            raise ClassNotFound('no lexer for filename %r found' % fn)
+
+        candidates = sorted(candidates)
+        if len(candidates) == 1:
+            return self._table.load(candidates[0])
+
+        # Sorted like Pygments sorts them, ties included, so both pick the
+        # same lexer.
+        result = []
+        for lexer_id in candidates:
+            cls = self._table.load(lexer_id)
+            rating = cls.analyse_text(code)
+            if rating == 1.0:
+                return cls
+            result.append((rating, cls))
+        result.sort()
+
+        if not result[-1][0] and primary is not None:
+            return self._table.load(primary)
+        return result[-1][1]
+
+    def _primary(self):
+        if self._filenames is None:
+            self._lock.acquire()
+            try:
+                if self._filenames is None:
+                    self._filenames = self._build('filenames')
+            finally:
+                self._lock.release()
+        return self._filenames
+
+    def _aliases(self):
+        if self._alias_filenames is None:
+            self._lock.acquire()
+            try:
+                if self._alias_filenames is None:
+                    self._alias_filenames = self._build('alias_filenames')
+            finally:
+                self._lock.release()
+        return self._alias_filenames
+
+    def _build(self, attr):
+        """
+        Index the lexers' filenames or alias_filenames. Entries are tuples of
+        (rank, lexer id, pattern), where the rank orders them as Pygments
+        would find them, and the lexer id is the lexer's position in the
+        lexer table.
+        """
+        from pygments.lexers._mapping import LEXERS
+
+        if self._table is None:
+            self._table = _LexerTable()
+        table = self._table
+
+        patterns = _Patterns()
+        rank = 0
+
+        if attr == 'filenames':
+            # get_lexer_for_filename goes through LEXERS in dict order.
+            builtin = [(table.builtin[key], entry[3]) for key, entry in LEXERS.iteritems()]
+        else:
+            modules = _modules_mentioning(attr)
+            builtin = [(table.builtin[key], getattr(table.load(table.builtin[key]), attr))
+                       for key, entry in LEXERS.iteritems()
+                       if modules is None or entry[0] in modules]
+
+        plugins = [(i, getattr(table.load(i), attr)) for i in table.plugins]
+
+        for lexer_id, filenames in builtin + plugins:
+            for pattern in filenames:
+                patterns.add(pattern, (rank, lexer_id, pattern))
+                rank += 1
+
+        patterns.compile()
+        return patterns
+
+# Literals, in lower case, that a lexer's analyse_text needs to find in a
+# text to rate it above zero: when none of them are there, it isn't run.
+# Every builtin lexer with an analyse_text is listed, with None where it
+# isn't sure to need anything; those, and any lexer not listed (plugins,
+# say), are always run.
+_NEEDS = {
+    # Shebangs, and what else the lexer looks for.
+    'BashLexer': ('#!', '$ '),
+    'JuliaLexer': ('#!',),
+    'NumPyLexer': ('numpy',),
+    'Perl6Lexer': ('#!', 'v6', '$*', '@*', '%*', '$?', '@?', '%?', '$!', '@!', '%!',
+                   '$.', '@.', '%.', 'module', 'role', 'class'),
+    'Python3Lexer': ('#!',),
+    'PythonLexer': ('#!', 'import '),
+    'RubyLexer': ('#!',),
+    'TclLexer': ('#!',),
+
+    # Markup, and templates embedded in it. looks_like_xml needs a doctype
+    # or a closing tag.
+    'CssDjangoLexer': ('{',),
+    'CssErbLexer': ('<%',),
+    'CssGenshiLexer': ('${', 'py:', '</', '<!doctype'),
+    'CssPhpLexer': ('<?', '?>'),
+    'CssSmartyLexer': ('{',),
+    'DjangoLexer': ('{',),
+    'DtdLexer': ('<!element', '<!attlist', '<!entity'),
+    'ErbLexer': ('<%',),
+    'GenshiLexer': ('${', 'py:', '</', '<!doctype'),
+    'HtmlDjangoLexer': ('{', '<!doctype'),
+    'HtmlGenshiLexer': ('${', 'py:', '<!doctype'),
+    'HtmlLexer': ('<!doctype',),
+    'HtmlPhpLexer': ('<?', '?>', '<!doctype'),
+    'HtmlSmartyLexer': ('{', '<!doctype'),
+    'JavascriptDjangoLexer': ('{',),
+    'JavascriptErbLexer': ('<%',),
+    'JavascriptGenshiLexer': ('${', 'py:', '</', '<!doctype'),
+    'JavascriptPhpLexer': ('<?', '?>'),
+    'JavascriptSmartyLexer': ('{',),
+    'JspLexer': ('<%', '</', '<!doctype'),
+    'LassoCssLexer': ('lasso9', '<?', '[', 'local(', '?>', ':'),
+    'LassoHtmlLexer': ('lasso9', '<', '[', 'local(', '?>'),
+    'LassoJavascriptLexer': ('lasso9', '<?', '[', 'local(', '?>', 'function'),
+    'LassoLexer': ('lasso9', '<?', '[', 'local(', '?>'),
+    'LassoXmlLexer': ('lasso9', '<?', '[', 'local(', '?>', '</', '<!doctype'),
+    'MasonLexer': ('<&',),
+    'PhpLexer': ('<?', '?>'),
+    'RhtmlLexer': ('<%', '<!doctype'),
+    'SmartyLexer': ('{',),
+    'SspLexer': ('val ', '<%', '</', '<!doctype'),
+    'TeaTemplateLexer': ('<%', '</', '<!doctype'),
+    'VelocityLexer': ('#', '$'),
+    'VelocityXmlLexer': ('#', '$', '</', '<!doctype'),
+    'XmlDjangoLexer': ('{', '</', '<!doctype'),
+    'XmlErbLexer': ('<%', '</', '<!doctype'),
+    'XmlLexer': ('</', '<!doctype'),
+    'XmlPhpLexer': ('<?', '?>', '</', '<!doctype'),
+    'XmlSmartyLexer': ('{', '</', '<!doctype'),
+    'XsltLexer': ('<xsl',),
+
+    # Everything else.
+    'ActionScript3Lexer': (':',),
+    'AntlrActionScriptLexer': ('grammar',),
+    'AntlrCSharpLexer': ('grammar',),
+    'AntlrCppLexer': ('grammar',),
+    'AntlrJavaLexer': ('grammar',),
+    'AntlrLexer': ('grammar',),
+    'AntlrObjectiveCLexer': ('grammar',),
+    'AntlrPerlLexer': ('grammar',),
+    'AntlrPythonLexer': ('grammar',),
+    'AntlrRubyLexer': ('grammar',),
+    'BugsLexer': ('model',),
+    'CSharpAspxLexer': ('language',),
+    'Ca65Lexer': (';',),
+    'CoqLexer': ('(*',),
+    'DiffLexer': ('index: ', 'diff ', '--- '),
+    'GasLexer': ('.',),
+    'GroffLexer': ('.',),
+    'HaxeLexer': (':',),
+    'IniLexer': ('[',),
+    'JagsLexer': ('model',),
+    'LogosLexer': ('%',),
+    'LogtalkLexer': (':- ',),
+    'ObjectiveCLexer': ('@', '['),
+    'ObjectiveCppLexer': ('@', '['),
+    'ObjectiveJLexer': ('@import',),
+    'OctaveLexer': ('%', '#'),
+    'PrologLexer': (':-',),
+    'RagelCLexer': ('@lang: c',),
+    'RagelCppLexer': ('@lang: c++',),
+    'RagelDLexer': ('@lang: d',),
+    'RagelJavaLexer': ('@lang: java',),
+    'RagelObjectiveCLexer': ('@lang: objc',),
+    'RagelRubyLexer': ('@lang: ruby',),
+    'RegeditLexer': ('windows registry editor',),
+    'RexxLexer': ('/*',),
+    'SLexer': ('<-',),
+    'StanLexer': ('parameters',),
+    'SystemVerilogLexer': ('//', '/*'),
+    'TexLexer': ('\\',),
+    'VbNetAspxLexer': ('language',),
+
+    # Always run.
+    'CLexer': None,
+    'CbmBasicV2Lexer': None,
+    'CppLexer': None,
+    'CudaLexer': None,
+    'ECLexer': None,
+    'MatlabLexer': None,
+    'NesCLexer': None,
+    'PerlLexer': None,
+    'RagelEmbeddedLexer': None,
+    'RstLexer': None,
+    'SourcesListLexer': None,
+    'SwigLexer': None,
+}
+
+# The interpreter named by a shebang, without its path or arguments.
+_SHEBANG = re.compile(r'#!\s*(?:\S*/)?(?:env\s+(?:-\S+\s+)*)?([A-Za-z][\w.+-]*)')
+
+# Documents starting with an HTML doctype or an XML prolog, and the lexer
+# for them unless a more specific markup lexer recognizes them. (Pygments
+# rates most HTML5 documents as XML.)
+_DOCUMENTS = (
+    (re.compile(r'\s*(?:<\?xml[^>]*>\s*)?<!doctype\s+html[\s>]|\s*<html[\s>]', re.I), 'HtmlLexer'),
+    (re.compile(r'\s*<\?xml\s'), 'XmlLexer'),
+)
+_GENERIC_MARKUP = frozenset([fallback for _, fallback in _DOCUMENTS])
+
+# Alias parts (html+django is html and django) of the lexers for markup and
+# the template languages embedded in it, the only ones tried for documents.
+_MARKUP = frozenset([
+    'aspx', 'cheetah', 'django', 'dtd', 'erb', 'evoque', 'genshi', 'html',
+    'htmldjango', 'jinja', 'jsp', 'kid', 'lasso', 'mako', 'mason', 'myghty',
+    'php', 'rhtml', 'smarty', 'spitfire', 'ssp', 'tea', 'velocity', 'xml',
+    'xslt',
+])
+
+class ContentDetector(object):
+    """
+    Picks a lexer for a text on its own, like guess_lexer, without running
+    the analyse_text of every lexer over all of it.
+
+    Cheap, strong signals are checked first: a vim modeline, the interpreter
+    a shebang names, and an XML prolog or HTML doctype, after which only
+    lexers for such documents are considered. Otherwise, analyse_text is
+    run on the lexers whose _NEEDS are in the text, over a prefix of it, and
+    the lexer that rates it highest is picked as guess_lexer would pick it.
+
+    Results are remembered by a digest of the text, so pastes seen before
+    cost a hash.
+    """
+    def __init__(self, lexer_class, prefix_chars=4096, max_entries=1024):
+        # Looks up lexer classes by alias.
+        self._lexer_class = lexer_class
+        self.prefix_chars = prefix_chars
+
+        self._lock = Lock()
+        self._table = None
+        self._analysers = None
+        self._results = LRUCache(max_entries)
+
+    def build(self):
+        """
+        Find the lexers with an analyse_text now, rather than when first
+        needed.
+        """
+        self._candidates()
+
+    def lexer_class(self, text):
+        """
+        Returns the lexer class for text, raising ClassNotFound if nothing
+        recognizes it.
+        """
+        if isinstance(text, unicode):
+            digest = sha1(text.encode('utf-8')).digest()
+        else:
+            digest = sha1(text).digest()
+
+        cls = self._results.get(digest)
+        if cls is None:
+            cls = self._detect(text)
+            self._results.set(digest, cls, 1)
+
+        if not cls:
+            raise ClassNotFound('no lexer matching the text found')
+        return cls
+
+    def _detect(self, text):
+        """
+        The lexer class for text, or False.
+        """
+        from pygments.modeline import get_filetype_from_line
+
+        prefix = text[:self.prefix_chars]
+        names = []
+
+        # Modelines, looked for in the same lines guess_lexer looks in: the
+        # last five, then the second to the sixth.
+        head = prefix.splitlines()
+        if len(text) > len(prefix):
+            tail = text[-self.prefix_chars:].splitlines()
+        else:
+            tail = head
+        for line in tail[-1:-6:-1] + head[5:0:-1]:
+            filetype = get_filetype_from_line(line)
+            if filetype:
+                names.append(filetype)
+                break
+
+        # The interpreter, as in python3, or else python for python2.7.
+        if prefix.startswith('#!'):
+            match = _SHEBANG.match(prefix)
+            if match:
+                interpreter = match.group(1).lower()
+                names.append(interpreter)
+                names.append(re.sub(r'[\d.]+$', '', interpreter))
+
+        for name in names:
+            try:
+                return self._lexer_class(alias=str(name))
+            except ClassNotFound:
+                pass
+
+        # Many analysers ask looks_like_xml, which memoizes its answer by
+        # the text's hash; answer for it, in a fraction of the time it takes.
+        from pygments import util
+        xml_cache = getattr(util, '_looks_like_xml_cache', None)
+        if xml_cache is not None:
+            xml_cache[hash(prefix)] = _looks_like_xml(prefix)
+
+        try:
+            for document, fallback in _DOCUMENTS:
+                if document.match(prefix):
+                    candidates = [(lexer_id, cls) for lexer_id, cls in self._candidates(prefix)
+                                  if _MARKUP.intersection(_alias_parts(cls))]
+                    cls = self._best(candidates, prefix)
+                    if not cls or cls.__name__ in _GENERIC_MARKUP:
+                        cls = self._table.load(self._table.builtin[fallback])
+                    return cls
+
+            return self._best(self._candidates(prefix), prefix)
+        finally:
+            # It never forgets otherwise; we remember the result anyway.
+            if xml_cache is not None:
+                xml_cache.pop(hash(prefix), None)
+
+    def _best(self, candidates, text):
+        """
+        The lexer guess_lexer would pick among candidates: the first to be
+        sure of text, or else the one that rates it highest. False if none
+        of them recognize it at all.
+        """
+        best = (0.0, False)
+        for _, cls in candidates:
+            rating = cls.analyse_text(text)
+            if rating == 1.0:
+                return cls
+            if rating > best[0]:
+                best = (rating, cls)
+        return best[1]
+
+    def _candidates(self, text=None):
+        """
+        The (lexer id, class) of the lexers with an analyse_text that needs
+        something in text, or all of them without text.
+        """
+        if self._analysers is None:
+            self._lock.acquire()
+            try:
+                if self._analysers is None:
+                    self._analysers = self._build()
+            finally:
+                self._lock.release()
+
+        if text is None:
+            return [(lexer_id, cls) for lexer_id, cls, _ in self._analysers]
+
+        text = text.lower()
+        found = {}
+        candidates = []
+        for lexer_id, cls, needs in self._analysers:
+            if needs is not None:
+                for literal in needs:
+                    present = found.get(literal)
+                    if present is None:
+                        present = found[literal] = literal in text
+                    if present:
+                        break
+                else:
+                    continue
+            candidates.append((lexer_id, cls))
+        return candidates
+
+    def _build(self):
+        """
+        The (lexer id, class, needs) of every lexer with an analyse_text of
+        its own, in the order guess_lexer goes through them. Only the lexer
+        modules that mention analyse_text are imported to find them.
+        """
+        from pygments.lexer import Lexer
+
+        table = self._table = _LexerTable()
+        modules = _modules_mentioning('analyse_text')
+
+        analysers = []
+        for lexer_id in xrange(len(table)):
+            module = table.module(lexer_id)
+            if module is not None and modules is not None and module not in modules:
+                continue
+            cls = table.load(lexer_id)
+            if cls.analyse_text is not Lexer.analyse_text:
+                analysers.append((lexer_id, cls, _NEEDS.get(cls.__name__)))
+        return analysers
+
+def _looks_like_xml(text):
+    """
+    What pygments.util.looks_like_xml says of text, in linear time. Its
+    tag_re, <(.+?)(\s.*?)?>.*?</.+?> with re.S, backtracks through all of
+    the first 1000 characters of texts without tags, and only asks for a
+    <, a > at least two characters on, then a </ and another >.
+    """
+    from pygments.util import doctype_lookup_re
+
+    if doctype_lookup_re.match(text):
+        return True
+
+    text = text[:1000]
+    start = text.find('<')
+    if start < 0:
+        return False
+    end = text.find('>', start + 2)
+    if end < 0:
+        return False
+    close = text.find('</', end + 1)
+    return close >= 0 and text.find('>', close + 3) >= 0
+
+def _alias_parts(cls):
+    """
+    The parts of a lexer's aliases, split at + and -.
+    """
+    parts = set()
+    for alias in cls.aliases:
+        parts.update(re.split(r'[+-]', alias.lower()))
+    return parts
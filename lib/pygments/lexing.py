@@ -0,0 +1,781 @@
+# -*- coding: utf-8 -*-
+"""
+Running RegexLexers from the middle of a text: from a line whose state is
+known, and from several lines at once, in a pool of processes; trying only
+the rules that can match the character at hand; and into a TokenBuffer.
+"""
+
+import os
+import sre_compile
+import sre_parse
+from array import array
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from sre_constants import LITERAL, NOT_LITERAL, IN, ANY, RANGE, CATEGORY, SUBPATTERN, \
+    BRANCH, GROUPREF, MAX_REPEAT, MIN_REPEAT, AT, ASSERT, ASSERT_NOT, CATEGORY_DIGIT, \
+    CATEGORY_SPACE, CATEGORY_WORD, SRE_FLAG_IGNORECASE, SRE_FLAG_LOCALE, \
+    SRE_FLAG_UNICODE, SRE_FLAG_DOTALL, MAXREPEAT
+from tempfile import mkstemp
+from threading import Lock, Thread
+from time import time, sleep
+
+from pygments.lexer import Lexer, RegexLexer, ExtendedRegexLexer
+from pygments.token import _TokenType, Token, Text, Error
+
+from tokenbuffer import TokenBuffer
+
+# Rules that match nothing move the lexer to another state; this many in a
+# row at one place means the states lead back to each other.
+_MAX_STALLS = 1000
+
+class LexerStuck(Exception):
+    pass
+
+# Matches between looks at the clock, when lexing to a deadline.
+_DEADLINE_MATCHES = 1024
+
+class Timeout(Exception):
+    """
+    Raised when lexing runs past its deadline.
+    """
+    pass
+
+def restartable(lexer):
+    """
+    Returns whether the lexer tokenizes with RegexLexer's own loop and no
+    filters, so its state stack says all there is to know about where it is,
+    and it can be started at any line whose stack is known.
+    """
+    cls = type(lexer)
+    return (isinstance(lexer, RegexLexer) and not isinstance(lexer, ExtendedRegexLexer) and
+            cls.get_tokens_unprocessed.im_func is RegexLexer.get_tokens_unprocessed.im_func and
+            cls.get_tokens.im_func is Lexer.get_tokens.im_func and
+            not lexer.filters)
+
+def preprocess(lexer, text):
+    """
+    Returns the unicode text as Lexer.get_tokens would hand it to
+    get_tokens_unprocessed.
+    """
+    if text.startswith(u'\ufeff'):
+        text = text[len(u'\ufeff'):]
+    text = text.replace(u'\r\n', u'\n')
+    text = text.replace(u'\r', u'\n')
+    if lexer.stripall:
+        text = text.strip()
+    elif lexer.stripnl:
+        text = text.strip(u'\n')
+    if lexer.tabsize > 0:
+        text = text.expandtabs(lexer.tabsize)
+    if lexer.ensurenl and not text.endswith(u'\n'):
+        text += u'\n'
+    return text
+
+# What the character classes \d, \s and \w match, short of unicode or locale
+# rules. Anything else we can't tell the first character of.
+_CATEGORIES = {
+    CATEGORY_DIGIT: u'0123456789',
+    CATEGORY_SPACE: u' \t\n\r\f\v',
+    CATEGORY_WORD: u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_',
+}
+
+# Character ranges bigger than this aren't worth listing.
+_MAX_RANGE = 256
+
+def _first_chars(items, flags):
+    """
+    Returns the characters a match of the parsed regex items can start with,
+    as a set, or None if it could start with anything or we can't tell; and
+    whether the items can match nothing at all.
+    """
+    chars = set()
+    for op, av in items:
+        if op in (AT, ASSERT, ASSERT_NOT):
+            # Matches no characters itself.
+            continue
+        if op is LITERAL:
+            first, empty = set([unichr(av)]), False
+        elif op is IN:
+            first, empty = _in_chars(av, flags), False
+        elif op is SUBPATTERN:
+            first, empty = _first_chars(av[1], flags)
+        elif op is BRANCH:
+            first, empty = set(), False
+            for branch in av[1]:
+                branch_first, branch_empty = _first_chars(branch, flags)
+                if branch_first is None:
+                    return None, True
+                first |= branch_first
+                empty = empty or branch_empty
+        elif op in (MAX_REPEAT, MIN_REPEAT):
+            first, empty = _first_chars(av[2], flags)
+            empty = empty or av[0] == 0
+        else:
+            return None, True
+        if first is None:
+            return None, True
+        chars |= first
+        if not empty:
+            return _ignore_case(chars, flags), False
+    return _ignore_case(chars, flags), True
+
+def _in_chars(items, flags):
+    """
+    Returns the characters a parsed character class matches, as a set, or
+    None for classes that are negated, too big, or depend on unicode or the
+    locale.
+    """
+    chars = set()
+    for op, av in items:
+        if op is LITERAL:
+            chars.add(unichr(av))
+        elif op is RANGE and av[1] - av[0] < _MAX_RANGE:
+            chars.update(unichr(i) for i in xrange(av[0], av[1] + 1))
+        elif op is CATEGORY and av in _CATEGORIES and not flags & (SRE_FLAG_UNICODE | SRE_FLAG_LOCALE):
+            chars.update(_CATEGORIES[av])
+        else:
+            return None
+    return chars
+
+def _ignore_case(chars, flags):
+    """
+    Adds the other case of each character to chars if the regex ignores case;
+    without unicode or locale rules, that's only ever an ASCII letter's.
+    """
+    if chars is None or not flags & SRE_FLAG_IGNORECASE:
+        return chars
+    if flags & (SRE_FLAG_UNICODE | SRE_FLAG_LOCALE):
+        return None
+    cased = set(chars)
+    for char in chars:
+        if char < u'\x80':
+            cased.add(char.lower())
+            cased.add(char.upper())
+    return cased
+
+def rule_first_chars(rexmatch):
+    """
+    Returns the characters a rule's regex can match at the start, as a set,
+    or None if it can match nothing, or start with anything we can't list.
+    """
+    pattern = rexmatch.__self__
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    chars, empty = _first_chars(parsed, parsed.pattern.flags)
+    if empty:
+        return None
+    return chars
+
+def rule_opener(rexmatch):
+    """
+    Returns a match function for what a rule's regex starts with, if it then
+    runs on over anything, lines included, for as long as it takes, as the
+    rule for a comment or a string does: one that fails where its start
+    matches, short of an end, may match once an end is added further down.
+    Returns None for other rules.
+    """
+    pattern = rexmatch.__self__
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    flags = parsed.pattern.flags
+    items = list(parsed)
+    while items and items[0][0] is SUBPATTERN:
+        items[:1] = list(items[0][1][1])
+    for i, item in enumerate(items):
+        if _runs_on([item], flags):
+            break
+    else:
+        return None
+    start = items[:i]
+    if not start or not _fixed(start) or _first_chars(start, flags)[1]:
+        return None
+    try:
+        return sre_compile.compile(sre_parse.SubPattern(parsed.pattern, start), flags).match
+    except Exception:
+        return None
+
+def _fixed(items):
+    """
+    Returns whether the parsed regex items match a few characters at most:
+    they repeat nothing but what's optional.
+    """
+    for op, av in items:
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            if av[1] > 1 or not _fixed(av[2]):
+                return False
+        elif op is SUBPATTERN:
+            if not _fixed(av[1]):
+                return False
+        elif op is BRANCH:
+            if [branch for branch in av[1] if not _fixed(branch)]:
+                return False
+        elif op not in (LITERAL, IN, AT):
+            return False
+    return True
+
+def _runs_on(items, flags):
+    """
+    Returns whether the parsed regex items repeat, without end, something
+    that can start with a newline, or with anything we can't list.
+    """
+    for op, av in items:
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            if av[1] == MAXREPEAT and _first_chars(av[2], flags)[0] is None:
+                try:
+                    if sre_compile.compile(av[2], flags).match(u'\n'):
+                        return True
+                except Exception:
+                    pass
+            if _runs_on(av[2], flags):
+                return True
+        elif op is SUBPATTERN and _runs_on(av[1], flags):
+            return True
+        elif op is BRANCH and [branch for branch in av[1] if _runs_on(branch, flags)]:
+            return True
+    return False
+
+def rule_newlines(rexmatch):
+    """
+    Returns the most newlines a rule's regex can match or look ahead at, or
+    None if it can go on over any number of them, or we can't tell.
+    """
+    pattern = rexmatch.__self__
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    return _newlines(parsed, parsed.pattern.flags, {})
+
+def _newlines(items, flags, groups):
+    """
+    Returns the most newlines the parsed regex items can match or look ahead
+    at, or None; groups holds those of each group that's been matched.
+    """
+    count = 0
+    for op, av in items:
+        if op is LITERAL:
+            lines = av == 10 and 1 or 0
+        elif op is NOT_LITERAL:
+            lines = av != 10 and 1 or 0
+        elif op is ANY:
+            lines = flags & SRE_FLAG_DOTALL and 1 or 0
+        elif op is IN:
+            try:
+                matched = sre_compile.compile(sre_parse.SubPattern(items.pattern, [(op, av)]), flags).match(u'\n')
+            except Exception:
+                return None
+            lines = matched and 1 or 0
+        elif op is AT:
+            lines = 0
+        elif op is SUBPATTERN:
+            lines = _newlines(av[1], flags, groups)
+            if av[0] is not None:
+                groups[av[0]] = lines
+        elif op is GROUPREF:
+            lines = groups.get(av)
+        elif op is BRANCH:
+            lines = [_newlines(branch, flags, groups) for branch in av[1]]
+            lines = max(lines) if None not in lines else None
+        elif op in (MAX_REPEAT, MIN_REPEAT):
+            lines = _newlines(av[2], flags, groups)
+            if lines:
+                lines = lines * av[1] if av[1] != MAXREPEAT else None
+        elif op in (ASSERT, ASSERT_NOT):
+            # Looking behind sees lines before, not after.
+            lines = _newlines(av[1], flags, groups) if av[0] > 0 else 0
+        else:
+            return None
+        if lines is None:
+            return None
+        count += lines
+    return count
+
+class _Dispatch(dict):
+    """
+    The rules of a lexer's states, by state, then by the character at hand:
+    for each state, a dict of the rules that can match at each character
+    some rule starts with, and the rules that can match at any other. Also
+    the rule_opener of each rule.
+
+    A rule is left out only if its regex can't start with the character, so
+    the first of the rest that matches is the first of all of them that
+    would; rules keep their order. States are done as the lexer gets to them.
+    """
+    def __init__(self, tokendefs):
+        dict.__init__(self)
+        self.tokendefs = tokendefs
+        self.first_chars = {}
+        self.openers = {}
+        self._lines_ahead = None
+
+    def __missing__(self, state):
+        rules = self.tokendefs[state]
+        firsts = []
+        for rule in rules:
+            rexmatch = rule[0]
+            if rexmatch not in self.first_chars:
+                self.first_chars[rexmatch] = rule_first_chars(rexmatch)
+                self.openers[rexmatch] = rule_opener(rexmatch)
+            firsts.append(self.first_chars[rexmatch])
+
+        anywhere = tuple([rule for rule, first in zip(rules, firsts) if first is None])
+        table = {}
+        for first in firsts:
+            for char in first or ():
+                if char not in table:
+                    table[char] = tuple([rule for rule, first in zip(rules, firsts)
+                                         if first is None or char in first])
+        self[state] = table, anywhere
+        return table, anywhere
+
+    def lines_ahead(self):
+        """
+        Returns the most lines past the one it starts at that a rule can
+        match or look at, of those that can't go on over any number, and at
+        least one: what a rule's match ends at may be decided by a look at
+        the start of the next line.
+        """
+        if self._lines_ahead is None:
+            counts = [rule_newlines(rule[0]) for rules in self.tokendefs.itervalues() for rule in rules]
+            self._lines_ahead = max([count for count in counts if count is not None] + [1])
+        return self._lines_ahead
+
+# _Dispatches by the id of the rules they're for, which each keeps alive.
+_dispatches = {}
+
+def dispatch(lexer):
+    """
+    Returns the _Dispatch for the lexer's rules. Lexers of a class share
+    their rules, and so their _Dispatch, but for those that pick their rules
+    per instance, as CSharpLexer does by unicodelevel: they share it with
+    the lexers that picked the same.
+    """
+    tokendefs = lexer._tokens
+    try:
+        return _dispatches[id(tokendefs)]
+    except KeyError:
+        return _dispatches.setdefault(id(tokendefs), _Dispatch(tokendefs))
+
+def lex(lexer, text, pos=0, stack=('root',), at_line=None, deadline=None, misses=None):
+    """
+    Yields the (tokentype, value) pairs of text from pos, which must be the
+    start of a line, lexing with the given state stack.
+
+    If given, at_line is called with the position of every line start the
+    lexer gets to and its state stack there, or None for the lines a token
+    runs into. Lexing stops once it returns true, or at the end of the text.
+    Raises Timeout if it's still lexing at deadline, a time.time().
+
+    If given, misses is a list the position of each character yielded as
+    Error is appended to, as is that of each match after a rule that failed
+    there with its rule_opener in place: the start of a comment, say, that
+    never ends.
+
+    This is RegexLexer.get_tokens_unprocessed, trying only the rules that can
+    match at the character at hand, with a look at every line, and a way out
+    of rules that keep matching nothing at the same place, which would
+    otherwise go round in circles forever: a LexerStuck error.
+    """
+    end = len(text)
+    line_start = at_line is None and end + 1 or pos
+    stalls = 0
+    checks = _DEADLINE_MATCHES
+
+    states = dispatch(lexer)
+    openers = states.openers
+    statestack = list(stack)
+    table, anywhere = states[statestack[-1]]
+    while 1:
+        while line_start <= pos:
+            if line_start == end:
+                # Rules that match nothing still get a go at the very end.
+                line_start += 1
+                break
+            if line_start == pos:
+                if at_line(line_start, statestack):
+                    return
+            else:
+                at_line(line_start, None)
+            line_start = text.find(u'\n', line_start) + 1
+
+        rules = table.get(text[pos:pos + 1], anywhere)
+        for rexmatch, action, new_state in rules:
+            m = rexmatch(text, pos)
+            if m:
+                if misses is not None:
+                    for rule in rules:
+                        if rule[0] is rexmatch:
+                            break
+                        opener = openers[rule[0]]
+                        if opener and opener(text, pos):
+                            misses.append(pos)
+                            break
+                if type(action) is _TokenType:
+                    yield action, m.group()
+                else:
+                    for item in action(lexer, m):
+                        yield item[1:]
+                if m.end() == pos:
+                    stalls += 1
+                    if stalls > _MAX_STALLS:
+                        raise LexerStuck("%s is stuck at position %d" % (lexer.name, pos))
+                else:
+                    pos = m.end()
+                    stalls = 0
+                    checks -= 1
+                    if not checks:
+                        if deadline is not None and time() > deadline:
+                            raise Timeout("%s ran out of time at position %d" % (lexer.name, pos))
+                        checks = _DEADLINE_MATCHES
+                if new_state is not None:
+                    # state transition
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        # pop
+                        del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % new_state
+                    table, anywhere = states[statestack[-1]]
+                break
+        else:
+            if pos == end:
+                return
+            if text[pos] == u'\n':
+                # at EOL, reset state to "root"
+                statestack = ['root']
+                table, anywhere = states['root']
+                yield Text, u'\n'
+            else:
+                if misses is not None:
+                    misses.append(pos)
+                yield Error, text[pos]
+            pos += 1
+
+def lex_buffer(lexer, text, deadline=None):
+    """
+    Returns the tokens of the preprocessed text as a TokenBuffer, lexed as
+    lex would from the start, but noting where each token starts rather than
+    making a substring and a pair for it.
+
+    Raises ValueError if a rule's callback yields a value that isn't the text
+    at its index, which only a buffer minds, and Timeout if it's still lexing
+    at deadline, a time.time().
+    """
+    buffer = TokenBuffer(text)
+    starts_append = buffer.starts.append
+    ids_append = buffer.ids.append
+    type_ids = buffer._ids
+    type_id = buffer.type_id
+
+    end = len(text)
+    pos = last = 0
+    stalls = 0
+    checks = _DEADLINE_MATCHES
+
+    states = dispatch(lexer)
+    statestack = ['root']
+    table, anywhere = states['root']
+    while 1:
+        for rexmatch, action, new_state in table.get(text[pos:pos + 1], anywhere):
+            m = rexmatch(text, pos)
+            if m:
+                if type(action) is _TokenType:
+                    if pos != last:
+                        starts_append(last)
+                        ids_append(0)
+                    starts_append(pos)
+                    ids_append(type_ids.get(action) or type_id(action))
+                    last = m.end()
+                else:
+                    for index, ttype, value in action(lexer, m):
+                        if index < last or not text.startswith(value, index):
+                            raise ValueError("%s token at %d isn't the text there" % (lexer.name, index))
+                        if index != last:
+                            starts_append(last)
+                            ids_append(0)
+                        starts_append(index)
+                        ids_append(type_ids.get(ttype) or type_id(ttype))
+                        last = index + len(value)
+                if m.end() == pos:
+                    stalls += 1
+                    if stalls > _MAX_STALLS:
+                        raise LexerStuck("%s is stuck at position %d" % (lexer.name, pos))
+                else:
+                    pos = m.end()
+                    stalls = 0
+                    checks -= 1
+                    if not checks:
+                        if deadline is not None and time() > deadline:
+                            raise Timeout("%s ran out of time at position %d" % (lexer.name, pos))
+                        checks = _DEADLINE_MATCHES
+                if new_state is not None:
+                    # state transition
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        # pop
+                        del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % new_state
+                    table, anywhere = states[statestack[-1]]
+                break
+        else:
+            if pos == end:
+                break
+            if pos != last:
+                starts_append(last)
+                ids_append(0)
+            starts_append(pos)
+            if text[pos] == u'\n':
+                # at EOL, reset state to "root"
+                statestack = ['root']
+                table, anywhere = states['root']
+                ids_append(type_ids.get(Text) or type_id(Text))
+            else:
+                ids_append(type_ids.get(Error) or type_id(Error))
+            pos += 1
+            last = pos
+
+    buffer.end = last
+    return buffer
+
+# The pool parallel lexing is done in, and the pid and number of processes
+# it was made for. It's made when first needed, and again after a fork: its
+# processes are another's children, and the threads that feed them aren't
+# copied. One job runs in it at a time.
+_pool = None
+_pool_for = None
+_jobs = 0
+_job_lock = Lock()
+
+# The job a pool process has loaded: its number, lexer and text.
+_job = (None, None, None)
+
+# Seconds between a pool process's looks at whether its parent is still there.
+_ORPHAN_CHECK = 1
+
+_ROOT = ['root']
+
+def parallel_tokens(lexer, text, processes, chunk_chars, deadline=None):
+    """
+    Returns the tokens of the preprocessed text, as a list of (tokentype,
+    value) pairs, lexing it in chunks of about chunk_chars in a pool of
+    processes. The lexer must be restartable.
+
+    Each chunk is lexed on the guess that its first line starts in the root
+    state, noting the lines after that which do too. Stitching the chunks
+    together, we lex on from the end of the previous chunk only until we
+    reach one of those lines, and take the rest of the chunk as it is;
+    lexing is the same from the same line and state on. If no line matches,
+    the guess was wrong, and the chunk has been lexed over here instead.
+    The result is exactly what lexing the whole text in one go gives.
+
+    Raises Timeout if it's still lexing at deadline, a time.time().
+    """
+    global _jobs
+
+    bounds = []
+    start = 0
+    while start < len(text):
+        end = text.find(u'\n', start + chunk_chars) + 1 or len(text)
+        bounds.append((start, end))
+        start = end
+
+    _job_lock.acquire()
+    try:
+        import multiprocessing
+
+        # Pool processes load the job from a file, once each, rather than
+        # have the whole text pickled along with every chunk.
+        fd, path = mkstemp(prefix='mentos-job-')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                dump((type(lexer), lexer.options, text), f, HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            _jobs += 1
+            job = (os.getpid(), _jobs)
+            pool = _get_pool(processes)
+            try:
+                result = pool.map_async(_lex_chunk, [(job, path, chunk) for chunk in bounds], 1)
+                if deadline is None:
+                    chunks = result.get()
+                else:
+                    try:
+                        chunks = result.get(max(deadline - time(), 0))
+                    except multiprocessing.TimeoutError:
+                        raise Timeout("%s ran out of time" % lexer.name)
+            except:
+                # Don't leave the pool busy with what's left of the job.
+                _drop_pool()
+                raise
+        finally:
+            os.remove(path)
+    finally:
+        _job_lock.release()
+
+    tokens = []
+    pos, stack = 0, _ROOT
+    for (start, end), chunk in zip(bounds, chunks):
+        if deadline is not None and time() > deadline:
+            raise Timeout("%s ran out of time at position %d" % (lexer.name, pos))
+        checkpoints = chunk and chunk[4] or {}
+        stop = []
+
+        def at_line(line_start, statestack):
+            if statestack is None:
+                return False
+            if line_start in checkpoints and statestack == _ROOT or line_start >= end:
+                stop.append((line_start, statestack))
+                return True
+            return False
+
+        tokens.extend(lex(lexer, text, pos, stack, at_line, deadline))
+        if not stop:
+            # A token ran on to the end of the text.
+            break
+        pos, stack = stop[0]
+        if pos in checkpoints and stack == _ROOT:
+            tokens.extend(_decode(chunk, checkpoints[pos]))
+            if chunk[5] is None:
+                break
+            pos, stack = chunk[5], chunk[6]
+
+    return tokens
+
+def _get_pool(processes):
+    """
+    Returns the pool of processes to lex in, making it if this process
+    hasn't one of that many processes yet.
+    """
+    global _pool, _pool_for
+    import multiprocessing
+
+    if _pool_for != (os.getpid(), processes):
+        if _pool_for and _pool_for[0] == os.getpid():
+            _drop_pool()
+        _pool = multiprocessing.Pool(processes, _watch_parent, (os.getpid(),))
+        _pool_for = (os.getpid(), processes)
+    return _pool
+
+def _drop_pool():
+    """
+    Terminates this process's pool, if it has one, for the next job to make
+    another.
+    """
+    global _pool, _pool_for
+    if _pool_for and _pool_for[0] == os.getpid():
+        _pool.terminate()
+        _pool.join()
+    _pool = _pool_for = None
+
+def _watch_parent(parent):
+    """
+    Starts a pool process looking out for its parent going away. The pool
+    is never closed if the parent is killed, and its processes wouldn't hear
+    of it, waiting on a pipe they hold both ends of.
+    """
+    def watch():
+        while os.getppid() == parent:
+            sleep(_ORPHAN_CHECK)
+        os._exit(0)
+
+    watcher = Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+
+def _lex_chunk(task):
+    """
+    Lex the chunk between the bounds of a (job, path, bounds) task, from the
+    root state, on to the first line after it that starts outside a token,
+    loading the job from the file at path if it's not the one loaded.
+
+    Returns the chunk's tokens, encoded for the trip back, the token index of
+    each line in it that starts in the root state, and the position and state
+    stack lexing stopped at, both None at the end of the text; or None if the
+    lexer failed, which starting in the wrong state can make it do.
+    """
+    global _job
+    job, path, (start, end) = task
+    if _job[0] != job:
+        f = open(path, 'rb')
+        try:
+            cls, options, text = load(f)
+        finally:
+            f.close()
+        _job = (job, cls(**options), text)
+    _, lexer, text = _job
+    tokens = []
+    checkpoints = {}
+
+    stop = [None, None]
+
+    def at_line(line_start, statestack):
+        if statestack is None:
+            return False
+        if line_start >= end:
+            stop[:] = line_start, statestack
+            return True
+        if statestack == _ROOT:
+            checkpoints[line_start] = len(tokens)
+        return False
+
+    try:
+        for token in lex(lexer, text, start, _ROOT, at_line):
+            tokens.append(token)
+    except Exception:
+        return None
+    pos, stack = stop
+
+    # Token types go by index, and values as one string and their lengths,
+    # which pickle much faster than a list of pairs.
+    types = {}
+    ids = array('H')
+    lengths = array('l')
+    for ttype, value in tokens:
+        ids.append(types.setdefault(ttype, len(types)))
+        lengths.append(len(value))
+    names = [None] * len(types)
+    for ttype, i in types.iteritems():
+        names[i] = tuple(ttype)
+    return names, ids, lengths, u''.join([value for _, value in tokens]), checkpoints, pos, stack
+
+def _decode(chunk, first):
+    """
+    Yields the tokens of an encoded chunk, from the given token index on.
+    """
+    names, ids, lengths, values = chunk[:4]
+
+    types = []
+    for name in names:
+        ttype = Token
+        for part in name:
+            ttype = getattr(ttype, part)
+        types.append(ttype)
+
+    offset = sum(lengths[:first])
+    for i in xrange(first, len(ids)):
+        length = lengths[i]
+        yield types[ids[i]], values[offset:offset + length]
+        offset += length
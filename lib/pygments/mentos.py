@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys, re, os, signal
+import sys, re, os, signal, struct, time, errno
 import traceback
+from hashlib import sha1
 if 'PYGMENTS_PATH' in os.environ:
     sys.path.insert(0, os.environ['PYGMENTS_PATH'])
 
@@ -13,10 +14,56 @@ sys.path.append(base_dir + "/vendor")
 sys.path.append(base_dir + "/vendor/pygments-main")
 sys.path.append(base_dir + "/vendor/simplejson")
 
+# Only the core package is imported up front. pygments.lexers, formatters,
+# styles and filters each cost tens of milliseconds to import, so they're
+# imported by the methods that need them, and a fresh mentos can answer its
+# first request without paying for the ones it doesn't use.
 import pygments
-from pygments import lexers, formatters, styles, filters
+from pygments.util import ClassNotFound
 
-from threading import Lock
+class _DeferredModule(object):
+    """
+    Stands in for a module until one of its attributes is first used, and
+    imports it then. Should the import fail, the attributes given as
+    fallbacks are used instead, and any others raise the ImportError.
+    """
+    def __init__(self, name, **fallbacks):
+        self._name = name
+        self._fallbacks = fallbacks
+        self._module = None
+        self._error = None
+
+    def __getattr__(self, attr):
+        if self._module is None and self._error is None:
+            try:
+                self._module = __import__(self._name)
+            except ImportError, e:
+                self._error = e
+        if self._module is not None:
+            return getattr(self._module, attr)
+        if attr in self._fallbacks:
+            return self._fallbacks[attr]
+        raise self._error
+
+# pygments.plugin imports pkg_resources, which alone takes longer than the
+# rest of Pygments, only to look up plugins when a builtin lexer, formatter
+# or style isn't found. Hand it a stand-in, so that's paid on the first
+# plugin lookup instead. Without setuptools, it finds no plugins, just as
+# pygments.plugin would have had its own import failed.
+if 'pkg_resources' not in sys.modules:
+    sys.modules['pkg_resources'] = _DeferredModule('pkg_resources',
+                                                   iter_entry_points=lambda group, name=None: iter(()))
+    try:
+        import pygments.plugin
+    finally:
+        del sys.modules['pkg_resources']
+
+from threading import Lock, Thread, local
+import Queue
+
+from caches import LRUCache, InstanceCache, freeze
+from metrics import Metrics
+from lexer_index import FilenameIndex, ContentDetector
 
 try:
     import json
@@ -43,6 +90,172 @@ def _get_fixed_bits_from_header(out_header):
     size = len(out_header)
     return "".join(map(lambda y:str((size>>y)&1), range(32-1, -1, -1)))
 
+# Protocol negotiation. A client that wants the framed protocol opens the
+# conversation with PROTOCOL_MAGIC followed by a single byte holding the
+# highest version it speaks; we answer with the version we'll actually use.
+# Clients that send nothing get the original (version 1) bit-string protocol,
+# whose first byte is always an ASCII '0' or '1'.
+PROTOCOL_MAGIC = "MNT"
+PROTOCOL_VERSION = 2
+
+# Version 2 frames are two big-endian unsigned 32 bit lengths (JSON header,
+# then body), followed by the header and the body themselves.
+_frame_prefix = struct.Struct(">II")
+
+class _Connection(object):
+    """
+    A client speaking the framed protocol: the files its frames are read from
+    and written to, stdin and stdout unless it connected to a daemon. Frames
+    can be written from several threads at once.
+    """
+    def __init__(self, infile, outfile, client=None):
+        self.infile = infile
+        self.outfile = outfile
+        self.client = client
+        self._write_lock = Lock()
+
+    def read_frame(self):
+        """
+        Read one version 2 frame. Returns a (header, body, seconds) tuple,
+        seconds being how long reading it took once it started coming in, or
+        None if the client went away.
+        """
+        prefix = self.infile.read(_frame_prefix.size)
+        if len(prefix) < _frame_prefix.size:
+            return None
+
+        started = time.time()
+        header_bytes, body_bytes = _frame_prefix.unpack(prefix)
+        header = json.loads(self.infile.read(header_bytes))
+        body = self.infile.read(body_bytes)
+        return header, body, time.time() - started
+
+    def write_frame(self, header, body=""):
+        """
+        Write one version 2 frame, in a single buffered write.
+        """
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        out_header = json.dumps(header).encode('utf-8')
+        frame = _frame_prefix.pack(len(out_header), len(body)) + out_header + body
+
+        self._write_lock.acquire()
+        try:
+            self.outfile.write(frame)
+            self.outfile.flush()
+        finally:
+            self._write_lock.release()
+
+class _FrameWriter(object):
+    """
+    A file-like object for formatters to write to, which sends what they
+    write to connection as chunk frames tagged with a request id, as soon as
+    chunk_bytes have built up. Only whole writes are sent, so an encoded
+    character is never split across two frames.
+    """
+    def __init__(self, connection, id, chunk_bytes=65536):
+        self.connection = connection
+        self.id = id
+        self.chunk_bytes = chunk_bytes
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.connection.write_frame({"id": self.id, "chunk": True}, "".join(self.parts))
+            self.parts = []
+            self.size = 0
+
+class MentosError(Exception):
+    """
+    Raised for errors that should be reported back to Rubyland as-is, without
+    a traceback.
+    """
+    pass
+
+class RequestTimeout(MentosError):
+    """
+    Raised when a request runs past the deadline its client gave it. Only
+    that request fails; the process carries on with the next.
+    """
+    pass
+
+# Tokens between looks at the clock.
+_DEADLINE_TOKENS = 256
+
+def _within(tokens, deadline):
+    """
+    Yields tokens, raising RequestTimeout once the deadline has passed. Lexers
+    and formatters both work a token at a time, so this stops either.
+    """
+    count = 0
+    for token in tokens:
+        yield token
+        count += 1
+        if count >= _DEADLINE_TOKENS:
+            if time.time() > deadline:
+                raise RequestTimeout("Request timed out")
+            count = 0
+
+def _timing_out(tokens, timeout):
+    """
+    Yields tokens, raising RequestTimeout in place of the timeout error of
+    whatever lexes them, which keeps its own time.
+    """
+    try:
+        for token in tokens:
+            yield token
+    except timeout:
+        raise RequestTimeout("Request timed out")
+
+# The budgets a highlight can be given: the most bytes of code it highlights,
+# the longest line, and the most seconds spent lexing.
+_BUDGETS = ("bytes", "line_length", "seconds")
+
+def _whole_lines(tokens, limit):
+    """
+    Returns the (tokentype, value) pairs that make up the whole lines in the
+    first limit characters of the text of tokens, a list, splitting the last
+    of them after its newline.
+    """
+    size = 0
+    for i, (ttype, value) in enumerate(tokens):
+        if size + len(value) > limit:
+            end = value.rfind(u'\n', 0, limit - size) + 1
+            if end:
+                return tokens[:i] + [(ttype, value[:end])]
+            break
+        size += len(value)
+    else:
+        i = len(tokens)
+
+    while i:
+        i -= 1
+        ttype, value = tokens[i]
+        end = value.rfind(u'\n') + 1
+        if end:
+            return tokens[:i] + [(ttype, value[:end])]
+    return []
+
+def _result_key(code, lexer, formatter_name, options):
+    """
+    Key a highlight result by everything it depends on: a digest of the code,
+    the resolved lexer class, the formatter and the (normalized) options.
+    """
+    if isinstance(code, unicode):
+        code = code.encode('utf-8')
+    lexer_class = type(lexer)
+    return (sha1(code).digest(), lexer_class.__module__ + "." + lexer_class.__name__,
+            formatter_name, json.dumps(options, sort_keys=True))
+
 def _signal_handler(signal, frame):
     """
     Handle the signal given in the first argument, exiting gracefully
@@ -53,8 +266,120 @@ class Mentos(object):
     """
     Interacts with pygments.rb to provide access to pygments functionality
     """
-    def __init__(self):
-        pass
+    def __init__(self, threads=1, cache_bytes=0, document_bytes=64 * 1024 * 1024,
+                 parallel=0, parallel_bytes=1024 * 1024, dispatch=True, token_buffers=True):
+        # Number of threads serving framed requests. With more than one,
+        # responses may go out in a different order than their requests came
+        # in, so a short request needn't wait behind a long one.
+        self.threads = threads
+
+        # Highlight results, so content we see again and again costs a hash
+        # lookup instead of lexing and formatting. Off unless given a budget.
+        if cache_bytes > 0:
+            self.results = LRUCache(cache_bytes)
+        else:
+            self.results = None
+
+        # Lexer and formatter instances, and the classes behind the names,
+        # mimetypes and filenames we've been asked for, so per-request setup
+        # is mostly dictionary lookups.
+        self.instances = InstanceCache()
+        self.lexer_classes = {}
+        self.formatter_classes = {}
+        self.filenames = FilenameIndex()
+        self.detector = ContentDetector(self.lexer_class)
+
+        # Stylesheets, by formatter, options (including the style) and prefix.
+        self.stylesheets = LRUCache(64)
+
+        # Documents being highlighted incrementally, by handle, up to a budget
+        # for their text.
+        self.documents = LRUCache(document_bytes)
+
+        # Number of processes to lex code of at least parallel_bytes with, for
+        # lexers that can be started partway through. Off unless given.
+        self.parallel = parallel
+        self.parallel_bytes = parallel_bytes
+
+        # Whether lexers that use RegexLexer's own loop are run by ours, which
+        # only tries the rules that can match at the character at hand.
+        self.dispatch = dispatch
+
+        # Whether tokens for formatters that can take a TokenBuffer are kept
+        # in one, as positions in the text, rather than as a pair and a
+        # substring per token; and the lexer classes that can't be.
+        self.token_buffers = token_buffers
+        self.unbuffered = set()
+
+        # The deadline of the request each thread is serving, if its client
+        # gave one, the time it has spent in each phase so far, and the
+        # connection it came in on.
+        self.request = local()
+
+        # Threads serving framed requests from a queue, once started.
+        self.queue = None
+        self.queue_lock = Lock()
+
+        # Counters and histograms of the requests served.
+        self.metrics = Metrics()
+
+    def timed(self, phase, started):
+        """
+        Adds the time since started to phase, in the timings of the request
+        being served, if it's keeping them. Returns the time now.
+        """
+        now = time.time()
+        timings = getattr(self.request, 'timings', None)
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + now - started
+        return now
+
+    def lexer_class(self, alias=None, mimetype=None):
+        """
+        Return the lexer class for the given alias or mimetype, raising
+        ClassNotFound if there's none.
+        """
+        key = (alias, mimetype)
+        cls = self.lexer_classes.get(key)
+
+        if cls is None:
+            from pygments import lexers
+
+            if alias is not None:
+                cls = type(lexers.get_lexer_by_name(alias))
+            else:
+                cls = type(lexers.get_lexer_for_mimetype(mimetype))
+            self.lexer_classes[key] = cls
+
+        return cls
+
+    def formatter(self, name, options):
+        """
+        Return a formatter for the given alias and options.
+        """
+        cls = self.formatter_classes.get(name)
+
+        if cls is None:
+            from pygments import formatters
+
+            # Builtin formatters first, since find_formatter_class looks
+            # up plugins even when it doesn't need to.
+            for builtin in formatters.FORMATTERS:
+                if name in builtin.aliases:
+                    cls = builtin
+                    break
+            else:
+                cls = formatters.find_formatter_class(name)
+
+            if not cls:
+                raise ClassNotFound("No formatter found for name %r" % name)
+
+            # Formatters of our own that give the same output, faster.
+            from formatting import FAST_FORMATTERS
+            cls = FAST_FORMATTERS.get(cls, cls)
+            self.formatter_classes[name] = cls
+
+        return self.instances.get(cls, options)
 
     def return_lexer(self, lexer, args, inputs, code=None):
         """
@@ -75,17 +400,14 @@ class Mentos(object):
         """
 
         if lexer:
-            if inputs:
-                return lexers.get_lexer_by_name(lexer, **inputs)
-            else:
-                return lexers.get_lexer_by_name(lexer)
+            return self.instances.get(self.lexer_class(alias=lexer), inputs or {})
 
         if inputs:
             if 'lexer' in inputs:
-                return lexers.get_lexer_by_name(inputs['lexer'], **inputs)
+                return self.instances.get(self.lexer_class(alias=inputs['lexer']), inputs)
 
             elif 'mimetype' in inputs:
-                return lexers.get_lexer_for_mimetype(inputs['mimetype'], **inputs)
+                return self.instances.get(self.lexer_class(mimetype=inputs['mimetype']), inputs)
 
             elif 'filename' in inputs:
                 name = inputs['filename']
@@ -93,24 +415,72 @@ class Mentos(object):
                 # If we have code and a filename, pygments allows us to guess
                 # with both. This is better than just guessing with code.
                 if code:
-                    return lexers.guess_lexer_for_filename(name, code, **inputs)
+                    cls = self.filenames.guess(name, code)
                 else:
-                    return lexers.get_lexer_for_filename(name, **inputs)
+                    cls = self.filenames.lexer_class(name)
+
+                # Lexers don't take a filename option; leaving it in would
+                # only give every filename its own cached instance.
+                options = dict(inputs)
+                del options['filename']
+                return self.instances.get(cls, options)
 
         # If all we got is code, try anyway.
         if code:
-            return lexers.guess_lexer(code, **inputs)
+            return self.instances.get(self.detector.lexer_class(code), inputs or {})
 
         else:
             return None
 
 
-    def highlight_text(self, code, lexer, formatter_name, args, kwargs):
+    def prewarm(self, aliases):
+        """
+        Compile the token tables of the given lexers now, rather than on their
+        first use. RegexLexerMeta compiles every regex of a lexer the first
+        time it's instantiated, which makes the first highlight in a new
+        process noticeably slow.
+
+        Returns a dict of the lexers warmed, the aliases we didn't know, and
+        the time it took in seconds.
+        """
+        started = time.time()
+        warmed = []
+        unknown = []
+
+        for alias in aliases:
+            try:
+                cls = self.lexer_class(alias=str(alias))
+            except ClassNotFound:
+                unknown.append(alias)
+                continue
+
+            lexer = self.instances.get(cls, {})
+            if self.dispatch:
+                import lexing
+                if lexing.restartable(lexer):
+                    lexing.dispatch(lexer)['root']
+            warmed.append(alias)
+
+        return {"lexers": warmed, "unknown": unknown, "seconds": time.time() - started}
+
+    def highlight_text(self, code, lexer, formatter_name, args, kwargs, out_header=None, outfile=None,
+                       budget=None):
         """
         Highlight the relevant code, and return a result string.
         The default formatter is html, but alternate formatters can be passed in via
         the formatter_name argument. Additional paramters can be passed as args
         or kwargs.
+
+        If given, out_header is told the alias of the lexer used, so clients
+        can keep track of which lexers are worth prewarming.
+
+        If given an outfile, the formatter writes to it as it goes and nothing
+        is returned. Results written this way aren't cached, since that would
+        mean holding on to all of them.
+
+        If given a budget, a dict of any of bytes, line_length and seconds, code
+        is highlighted only as far as the budget goes, as budget_tokens says,
+        and out_header is told which fallback, if any, was taken.
         """
         # Default to html if we don't have the formatter name.
         if formatter_name:
@@ -119,24 +489,359 @@ class Mentos(object):
             _format_name = "html"
 
         # Return a lexer object
+        started = time.time()
         lexer = self.return_lexer(lexer, args, kwargs, code)
+        started = self.timed("lexer", started)
 
         # Make sure we sucessfuly got a lexer
         if lexer:
-            formatter = pygments.formatters.get_formatter_by_name(str.lower(_format_name), **kwargs)
+            if out_header is not None and lexer.aliases:
+                out_header["lexer"] = lexer.aliases[0]
+
+            if self.results is not None:
+                key = _result_key(code, lexer, _format_name, kwargs)
+                res = self.results.get(key)
+                if res is not None:
+                    if budget and out_header is not None:
+                        out_header["budget"] = {"fallback": None, "lines": None}
+                    if outfile is not None:
+                        outfile.write(res)
+                        return None
+                    return res
+
+            formatter = self.formatter(str.lower(_format_name), kwargs)
+            buffer = getattr(formatter, 'takes_buffers', False)
+            fallback = None
+            if budget:
+                tokens, fallback, lines = self.budget_tokens(code, lexer, budget, buffer)
+                if out_header is not None:
+                    out_header["budget"] = {"fallback": fallback, "lines": lines}
+            else:
+                tokens = self.lex(code, lexer, buffer)
+            # Tokens that come from a generator are lexed as they're
+            # formatted, and timed as formatting.
+            started = self.timed("lex", started)
+
+            if outfile is not None:
+                pygments.format(tokens, formatter, outfile)
+                self.timed("format", started)
+                return None
 
             # Do the damn thing.
-            res = pygments.highlight(code, lexer, formatter)
+            res = pygments.format(tokens, formatter)
+            self.timed("format", started)
+
+            # What falls back is the budget's, not the code's.
+            if self.results is not None and fallback is None:
+                self.results.set(key, res, len(res) + len(key[3]))
 
             return res
 
         else:
-            _write_error("No lexer")
+            raise MentosError("No lexer")
+
+    def lex(self, code, lexer, buffer=False):
+        """
+        Returns the tokens of code, as the lexer's get_tokens would.
+
+        For lexers that use RegexLexer's own loop, code is lexed with ours: in
+        chunks, in a pool of processes, if it's big enough to be worth it and
+        parallel lexing is on, or else trying only the rules that can match at
+        each character, if that's on; into a TokenBuffer, if asked for one and
+        token buffers are on.
+
+        If the request has a deadline, lexing (and formatting, which pulls
+        tokens as it goes) raises RequestTimeout once it has passed.
+        """
+        deadline = getattr(self.request, 'deadline', None)
+        tokens = None
+
+        if (self.parallel or self.dispatch) and isinstance(code, unicode):
+            import lexing
+            if lexing.restartable(lexer):
+                text = lexing.preprocess(lexer, code)
+                try:
+                    if self.parallel and len(code) >= self.parallel_bytes:
+                        tokens = lexing.parallel_tokens(lexer, text, self.parallel,
+                                                        max(len(text) // (self.parallel * 4), 1024),
+                                                        deadline)
+                    elif self.dispatch:
+                        if buffer and self.token_buffers and type(lexer) not in self.unbuffered:
+                            try:
+                                return lexing.lex_buffer(lexer, text, deadline)
+                            except ValueError:
+                                # Its callbacks make up tokens of their own.
+                                self.unbuffered.add(type(lexer))
+                        tokens = lexing.lex(lexer, text, deadline=deadline)
+                except lexing.Timeout:
+                    raise RequestTimeout("Request timed out")
+
+        if tokens is None:
+            tokens = lexer.get_tokens(code)
+            if deadline is not None:
+                tokens = _within(tokens, deadline)
+        elif deadline is not None and not isinstance(tokens, list):
+            tokens = _timing_out(tokens, lexing.Timeout)
+        return tokens
+
+    def budget_tokens(self, code, lexer, budget, buffer=False):
+        """
+        Returns the tokens of code, as lex would, if highlighting them keeps
+        within budget, a dict of any of:
+
+        - line_length: if any line is longer, the whole of code is plain text,
+          as TextLexer would give it;
+        - bytes: if code is bigger, the whole lines in the first that many
+          bytes are highlighted, and the rest is plain text;
+        - seconds: if lexing takes longer, the whole lines lexed by then are
+          highlighted, and the rest is plain text.
+
+        Returns the tokens, the fallback taken, the name of the budget that ran
+        out, or None, and how many lines were highlighted before it, or None
+        if they all were. Only code that has been decoded can be budgeted.
+        """
+        for name, value in budget.iteritems():
+            if name not in _BUDGETS or not isinstance(value, (int, long, float)) or value <= 0:
+                raise MentosError("Invalid budget %s: %r" % (name, value))
+
+        if not isinstance(code, unicode):
+            return self.lex(code, lexer, buffer), None, None
+
+        import lexing
+        from pygments.token import Text
+        text = lexing.preprocess(lexer, code)
+
+        line_length = budget.get("line_length")
+        if line_length and max(map(len, text.split(u'\n'))) > line_length:
+            return [(Text, text)], "line_length", 0
+
+        # Where the bytes run out, in characters.
+        stop = None
+        if budget.get("bytes"):
+            encoded = text.encode('utf-8')
+            if len(encoded) > budget["bytes"]:
+                stop = len(encoded[:int(budget["bytes"])].decode('utf-8', 'ignore'))
+
+        seconds = budget.get("seconds")
+        if stop is None and not seconds:
+            return self.lex(code, lexer, buffer), None, None
+
+        tokens = self.lex(code, lexer)
+        if seconds:
+            deadline = time.time() + seconds
+            tokens = _within(tokens, deadline)
+
+        head = []
+        size = 0
+        try:
+            for ttype, value in tokens:
+                head.append((ttype, value))
+                size += len(value)
+                if stop is not None and size >= stop:
+                    fallback = "bytes"
+                    break
+            else:
+                return head, None, None
+        except RequestTimeout:
+            request_deadline = getattr(self.request, 'deadline', None)
+            if not seconds or request_deadline is not None and time.time() > request_deadline:
+                raise
+            fallback = "seconds"
+            stop = size
+
+        head = _whole_lines(head, stop)
+        lines = sum(value.count(u'\n') for _, value in head)
+        rest = text.split(u'\n', lines)[-1]
+        if rest:
+            head.append((Text, rest))
+        return head, fallback, lines
+
+    def tokenize(self, code, lexer, args, kwargs, out_header=None):
+        """
+        Lex code without formatting it, so the tokens can be kept and
+        rendered any number of ways later, with render.
+
+        Returns a dict of the token types seen, as names like
+        "Comment.Single", the tokens as a flat list of type index and length
+        in UTF-8 bytes for each, and the text they add up to: the code as the
+        lexer saw it, after any newline, tab and whitespace handling.
+        """
+        started = time.time()
+        lexer = self.return_lexer(lexer, args, kwargs, code)
+        started = self.timed("lexer", started)
+        if not lexer:
+            raise MentosError("No lexer")
+        if out_header is not None and lexer.aliases:
+            out_header["lexer"] = lexer.aliases[0]
+
+        tokens = self.lex(code, lexer)
+
+        types = {}
+        runs = []
+        values = []
+        for ttype, value in tokens:
+            index = types.get(ttype)
+            if index is None:
+                index = types[ttype] = len(types)
+            runs.append(index)
+            runs.append(len(value))
+            values.append(value)
+
+        text = u''.join(values)
+        encoded = text.encode('utf-8')
+        if len(encoded) != len(text):
+            # Lengths so far are in characters.
+            for i, value in enumerate(values):
+                runs[2 * i + 1] = len(value.encode('utf-8'))
+
+        names = [None] * len(types)
+        for ttype, index in types.iteritems():
+            names[index] = '.'.join(ttype)
+        self.timed("lex", started)
+        return {"types": names, "tokens": runs, "text": text}
+
+    def render(self, text, types, runs, formatter_name, kwargs):
+        """
+        Format tokens returned by tokenize, given the UTF-8 encoded text they
+        add up to, without lexing anything.
+        """
+        from pygments.token import string_to_tokentype
+
+        if len(runs) % 2 or sum(runs[1::2]) != len(text):
+            raise MentosError("Tokens don't match their text")
+        types = [string_to_tokentype(str(name)) for name in types]
+
+        def tokens():
+            offset = 0
+            for i in xrange(0, len(runs), 2):
+                length = runs[i + 1]
+                yield types[runs[i]], text[offset:offset + length].decode('utf-8')
+                offset += length
+
+        stream = tokens()
+        deadline = getattr(self.request, 'deadline', None)
+        if deadline is not None:
+            stream = _within(stream, deadline)
+
+        started = time.time()
+        formatter = self.formatter(str.lower(str(formatter_name or "html")), kwargs)
+        try:
+            return pygments.format(stream, formatter)
+        except (IndexError, UnicodeDecodeError), e:
+            raise MentosError("Tokens don't match their text: %s" % e)
+        finally:
+            self.timed("format", started)
+
+    def highlight_incremental(self, handle, edit, code, lexer, formatter_name, args, kwargs):
+        """
+        Highlight a document as html, remembering it by handle, or, given an
+        edit, replace its lines edit[0] up to edit[1] with code and highlight
+        again only what the edit changed.
+
+        Returns a dict of the line the changed lines start at, how many of
+        the old lines they replace, the changed lines themselves and the
+        number of lines in the document.
+        """
+        from incremental import Document
+
+        if formatter_name and str(formatter_name).lower() != "html":
+            raise MentosError("highlight_incremental only supports the html formatter")
+
+        if handle is None:
+            raise MentosError("highlight_incremental requires a document")
+
+        key = self._document_key(handle)
+
+        if edit is None:
+            # Lines are the editor's, so leading and trailing ones stay.
+            kwargs = dict(kwargs, stripnl=False, stripall=False)
+            lexer = self.return_lexer(lexer, args, kwargs, code)
+            if not lexer:
+                raise MentosError("No lexer")
+
+            document = Document(lexer, self.formatter("html", kwargs), u"")
+            edit = [0, 0]
+        else:
+            document = self.documents.get(key)
+            if document is None:
+                raise MentosError("Unknown document %s" % handle)
+
+        try:
+            start, removed, lines = document.edit(edit[0], edit[1], code)
+        except ValueError, e:
+            raise MentosError(str(e))
 
-    def get_data(self, method, lexer, args, kwargs, text=None):
+        self.documents.set(key, document, len(document.text) + 1)
+        return {"start": start, "removed": removed, "lines": lines, "line_count": len(document)}
+
+    def _document_key(self, handle):
+        """
+        Returns the key of the document a client calls handle. A daemon's
+        clients each name their documents as they like.
+        """
+        connection = getattr(self.request, "connection", None)
+        return (connection and connection.client, handle)
+
+    def highlight_many(self, items, text):
+        """
+        Highlight a batch of snippets, sent back to back in text. Each item is
+        a hash holding the size of its snippet in bytes, along with the lexer,
+        formatter and options a single highlight would take.
+
+        A failing snippet doesn't fail the batch; its error is reported in its
+        place instead. Returns a list of per-item results, each either a size
+        in bytes or an error, and the highlighted snippets concatenated.
+        """
+        results = []
+        chunks = []
+        offset = 0
+
+        for item in items:
+            _bytes = item.get("bytes", 0)
+            code = text[offset:offset + _bytes]
+            offset += _bytes
+
+            try:
+                try:
+                    code = code.decode('utf-8')
+                except UnicodeDecodeError:
+                    # The text may already be encoded
+                    pass
+
+                lexer = item.get("lexer", None)
+                if lexer:
+                    lexer = str(lexer)
+
+                result = {}
+                res = self.highlight_text(code, lexer, item.get("formatter", None), [],
+                                          _convert_keys(item.get("options", {})), result,
+                                          budget=item.get("budget"))
+                if isinstance(res, unicode):
+                    res = res.encode('utf-8')
+
+                result["bytes"] = len(res)
+                results.append(result)
+                chunks.append(res)
+
+            except RequestTimeout:
+                # The deadline is the batch's; it times out as a whole.
+                raise
+
+            except MentosError, e:
+                results.append({"error": str(e)})
+
+            except:
+                results.append({"error": traceback.format_exc()})
+
+        return results, "".join(chunks)
+
+    def get_data(self, method, lexer, args, kwargs, text=None, out_header=None):
         """
         Based on the method argument, determine the action we'd like pygments
         to do. Then return the data generated from pygments.
+
+        Methods that return more than a body, like highlight_many, put their
+        extra metadata in out_header, which only the framed protocol has.
         """
         if kwargs:
             formatter_name = kwargs.get("formatter", None)
@@ -150,16 +855,20 @@ class Mentos(object):
             # itself returns generators, so we make them lists so we can serialize
             # easier.
             if method == 'get_all_styles':
-                res = json.dumps(list(pygments.styles.get_all_styles()))
+                from pygments.styles import get_all_styles
+                res = json.dumps(list(get_all_styles()))
 
             elif method == 'get_all_filters':
-                res = json.dumps(list(pygments.filters.get_all_filters()))
+                from pygments.filters import get_all_filters
+                res = json.dumps(list(get_all_filters()))
 
             elif method == 'get_all_lexers':
-                res = json.dumps(list(pygments.lexers.get_all_lexers()))
+                from pygments.lexers import get_all_lexers
+                res = json.dumps(list(get_all_lexers()))
 
             elif method == 'get_all_formatters':
-                res = [ [ft.__name__, ft.name, ft.aliases] for ft in pygments.formatters.get_all_formatters() ]
+                from pygments.formatters import get_all_formatters
+                res = [ [ft.__name__, ft.name, ft.aliases] for ft in get_all_formatters() ]
                 res = json.dumps(res)
 
             elif method == 'highlight':
@@ -168,12 +877,76 @@ class Mentos(object):
                 except UnicodeDecodeError:
                     # The text may already be encoded
                     text = text
-                res = self.highlight_text(text, lexer, formatter_name, args, _convert_keys(opts))
+
+                # Streamed results go out as chunk frames while the formatter
+                # runs, ahead of an empty response, so neither side has to
+                # hold all of a large result at once.
+                if kwargs.get("stream") and out_header is not None:
+                    outfile = _FrameWriter(self.request.connection, out_header["id"],
+                                           kwargs.get("chunk_bytes", 65536))
+                    self.highlight_text(text, lexer, formatter_name, args, _convert_keys(opts),
+                                        out_header, outfile, kwargs.get("budget"))
+                    outfile.flush()
+                    res = ""
+                else:
+                    res = self.highlight_text(text, lexer, formatter_name, args, _convert_keys(opts),
+                                              out_header, budget=kwargs.get("budget"))
+
+            elif method == 'tokens':
+                try:
+                    text = text.decode('utf-8')
+                except UnicodeDecodeError:
+                    # The text may already be encoded
+                    text = text
+                res = json.dumps(self.tokenize(text, lexer, args, _convert_keys(opts), out_header))
+
+            elif method == 'render':
+                res = self.render(text or "", kwargs.get("types", []), kwargs.get("tokens", []),
+                                  formatter_name, _convert_keys(opts))
+
+            elif method == 'highlight_incremental':
+                try:
+                    text = text.decode('utf-8')
+                except UnicodeDecodeError:
+                    # The text may already be encoded
+                    text = text
+                res = json.dumps(self.highlight_incremental(kwargs.get("document"), kwargs.get("edit"), text,
+                                                            lexer, formatter_name, args, _convert_keys(opts)))
+
+            elif method == 'close_document':
+                self.documents.delete(self._document_key(kwargs.get("document")))
+                res = json.dumps(True)
+
+            elif method == 'highlight_many':
+                if out_header is None:
+                    raise MentosError("highlight_many requires protocol version 2")
+                out_header["items"], res = self.highlight_many(kwargs.get("items", []), text)
+
+            elif method == 'prewarm':
+                res = json.dumps(self.prewarm(args[0]))
+
+            elif method == 'stats':
+                res = self.metrics.stats()
+                res["pid"] = os.getpid()
+                if self.results is not None:
+                    res["cache"] = self.results.stats()
+                res = json.dumps(res)
+
+            elif method == 'cache_stats':
+                if self.results is not None:
+                    res = json.dumps(self.results.stats())
+                else:
+                    res = json.dumps({"max_bytes": 0})
 
             elif method == 'css':
                 kwargs = _convert_keys(kwargs)
-                fmt = pygments.formatters.get_formatter_by_name(args[0], **kwargs)
-                res = fmt.get_style_defs(args[1])
+                fmt = self.formatter(args[0], kwargs)
+
+                key = (type(fmt), freeze(kwargs), args[1])
+                res = self.stylesheets.get(key)
+                if res is None:
+                    res = fmt.get_style_defs(args[1])
+                    self.stylesheets.set(key, res, 1)
 
             elif method == 'lexer_name_for':
                 lexer = self.return_lexer(None, args, kwargs, text)
@@ -184,10 +957,10 @@ class Mentos(object):
                     res = lexer.aliases[0]
 
                 else:
-                    _write_error("No lexer")
+                    raise MentosError("No lexer")
 
             else:
-                _write_error("Invalid method " + method)
+                raise MentosError("Invalid method " + method)
 
             return res
 
@@ -255,6 +1028,319 @@ class Mentos(object):
         expects and requires a JSON header of metadata. If there is data to be
         pygmentized, this header will be followed by the text to be pygmentized.
 
+        The first bytes on stdin decide which protocol we speak. A client may
+        ask for the framed protocol by sending PROTOCOL_MAGIC and a version
+        byte; anything else is the start of a version 1 request.
+        """
+        magic = sys.stdin.read(len(PROTOCOL_MAGIC) + 1)
+
+        if magic[:len(PROTOCOL_MAGIC)] == PROTOCOL_MAGIC and len(magic) > len(PROTOCOL_MAGIC):
+            version = min(ord(magic[-1]), PROTOCOL_VERSION)
+            sys.stdout.write(PROTOCOL_MAGIC + chr(version))
+            sys.stdout.flush()
+
+            if version >= 2:
+                return self.serve_framed()
+            magic = ""
+
+        self.serve_legacy(magic)
+
+    def serve_framed(self, connection=None):
+        """
+        Serve version 2 requests from connection, or stdin and stdout, until
+        the client goes away.
+
+        Each request is a frame whose header is of form:
+        { "id": 1, "method": "highlight", "args": [], "kwargs": {"arg1": "v"} }
+        and whose body is the text to be pygmentized, if any. The response
+        echoes the request id in its header, along with either the method or
+        an error, and carries the result as its body.
+        """
+        if connection is None:
+            connection = _Connection(sys.stdin, sys.stdout)
+        requests = self._request_queue()
+
+        while True:
+            frame = connection.read_frame()
+            if frame is None:
+                break
+
+            if requests:
+                requests.put((frame, connection))
+            else:
+                self._serve_frame(frame, connection)
+
+    def _request_queue(self):
+        """
+        Returns the queue the threads serving requests take them from,
+        starting them the first time, or None if we serve them one at a time.
+        """
+        if self.threads <= 1:
+            return None
+
+        self.queue_lock.acquire()
+        try:
+            if self.queue is None:
+                self.queue = Queue.Queue(self.threads * 2)
+                for i in range(self.threads):
+                    worker = Thread(target=self._serve_queue, args=(self.queue,))
+                    worker.setDaemon(True)
+                    worker.start()
+            return self.queue
+        finally:
+            self.queue_lock.release()
+
+    def _serve_queue(self, requests):
+        while True:
+            frame, connection = requests.get()
+            try:
+                self._serve_frame(frame, connection)
+            except IOError:
+                # The client went away; whoever reads its requests finds out.
+                pass
+
+    def _serve_frame(self, frame, connection):
+        header, text, read_seconds = frame
+        out_header = {"id": header.get("id")}
+        res = ""
+        started = time.time()
+        timings = self.request.timings = {"read": read_seconds}
+        self.request.connection = connection
+        want_timings = False
+
+        # A client's timeout, in seconds, counts from when we read its request.
+        timeout = header.get("timeout")
+        self.request.deadline = timeout and started + timeout or None
+
+        try:
+            method, args, kwargs, lexer = self._parse_header(header)
+
+            if lexer:
+                lexer = str(lexer)
+            want_timings = isinstance(kwargs, dict) and kwargs.get("timings")
+
+            res = self.get_data(method, lexer, args, kwargs, text, out_header)
+            out_header["method"] = method
+
+        except RequestTimeout, e:
+            out_header = {"id": header.get("id"), "error": str(e), "timeout": True}
+            res = ""
+
+        except MentosError, e:
+            out_header = {"id": header.get("id"), "error": str(e)}
+            res = ""
+
+        except:
+            out_header = {"id": header.get("id"), "error": traceback.format_exc()}
+            res = ""
+
+        finally:
+            self.request.deadline = None
+            self.request.timings = None
+            self.request.connection = None
+
+        if isinstance(res, unicode):
+            res = res.encode('utf-8')
+        lexer = out_header.get("lexer")
+        if want_timings:
+            out_header["timings"] = dict(timings, total=time.time() - started + read_seconds)
+
+        writing = time.time()
+        connection.write_frame(out_header, res or "")
+        timings["write"] = time.time() - writing
+
+        self.metrics.record(str(header.get("method")), lexer, time.time() - started + read_seconds,
+                            timings, len(text), len(res or ""), "error" in out_header,
+                            "timeout" in out_header)
+
+    def serve_zygote(self):
+        """
+        Run as a zygote: a process that imports Pygments and prewarms lexers
+        once, then forks ready workers on request. Forked workers share the
+        imported modules and compiled token tables copy-on-write, so a new
+        worker is ready in milliseconds and costs little memory.
+
+        The zygote speaks a line protocol of JSON objects on stdin and stdout.
+        The first line holds the lexers to prewarm, {"prewarm": ["ruby"]},
+        and is answered with the prewarm report once it's done. Every line
+        after that, {"spawn": "/path/to/socket"}, forks a worker that connects
+        to the Unix socket at that path and serves requests over it; the
+        answer holds the worker's pid.
+        """
+        # Workers are our children, not the client's, but we never wait for
+        # them: the client kills them by pid and can't reap them. Ignoring
+        # SIGCHLD has the kernel reap them, so none are left as zombies.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        # Unlike a lone mentos, import everything up front: it's paid once
+        # here, and every worker forked afterwards shares it.
+        from pygments import lexers, formatters, styles, filters
+        self.filenames.build()
+        self.detector.build()
+
+        line = sys.stdin.readline()
+        if not line:
+            return
+        report = self.prewarm(json.loads(line).get("prewarm", []))
+        sys.stdout.write(json.dumps(report) + "\n")
+        sys.stdout.flush()
+
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                break
+
+            path = str(json.loads(line)["spawn"])
+            pid = os.fork()
+
+            if pid == 0:
+                try:
+                    try:
+                        self._become_worker(path)
+                    except:
+                        traceback.print_exc()
+                finally:
+                    os._exit(0)
+
+            sys.stdout.write(json.dumps({"pid": pid}) + "\n")
+            sys.stdout.flush()
+
+    def _become_worker(self, path):
+        """
+        In a freshly forked worker, connect to the client at path and serve
+        requests over that socket, as if it were our stdin and stdout.
+        """
+        import socket
+
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        os.dup2(sock.fileno(), 0)
+        os.dup2(sock.fileno(), 1)
+        sock.close()
+
+        # Fresh file objects, so nothing the zygote had buffered is read.
+        sys.stdin = os.fdopen(0, 'rb')
+        sys.stdout = os.fdopen(1, 'wb')
+
+        self.start()
+
+    def serve_daemon(self, path, processes=1, prewarm=()):
+        """
+        Run as a daemon: a process serving any number of clients that connect
+        to the Unix socket at path, so the processes of a host can share
+        their lexers, caches and documents instead of each keeping its own
+        mentos. Lexers in prewarm are compiled before taking connections.
+
+        Clients speak the framed protocol, opening with its handshake as they
+        would over a pipe, and each is served by a thread of its own (or, with
+        more than one thread, by a shared queue of them). With processes over
+        1, that many processes are forked to take connections from the socket,
+        which is as many clients as can be lexing at once; they share what was
+        imported and prewarmed copy-on-write, and are replaced should they
+        die. The socket is removed once we're done with it.
+        """
+        # Imported up front, as in a zygote, so no client waits for it.
+        from pygments import lexers, formatters, styles, filters
+        self.filenames.build()
+        self.detector.build()
+        self.prewarm(prewarm)
+
+        server = _listen(path)
+        try:
+            if processes <= 1:
+                self._accept(server)
+                return
+
+            children = set()
+            try:
+                while True:
+                    while len(children) < processes:
+                        pid = os.fork()
+                        if pid == 0:
+                            try:
+                                try:
+                                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                                    self._accept(server)
+                                except Exception:
+                                    traceback.print_exc()
+                            finally:
+                                os._exit(0)
+                        children.add(pid)
+
+                    try:
+                        children.discard(os.wait()[0])
+                    except OSError:
+                        pass
+            finally:
+                for pid in children:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+        finally:
+            server.close()
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _accept(self, server):
+        """
+        Take connections from the listening socket server, serving each in a
+        thread of its own, for good.
+        """
+        import socket
+        from itertools import count
+
+        # Clients are numbered, to tell their documents apart.
+        clients = count(1)
+
+        while True:
+            try:
+                sock, _ = server.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            client = Thread(target=self._serve_client, args=(sock, clients.next()))
+            client.setDaemon(True)
+            client.start()
+
+    def _serve_client(self, sock, client):
+        """
+        Negotiate the protocol with a client of the daemon, then serve its
+        requests until it goes away. Only the framed protocol is spoken here;
+        a client asking for less is answered and hung up on.
+        """
+        infile = sock.makefile('rb')
+        outfile = sock.makefile('wb')
+        try:
+            try:
+                magic = infile.read(len(PROTOCOL_MAGIC) + 1)
+                if magic[:len(PROTOCOL_MAGIC)] != PROTOCOL_MAGIC or len(magic) <= len(PROTOCOL_MAGIC):
+                    return
+
+                version = min(ord(magic[-1]), PROTOCOL_VERSION)
+                outfile.write(PROTOCOL_MAGIC + chr(version))
+                outfile.flush()
+
+                if version >= 2:
+                    self.serve_framed(_Connection(infile, outfile, client))
+            except IOError:
+                pass
+        finally:
+            for f in (infile, outfile, sock):
+                try:
+                    f.close()
+                except IOError:
+                    pass
+
+    def serve_legacy(self, prefix=""):
+        """
+        Serve version 1 requests until stdin is closed. The prefix holds any
+        bytes already consumed while negotiating the protocol.
+
         The header is of form:
         { "method": "highlight", "args": [], "kwargs": {"arg1": "v"}, "bytes": 128, "fd": "8"}
         """
@@ -264,10 +1350,16 @@ class Mentos(object):
             # The loop begins by reading off a simple 32-arity string
             # representing an integer of 32 bits. This is the length of
             # our JSON header.
-            size = sys.stdin.read(32)
+            size = prefix + sys.stdin.read(32 - len(prefix))
+            prefix = ""
 
             lock.acquire()
 
+            started = time.time()
+            timings = self.request.timings = {}
+            method = text = res = None
+            failed = True
+
             try:
                 # Read from stdin the amount of bytes we were told to expect.
                 header_bytes = int(size, 2)
@@ -307,14 +1399,81 @@ class Mentos(object):
                     res = start_id + "  " + res + "  " + end_id
 
                 self._send_data(res, method)
+                failed = False
+
+            except MentosError, e:
+                _write_error(str(e))
 
             except:
                 tb = traceback.format_exc()
                 _write_error(tb)
 
             finally:
+                self.request.timings = None
                 lock.release()
 
+            if method is not None:
+                self.metrics.record(str(method), None, time.time() - started, timings,
+                                    len(text or ""), len(res or ""), failed)
+
+def _listen(path):
+    """
+    Returns a socket listening at path. A socket file left there by a daemon
+    that's gone is replaced; one that's still answering is left alone.
+    """
+    import socket
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+    except socket.error, e:
+        if e.args[0] != errno.EADDRINUSE:
+            raise
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+                server.bind(path)
+            else:
+                raise MentosError("A mentos daemon is already listening on %s" % path)
+        finally:
+            probe.close()
+
+    server.listen(128)
+    return server
+
+def _close_inherited_fds():
+    """
+    Close the fd's inherited from the ruby parent, keeping stdin, stdout
+    and stderr.
+
+    Where the kernel lists our open fd's in /proc/self/fd, only those are
+    closed. Elsewhere, fall back to closing the whole range up to the fd
+    limit, in a single os.closerange call rather than an os.close per fd.
+    (/dev/fd isn't used: without fdescfs the BSDs list only 0, 1 and 2.)
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except (OSError, ValueError):
+        import resource
+        maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if maxfd == resource.RLIM_INFINITY:
+            maxfd = 65536
+        os.closerange(3, maxfd)
+        return
+
+    # One of the fd's listed is the directory listdir read, which is closed
+    # by now; closing it again just fails.
+    for fd in fds:
+        if fd > 2:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
 def main():
 
     # Signal handlers to trap signals.
@@ -323,26 +1482,40 @@ def main():
     if sys.platform != "win32":
         signal.signal(signal.SIGHUP, _signal_handler)
 
-    mentos = Mentos()
+    mentos = Mentos(int(os.environ.get('MENTOS_THREADS', 1)),
+                    int(os.environ.get('MENTOS_CACHE_BYTES', 0)),
+                    int(os.environ.get('MENTOS_DOCUMENT_BYTES', 64 * 1024 * 1024)),
+                    int(os.environ.get('MENTOS_PARALLEL', 0)),
+                    int(os.environ.get('MENTOS_PARALLEL_BYTES', 1024 * 1024)),
+                    os.environ.get('MENTOS_DISPATCH', '1') != '0',
+                    os.environ.get('MENTOS_TOKEN_BUFFERS', '1') != '0')
 
     if sys.platform == "win32":
         # disable CRLF
         import msvcrt
         msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
     else:
-        # close fd's inherited from the ruby parent
-        import resource
-        maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
-        if maxfd == resource.RLIM_INFINITY:
-            maxfd = 65536
-
-        for fd in range(3, maxfd):
-            try:
-                os.close(fd)
-            except:
-                pass
-
-    mentos.start()
+        _close_inherited_fds()
+
+    args = sys.argv[1:]
+    if "--daemon" in args:
+        # The socket's path follows the flag, or is in MENTOS_SOCKET.
+        path = args[args.index("--daemon") + 1:] or [os.environ.get('MENTOS_SOCKET')]
+        if not path[0]:
+            sys.exit("mentos: --daemon needs the path of a socket to listen on")
+        prewarm = [alias for alias in os.environ.get('MENTOS_PREWARM', '').split(',') if alias]
+        try:
+            mentos.serve_daemon(path[0], int(os.environ.get('MENTOS_DAEMON_PROCESSES', 1)), prewarm)
+        except MentosError, e:
+            sys.exit("mentos: %s" % e)
+        except SystemExit:
+            # Threads serving clients are still reading from them; leave
+            # without tearing the interpreter down under them.
+            os._exit(0)
+    elif "--zygote" in args:
+        mentos.serve_zygote()
+    else:
+        mentos.start()
 
 if __name__ == "__main__":
     main()
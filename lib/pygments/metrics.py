@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms mentos keeps about the requests it serves.
+"""
+
+import os
+import sys
+from threading import Lock
+
+# Upper bounds of the histogram buckets, in seconds. Anything slower goes in
+# a last bucket of its own.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# What a highlight's time is split into: resolving the lexer, lexing,
+# formatting, and reading the request and writing the response.
+PHASES = ("lexer", "lex", "format", "read", "write")
+
+class Histogram(object):
+    """
+    How many of the times it's been given fell in each of BUCKETS, with
+    their count, sum and maximum.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        i = 0
+        for bound in BUCKETS:
+            if seconds <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket the given fraction of times fall
+        in or under, or the maximum if that's the last bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        """
+        Returns a dict of the histogram: count, sum, max, the 50th, 90th and
+        99th percentiles, and buckets, pairs of each bucket's upper bound (None
+        for the last) and count.
+        """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "buckets": zip(BUCKETS + (None,), self.counts),
+        }
+
+class _Counts(object):
+    """
+    The counters kept for a method or a lexer.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = Histogram()
+        self.phases = {}
+
+    def add(self, seconds, timings, bytes_in, bytes_out, error, timeout):
+        self.requests += 1
+        self.errors += error and not timeout and 1 or 0
+        self.timeouts += timeout and 1 or 0
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds.add(seconds)
+        for phase, took in timings.iteritems():
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram()
+            histogram.add(took)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "seconds": self.seconds.stats(),
+            "phases": dict((phase, histogram.stats()) for phase, histogram in self.phases.iteritems()),
+        }
+
+class Metrics(object):
+    """
+    Counters and histograms of the requests served, per method and per lexer.
+    Each request's time is counted as a whole, and split into the PHASES it
+    went through. Safe to use from several threads at once.
+    """
+    def __init__(self):
+        self.methods = {}
+        self.lexers = {}
+        self._lock = Lock()
+
+    def record(self, method, lexer, seconds, timings, bytes_in, bytes_out, error=False, timeout=False):
+        """
+        Counts a request for method, which took seconds in all, and the
+        seconds in each phase in timings, a dict. Its lexer, if it had one, is
+        an alias.
+        """
+        self._lock.acquire()
+        try:
+            for counts, key in ((self.methods, method), (self.lexers, lexer)):
+                if key is None:
+                    continue
+                entry = counts.get(key)
+                if entry is None:
+                    entry = counts[key] = _Counts()
+                entry.add(seconds, timings, bytes_in, bytes_out, error, timeout)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns a dict of the counters of each method and of each lexer, and
+        the process' memory use.
+        """
+        # The kernel updates the peak lazily, so it can trail what's resident.
+        rss = rss_bytes()
+        self._lock.acquire()
+        try:
+            return {
+                "methods": dict((name, counts.stats()) for name, counts in self.methods.iteritems()),
+                "lexers": dict((name, counts.stats()) for name, counts in self.lexers.iteritems()),
+                "rss_bytes": rss,
+                "max_rss_bytes": max(max_rss_bytes(), rss),
+            }
+        finally:
+            self._lock.release()
+
+def rss_bytes():
+    """
+    Returns how much of the process is resident in memory, in bytes, where
+    the kernel tells us in /proc, or else None.
+    """
+    try:
+        statm = open('/proc/self/statm')
+        try:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            statm.close()
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def max_rss_bytes():
+    """
+    Returns the most of the process that has been resident in memory at
+    once, in bytes.
+    """
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes, OS X in bytes.
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return maxrss
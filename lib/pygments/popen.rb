@@ -4,11 +4,20 @@ require 'yajl'
 require 'timeout'
 require 'logger'
 require 'time'
+require 'thread'
+require 'monitor'
+require 'socket'
+require 'tmpdir'
 
 # Error class
 class MentosError < IOError
 end
 
+# Raised by mentos when a request runs past its deadline. Only that request
+# is dropped; the child stays up.
+class MentosTimeout < MentosError
+end
+
 # Pygments provides access to the Pygments library via a pipe and a long-running
 # Python process.
 module Pygments
@@ -16,10 +25,244 @@ module Pygments
     include POSIX::Spawn
     extend self
 
-    # Get things started by opening a pipe to mentos (the freshmaker), a
-    # Python process that talks to the Pygments library. We'll talk back and
-    # forth across this pipe.
-    def start(pygments_path = File.expand_path('../../../vendor/pygments-main/', __FILE__))
+    # Protocol negotiation with mentos. We open the conversation with the
+    # magic string and the highest protocol version we'd like to speak;
+    # mentos answers with the version it picked. Version 1 is the original
+    # bit-string framing and needs no handshake at all.
+    PROTOCOL_MAGIC = "MNT"
+    PROTOCOL_VERSION = 2
+
+    # Seconds past a request's own deadline we wait for mentos to give up on
+    # it, before killing the child. Time spent in a single regex match can't
+    # be cut short from inside.
+    TIMEOUT_GRACE = 2
+
+    # Seconds between attempts to reach the mentos daemon again, for workers
+    # that fell back to a child of their own.
+    DAEMON_RETRY = 30
+
+    # Starting and stopping children, and picking a child for a request, are
+    # serialized through this lock. Requests themselves don't hold it, so
+    # concurrent threads can have several requests in flight at once.
+    LOCK = Monitor.new
+
+    # A mentos child in the pool: its pid and pipes, the protocol it speaks,
+    # and some bookkeeping on its load and health. A worker connected to the
+    # mentos daemon has no pid; its socket is the path it's connected to, and
+    # fell_back_at is when it last failed to connect and started a child.
+    class Worker < Struct.new(:pid, :in, :out, :err, :protocol, :multiplexer, :lock,
+                              :in_flight, :requests, :errors, :timeouts, :restarts,
+                              :prewarmed, :prewarm_seconds, :socket, :fell_back_at)
+      def initialize
+        super(nil, nil, nil, nil, nil, nil, Mutex.new, 0, 0, 0, 0, 0, [], nil, nil, nil)
+      end
+
+      # Check for a pid, and then hit `kill -0` with the pid to
+      # check if the pid is still in the process table. If this function
+      # gives us an ENOENT or ESRCH, we can also safely return false (no process
+      # to worry about). Defensively, if EPERM is raised, in a odd/rare
+      # dying process situation (e.g., mentos is checking on the pid of a dead
+      # process and the pid has already been re-used) we'll want to raise
+      # that as a more informative Mentos exception.
+      #
+      # A connection to the daemon is alive until it's closed, from either end.
+      #
+      # Returns true if the child is alive.
+      def alive?
+        return !!multiplexer && !multiplexer.closed? if socket
+        return true if pid && Process.kill(0, pid)
+        false
+      rescue Errno::ENOENT, Errno::ESRCH
+        false
+      rescue Errno::EPERM
+        raise MentosError, "EPERM checking if child process is alive."
+      end
+    end
+
+    # Multiplexes framed requests over the pipe to a single mentos child. Any
+    # number of threads may send requests; each is tagged with an id, and a
+    # background thread reads the responses and hands each one to the thread
+    # waiting on its id. Responses may arrive in any order.
+    class Multiplexer
+      def initialize(input, output)
+        @in = input
+        @out = output
+        @write_lock = Mutex.new
+        @lock = Mutex.new
+        @arrived = ConditionVariable.new
+        @responses = {}
+        @streams = {}
+        @error = nil
+        @last_id = 0
+        @thread = Thread.new { run }
+      end
+
+      # Returns true once the pipe has been closed, after which no request
+      # can get an answer.
+      def closed?
+        @lock.synchronize { !@error.nil? }
+      end
+
+      # Send a request, then block until its response has been read, or until
+      # the pipe is closed, in which case the read error is raised.
+      #
+      # Returns the response header as a Hash and the response body.
+      def call(method, args, kwargs, body=nil, timeout=nil)
+        id = @lock.synchronize { @last_id += 1 }
+        out_header = request_header(id, method, args, kwargs, timeout)
+        @write_lock.synchronize { write_frame(out_header, body) }
+
+        @lock.synchronize do
+          until @responses.has_key?(id)
+            raise @error if @error
+            @arrived.wait(@lock)
+          end
+          @responses.delete(id)
+        end
+      end
+
+      # Send a request whose response comes back as a series of chunk frames
+      # followed by a final response, yielding the body of each chunk as it
+      # arrives. If the block raises, the rest of the response is read and
+      # dropped, so it doesn't pile up. Given patience, in seconds,
+      # Timeout::Error is raised once that long has been spent waiting for
+      # frames, not counting the time spent in the block.
+      #
+      # Returns the final response header as a Hash and the response body.
+      def stream(method, args, kwargs, body=nil, timeout=nil, patience=nil)
+        id = @lock.synchronize { @last_id += 1 }
+        frames = @lock.synchronize { @streams[id] = [] }
+        out_header = request_header(id, method, args, kwargs, timeout)
+        @write_lock.synchronize { write_frame(out_header, body) }
+
+        loop do
+          header, chunk = @lock.synchronize do
+            while frames.empty?
+              raise @error if @error
+              if patience
+                raise Timeout::Error, "no response from mentos" if patience <= 0
+                waited_from = Time.now
+                @arrived.wait(@lock, patience)
+                patience -= Time.now - waited_from
+              else
+                @arrived.wait(@lock)
+              end
+            end
+            frames.shift
+          end
+
+          unless header["chunk"]
+            frames = nil
+            return [header, chunk]
+          end
+          yield chunk
+        end
+      ensure
+        @lock.synchronize do
+          if frames
+            @streams[id] = :discard
+          else
+            @streams.delete(id)
+          end
+        end
+      end
+
+      private
+
+      def run
+        loop do
+          header, body = read_frame
+          header = Yajl.load(header)
+          id = header["id"]
+
+          @lock.synchronize do
+            if @streams[id] == :discard
+              @streams.delete(id) unless header["chunk"]
+            elsif @streams[id]
+              @streams[id] << [header, body]
+            else
+              @responses[id] = [header, body]
+            end
+            @arrived.broadcast
+          end
+        end
+      rescue EOFError, IOError, SystemCallError => e
+        @lock.synchronize do
+          @error = e.is_a?(EOFError) ? e : EOFError.new(e.message)
+          @arrived.broadcast
+        end
+      end
+
+      # The header of a request. Given a timeout, in seconds, mentos gives up
+      # on the request once it has run that long.
+      def request_header(id, method, args, kwargs, timeout)
+        header = { :id => id, :method => method, :args => args, :kwargs => kwargs }
+        header[:timeout] = timeout if timeout
+        Yajl.dump(header)
+      end
+
+      # Write a version 2 frame: the byte sizes of the header and the body as
+      # two 32 bit big-endian integers, then the header and the body. The body
+      # may also be given as an array of strings, which are sent back to back.
+      #
+      # Returns nothing.
+      def write_frame(out_header, body=nil)
+        parts = Array(body)
+        body_bytes = parts.inject(0) { |sum, part| sum + part.bytesize }
+
+        @in.write([out_header.bytesize, body_bytes].pack("NN"))
+        @in.write(out_header)
+        parts.each { |part| @in.write(part) }
+        @in.flush
+      end
+
+      # Read a version 2 frame, laid out the same way.
+      #
+      # Returns the header and the body as an array of two strings.
+      def read_frame
+        prefix = @out.read(8)
+        raise EOFError if prefix.nil? || prefix.bytesize < 8
+
+        header_bytes, body_bytes = prefix.unpack("NN")
+        header = @out.read(header_bytes)
+        body = @out.read(body_bytes)
+        raise EOFError if header.nil? || body.nil?
+
+        [header, body]
+      end
+    end
+
+    # Get things started by opening pipes to a pool of mentos (the freshmaker)
+    # processes, Python processes that talk to the Pygments library. We'll talk
+    # back and forth across these pipes.
+    #
+    # Options:
+    #
+    #   :pool_size   - The number of mentos processes to keep (defaults to the
+    #                  MENTOS_POOL_SIZE environment variable, or 1).
+    #   :prewarm     - An array of lexer aliases whose regexes each process
+    #                  compiles before taking requests (defaults to the comma
+    #                  separated MENTOS_PREWARM environment variable).
+    #   :prewarm_top - Also prewarm this many of the lexers we've used most so
+    #                  far, so respawned processes come back warm (defaults to
+    #                  the MENTOS_PREWARM_TOP environment variable, or 0).
+    #   :zygote      - Fork workers from a single prewarmed mentos process, the
+    #                  zygote, instead of starting each one from scratch. New
+    #                  workers are then ready in milliseconds, and share most
+    #                  of their memory (defaults to the MENTOS_ZYGOTE
+    #                  environment variable; not available on Windows).
+    #   :socket      - The path of a Unix socket a mentos daemon listens on,
+    #                  shared by the processes of a host. Workers connect to
+    #                  it instead of starting children; if it can't be
+    #                  reached, they start one of their own and try the daemon
+    #                  again later (defaults to the MENTOS_SOCKET environment
+    #                  variable; not available on Windows).
+    def start(pygments_path = File.expand_path('../../../vendor/pygments-main/', __FILE__), opts = {})
+      if pygments_path.is_a?(Hash)
+        opts = pygments_path
+        pygments_path = File.expand_path('../../../vendor/pygments-main/', __FILE__)
+      end
+
       is_windows = RUBY_PLATFORM =~ /mswin|mingw/
       begin
         @log = Logger.new(ENV['MENTOS_LOG'] ||= is_windows ? 'NUL:' : '/dev/null')
@@ -31,14 +274,21 @@ module Pygments
 
       ENV['PYGMENTS_PATH'] = pygments_path
 
-      # Make sure we kill off the child when we're done
+      # Make sure we kill off the children when we're done
       at_exit { stop "Exiting" }
 
-      # A pipe to the mentos python process. #popen4 gives us
-      # the pid and three IO objects to write and read.
-      script = "#{python_binary} #{File.expand_path('../mentos.py', __FILE__)}"
-      @pid, @in, @out, @err = popen4(script)
-      @log.info "[#{Time.now.iso8601}] Starting pid #{@pid.to_s} with fd #{@out.to_i.to_s}."
+      LOCK.synchronize do
+        stop "Restarting" if @workers
+
+        @prewarm = opts[:prewarm] || (ENV['MENTOS_PREWARM'] || '').split(',')
+        @prewarm_top = (opts[:prewarm_top] || ENV['MENTOS_PREWARM_TOP'] || 0).to_i
+        @lexer_usage ||= Hash.new(0)
+        @zygote_enabled = !is_windows && !!(opts.has_key?(:zygote) ? opts[:zygote] : ENV['MENTOS_ZYGOTE'])
+        @socket_path = is_windows ? nil : (opts.has_key?(:socket) ? opts[:socket] : ENV['MENTOS_SOCKET'])
+
+        pool_size = (opts[:pool_size] || ENV['MENTOS_POOL_SIZE'] || 1).to_i
+        @workers = Array.new([pool_size, 1].max) { spawn_worker(Worker.new) }
+      end
     end
 
     # Detect a suitable Python binary to use. We can't just use `python2`
@@ -51,46 +301,44 @@ module Pygments
       end
     end
 
-    # Stop the child process by issuing a kill -9.
-    #
-    # We then call waitpid() with the pid, which waits for that particular
-    # child and reaps it.
-    #
-    # kill() can set errno to ESRCH if, for some reason, the file
-    # is gone; regardless the final outcome of this method
-    # will be to set our @pid variable to nil.
-    #
-    # Technically, kill() can also fail with EPERM or EINVAL (wherein
-    # the signal isn't sent); but we have permissions, and
-    # we're not doing anything invalid here.
+    # Stop every child in the pool, and the zygote if there is one. They'll be
+    # respawned as requests need them.
     def stop(reason)
-      if @pid
-        begin
-          Process.kill('KILL', @pid)
-          Process.waitpid(@pid)
-        rescue Errno::ESRCH, Errno::ECHILD
-        end
+      LOCK.synchronize do
+        (@workers || []).each { |worker| stop_worker(worker, worker.pid, reason) }
+        stop_worker(@zygote, @zygote.pid, reason) if @zygote && @zygote.pid
       end
-      @log.info "[#{Time.now.iso8601}] Killing pid: #{@pid.to_s}. Reason: #{reason}"
-      @pid = nil
     end
 
-    # Check for a @pid variable, and then hit `kill -0` with the pid to
-    # check if the pid is still in the process table. If this function
-    # gives us an ENOENT or ESRCH, we can also safely return false (no process
-    # to worry about). Defensively, if EPERM is raised, in a odd/rare
-    # dying process situation (e.g., mentos is checking on the pid of a dead
-    # process and the pid has already been re-used) we'll want to raise
-    # that as a more informative Mentos exception.
-    #
-    # Returns true if the child is alive.
+    # Returns true if the pool has been started and all of its children are
+    # alive.
     def alive?
-      return true if @pid && Process.kill(0, @pid)
-      false
-    rescue Errno::ENOENT, Errno::ESRCH
-      false
-    rescue Errno::EPERM
-      raise MentosError, "EPERM checking if child process is alive."
+      LOCK.synchronize do
+        !@workers.nil? && @workers.all? { |worker| worker.alive? }
+      end
+    end
+
+    # Public: Report on the health of each mentos process in the pool.
+    #
+    # Returns an array with a hash of counters for each process.
+    def workers
+      LOCK.synchronize do
+        (@workers || []).map do |worker|
+          {
+            :pid => worker.pid,
+            :socket => worker.socket,
+            :alive => worker.alive?,
+            :protocol => worker.protocol,
+            :in_flight => worker.in_flight,
+            :requests => worker.requests,
+            :errors => worker.errors,
+            :timeouts => worker.timeouts,
+            :restarts => worker.restarts,
+            :prewarmed => worker.prewarmed,
+            :prewarm_seconds => worker.prewarm_seconds
+          }
+        end
+      end
     end
 
     # Public: Get an array of available Pygments formatters
@@ -156,6 +404,38 @@ module Pygments
       mentos(:get_all_styles)
     end
 
+    # Public: Return the counters of mentos' result cache, which is enabled by
+    # setting MENTOS_CACHE_BYTES to its size in bytes. With a pool, these are
+    # the counters of whichever process answers.
+    #
+    # Returns a hash of hits, misses, evictions, entries, bytes and max_bytes.
+    def cache_stats
+      mentos(:cache_stats)
+    end
+
+    # Public: Return the metrics of each mentos process in the pool: counters
+    # and latency histograms of the requests it has served. Processes are
+    # asked one at a time, so their numbers can be a request or so apart.
+    #
+    # Returns a hash by pid of a hash for each process, with its :pid, and
+    # :methods and :lexers, each a hash by name of :requests, :errors,
+    # :timeouts, :bytes_in, :bytes_out, and histograms of the :seconds
+    # requests took in all and in each of their :phases (:lexer resolution,
+    # :lex, :format, :read and :write). Histograms hold a :count, :sum, :max,
+    # :p50, :p90, :p99, and :buckets, pairs of each bucket's upper bound in
+    # seconds and count. Also :rss_bytes and :max_rss_bytes, the process'
+    # memory use now and at its most, and the result cache's :cache_stats as
+    # :cache, if it's on. Over the legacy protocol, requests aren't told
+    # apart by lexer, so :lexers is empty.
+    def stats
+      size = LOCK.synchronize { start unless @workers; @workers.size }
+      (0...size).inject({}) do |all, index|
+        res = mentos(:stats, [], {}, nil, index)
+        all[res[:pid]] = res if res
+        all
+      end
+    end
+
     # Public: Return css for highlighted code
     def css(klass='', opts={})
       if klass.is_a?(Hash)
@@ -187,7 +467,30 @@ module Pygments
     #
     # Takes a first-position argument of the code to be highlighted, and a
     # second-position hash of various arguments specifiying highlighting properties.
-    def highlight(code, opts={})
+    #
+    # Given a block, or an IO as the :out option, the result is streamed
+    # instead of returned: chunks of it are yielded to the block, or written
+    # to the IO, as the formatter produces them, so a large result never has
+    # to be held in memory all at once. The chunks add up to what would have
+    # been returned. Streaming returns the IO, if one was given. The
+    # :chunk_size option sets roughly how many bytes mentos sends at a time
+    # (64KB by default). Only the time spent waiting on mentos counts toward
+    # MENTOS_TIMEOUT, not the time the block or IO takes over the chunks. A
+    # stream that times out raises a MentosError rather than returning nil,
+    # since part of it may have been handed over already.
+    #
+    # The :budget option bounds how much work a highlight may take, for
+    # inputs that are huge or pathological: a hash of any of :bytes, the most
+    # bytes of code highlighted; :line_length, the longest line; and :seconds,
+    # the most time spent lexing. The whole lines within the bytes or the
+    # seconds are highlighted, and the rest left as plain text; a line over
+    # the line length leaves all of it as plain text. The String returned is
+    # then a Budgeted: its #fallback says which budget ran out, if any, and
+    # #highlighted_lines how many lines were highlighted before it did.
+    #
+    # Given :timings => true, the String returned is a Timed, whose #timings
+    # say where mentos spent its time on it.
+    def highlight(code, opts={}, &block)
       # If the caller didn't give us any code, we have nothing to do,
       # so return right away.
       return code if code.nil? || code.empty?
@@ -198,67 +501,591 @@ module Pygments
       # Default to utf-8 for the output encoding, if not given.
       opts[:options][:outencoding] ||= 'utf-8'
 
+      return stream_highlight(code, opts, &block) if block || opts[:out]
+
       # Get back the string from mentos and force encoding if we can
       str = mentos(:highlight, nil, opts, code)
       str.force_encoding(opts[:options][:outencoding]) if str.respond_to?(:force_encoding)
       str
     end
 
+    # Public: Highlight many snippets of code in a single round trip.
+    #
+    # Takes an array of [code, opts] pairs, where opts is the same hash
+    # #highlight takes.
+    #
+    # Returns an array with the highlighted String for each snippet, in order.
+    # A snippet that couldn't be highlighted gets a MentosError in its place,
+    # rather than failing the whole batch.
+    def highlight_many(snippets)
+      # The original protocol can't carry a batch, so fall back to one round
+      # trip per snippet.
+      if requested_protocol < 2
+        return snippets.map do |code, opts|
+          begin
+            highlight(code, opts || {})
+          rescue MentosError => e
+            e
+          end
+        end
+      end
+
+      items = snippets.map do |code, opts|
+        opts ||= {}
+        opts[:options] ||= {}
+        opts[:options][:outencoding] ||= 'utf-8'
+        opts.merge(:bytes => code.to_s.bytesize)
+      end
+      codes = snippets.map { |code, _| code.to_s }
+
+      results = mentos(:highlight_many, nil, {:items => items}, codes)
+      return results if results.nil?
+
+      results.each_with_index.map do |str, i|
+        # Mirror #highlight, which hands back empty code untouched.
+        code = snippets[i].first
+        next code if code.nil? || code.empty?
+
+        if str.respond_to?(:force_encoding)
+          str.force_encoding(items[i][:options][:outencoding])
+        end
+        str
+      end
+    end
+
+    # What became of a highlight's budget, on the String it returns: the
+    # budget that ran out, as :bytes, :line_length or :seconds, or nil if none
+    # did, and how many lines were highlighted before it did.
+    module Budgeted
+      attr_accessor :fallback, :highlighted_lines
+    end
+
+    # How long a highlight given the :timings option took, on the String it
+    # returns: a hash of the seconds mentos spent reading the request
+    # ("read"), resolving the lexer ("lexer"), lexing ("lex") and
+    # formatting ("format"), and in all ("total").
+    module Timed
+      attr_accessor :timings
+    end
+
+    # Public: Lex code without formatting it, so the tokens can be stored and
+    # rendered with any formatter and options later, by #render, without
+    # lexing again.
+    #
+    # Takes the code and a hash of the same options #highlight takes; the
+    # formatter options are left for #render.
+    #
+    # Returns a hash of :types, the names of the token types seen (like
+    # "Comment.Single"), :tokens, a flat array of a type's index and a length
+    # in bytes for each token, and :text, which the tokens' lengths add up to:
+    # the code as the lexer saw it, which may differ in its newlines, tabs and
+    # leading or trailing whitespace.
+    def tokens(code, opts={})
+      opts[:options] ||= {}
+      mentos(:tokens, nil, opts, code.to_s)
+    end
+
+    # Public: Format tokens returned by #tokens.
+    #
+    # Takes the hash #tokens returned (with symbol or string keys, so it can
+    # be stored as JSON), and a hash of the same options #highlight takes,
+    # less the lexer's.
+    #
+    # Returns the formatted String, as #highlight would.
+    def render(tokens, opts={})
+      opts[:options] ||= {}
+      opts[:options][:outencoding] ||= 'utf-8'
+
+      kwargs = opts.merge(:types => tokens[:types] || tokens["types"],
+                          :tokens => tokens[:tokens] || tokens["tokens"])
+      str = mentos(:render, nil, kwargs, (tokens[:text] || tokens["text"]).to_s)
+      str.force_encoding(opts[:options][:outencoding]) if str.respond_to?(:force_encoding)
+      str
+    end
+
+    # Public: Highlight a document that's being edited, re-highlighting only
+    # what each edit changes. Only the html formatter is supported, and the
+    # result is the HTML of each line, without the wrapping <div> and <pre>.
+    #
+    # Takes the code and a hash of the same options #highlight takes, plus:
+    #
+    #   :document - A handle for the document, such as an id from the editor.
+    #               Required. Without an :edit, the document is (re)opened
+    #               with the code as its text.
+    #   :edit     - An array of the first line an edit replaces and the line
+    #               after the last (counting from 0), in which case the code
+    #               is the replacement for those lines. An empty range inserts
+    #               the code; empty code deletes the lines.
+    #
+    # Documents are kept in the mentos process that opened them, as long as
+    # they fit in MENTOS_DOCUMENT_BYTES (64MB of text by default). Editing a
+    # document it no longer has, say after a restart, raises a MentosError,
+    # and the document has to be opened again.
+    #
+    # Returns a hash of the :lines of HTML that changed, the line they :start
+    # at, how many of the old lines they replace (:removed), and the document's
+    # new :line_count.
+    def highlight_incremental(code, opts={})
+      raise ArgumentError, "highlight_incremental requires a :document" unless opts[:document]
+
+      opts[:options] ||= {}
+      mentos(:highlight_incremental, nil, opts, code.to_s)
+    end
+
+    # Public: Forget a document opened by #highlight_incremental.
+    #
+    # Returns nothing.
+    def close_document(document)
+      mentos(:close_document, nil, {:document => document})
+      nil
+    end
+
     private
 
-    # Our 'rpc'-ish request to mentos. Requires a method name, and then optional
-    # args, kwargs, code.
-    def mentos(method, args=[], kwargs={}, original_code=nil)
-      # Open the pipe if necessary
-      start unless alive?
+    # Highlight code for #highlight, handing the result to the block or the
+    # :out IO a chunk at a time. Trailing whitespace is held back until more
+    # output follows it, since the whole result would have been stripped of
+    # it. Over the original protocol the result arrives in one piece.
+    #
+    # Returns the :out IO, or nil.
+    def stream_highlight(code, opts, &block)
+      out = opts[:out]
+      block ||= lambda { |chunk| out.write(chunk) }
+      encoding = opts[:options][:outencoding]
+      kwargs = opts.reject { |key, _| key == :out }.merge(:stream => true)
+      kwargs[:chunk_bytes] = kwargs.delete(:chunk_size) if kwargs[:chunk_size]
+
+      pending = ""
+      emit = lambda do |chunk|
+        chunk.force_encoding(encoding) if chunk.respond_to?(:force_encoding)
+        chunk = pending + chunk
+        stripped = chunk.rstrip
+        pending = chunk[stripped.length..-1]
+        block.call(stripped) unless stripped.empty?
+      end
+
+      str = mentos(:highlight, nil, kwargs, code, &emit)
+      emit.call(str) if str && !str.empty?
+      out
+    end
+
+    # Spawn a mentos process for the given worker, replacing its previous
+    # process, if any. With a daemon to use, connect to it instead, unless it
+    # can't be reached.
+    #
+    # Returns the worker.
+    def spawn_worker(worker)
+      stop_worker(worker, worker.pid, "Daemon hung up.") if worker.socket
+      worker.fell_back_at = nil
+
+      if @socket_path && connect_daemon(worker)
+        @log.info "[#{Time.now.iso8601}] Connected to the mentos daemon at #{@socket_path}."
+      else
+        worker.fell_back_at = Time.now if @socket_path
+
+        if @zygote_enabled
+          fork_worker(worker)
+        else
+          # A pipe to the mentos python process. #popen4 gives us
+          # the pid and three IO objects to write and read.
+          worker.pid, worker.in, worker.out, worker.err = popen4(mentos_script)
+        end
+        @log.info "[#{Time.now.iso8601}] Starting pid #{worker.pid.to_s} with fd #{worker.out.to_i.to_s}."
+
+        worker.protocol = negotiate_protocol(worker, requested_protocol)
+        @log.info "[#{Time.now.iso8601}] Speaking protocol version #{worker.protocol.to_s}."
+      end
+
+      worker.multiplexer = worker.protocol >= 2 ? Multiplexer.new(worker.in, worker.out) : nil
+      prewarm_worker(worker)
+      worker
+    end
+
+    # Connect the worker to the mentos daemon, which only speaks the framed
+    # protocol.
+    #
+    # Returns true if it's connected, or false if the daemon couldn't be
+    # reached, in which case the worker is left as it was.
+    def connect_daemon(worker)
+      return false if requested_protocol < 2
+
+      socket = UNIXSocket.new(@socket_path)
+      Timeout::timeout(ENV["MENTOS_TIMEOUT"] || 8) do
+        socket.write(PROTOCOL_MAGIC + PROTOCOL_VERSION.chr)
+        reply = socket.read(PROTOCOL_MAGIC.bytesize + 1)
+        raise EOFError if reply.nil? || reply != PROTOCOL_MAGIC + PROTOCOL_VERSION.chr
+      end
+
+      # From here on, every frame is flushed exactly once.
+      socket.sync = false
+      worker.pid = nil
+      worker.in = worker.out = socket
+      worker.err = nil
+      worker.protocol = PROTOCOL_VERSION
+      worker.socket = @socket_path
+      true
+    rescue Timeout::Error, EOFError, IOError, SystemCallError => e
+      @log.error "[#{Time.now.iso8601}] Failed to connect to the mentos daemon at #{@socket_path}: #{e.message}"
+      socket.close if socket && !socket.closed?
+      false
+    end
+
+    # Move a worker that fell back to a child of its own back to the daemon,
+    # if it's been a while and the daemon is there again. The child is only
+    # stopped when none of its requests are in flight.
+    #
+    # Returns nothing.
+    def rejoin_daemon(worker)
+      return unless worker.fell_back_at && worker.in_flight == 0
+      return if Time.now - worker.fell_back_at < DAEMON_RETRY
+
+      worker.fell_back_at = Time.now
+      UNIXSocket.new(@socket_path).close
+      stop_worker(worker, worker.pid, "Rejoining the mentos daemon.")
+      spawn_worker(worker)
+    rescue SystemCallError
+    end
+
+    # The command line that runs mentos.
+    def mentos_script
+      "#{python_binary} #{File.expand_path('../mentos.py', __FILE__)}"
+    end
+
+    # Start the zygote, and wait for it to prewarm its lexers.
+    #
+    # Returns nothing.
+    def start_zygote
+      @zygote ||= Worker.new
+      @zygote.pid, @zygote.in, @zygote.out, @zygote.err = popen4("#{mentos_script} --zygote")
+      @log.info "[#{Time.now.iso8601}] Starting zygote pid #{@zygote.pid.to_s}."
+
+      Timeout::timeout(ENV["MENTOS_TIMEOUT"] || 8) do
+        @zygote.in.puts(Yajl.dump(:prewarm => prewarm_aliases))
+        @zygote.in.flush
+        report = @zygote.out.gets
+        raise EOFError if report.nil?
+
+        report = Yajl.load(report)
+        @zygote.prewarmed = report["lexers"]
+        @zygote.prewarm_seconds = report["seconds"]
+      end
+    rescue Timeout::Error, Errno::EPIPE, EOFError
+      @log.error "[#{Time.now.iso8601}] Failed to start zygote."
+      stop_worker(@zygote, @zygote.pid, "Failed to start zygote.")
+      raise MentosError, "Failed to start zygote."
+    end
+
+    # Have the zygote fork a new mentos process for the worker. The forked
+    # process connects back to a Unix socket we listen on just for it, and
+    # uses that socket in place of its stdin and stdout.
+    #
+    # Returns nothing.
+    def fork_worker(worker)
+      start_zygote unless @zygote && @zygote.alive?
+
+      path = File.join(Dir.tmpdir, "mentos-#{Process.pid}-#{@zygote.pid}-#{rand(1 << 32)}.sock")
+      server = UNIXServer.new(path)
 
       begin
-        # Timeout requests that take too long.
-        timeout_time = ENV["MENTOS_TIMEOUT"] || 8
-
-        Timeout::timeout(timeout_time) do
-          # For sanity checking on both sides of the pipe when highlighting, we prepend and
-          # append an id.  mentos checks that these are 8 character ids and that they match.
-          # It then returns the id's back to Rubyland.
-          id = (0...8).map{65.+(rand(25)).chr}.join
-          code = add_ids(original_code, id) if original_code
-
-          # Add metadata to the header and generate it.
-          if code
-            bytesize = code.bytesize
-          else
-            bytesize = 0
-          end
+        Timeout::timeout(ENV["MENTOS_TIMEOUT"] || 8) do
+          @zygote.in.puts(Yajl.dump(:spawn => path))
+          @zygote.in.flush
+          reply = @zygote.out.gets
+          raise EOFError if reply.nil?
+
+          worker.pid = Yajl.load(reply)["pid"]
+          worker.in = worker.out = server.accept
+          worker.err = nil
+        end
+      rescue Timeout::Error, Errno::EPIPE, EOFError
+        @log.error "[#{Time.now.iso8601}] Failed to fork a worker from the zygote."
+        stop_worker(@zygote, @zygote.pid, "Failed to fork a worker.")
+        raise MentosError, "Failed to fork a worker from the zygote."
+      ensure
+        server.close
+        File.unlink(path) if File.exist?(path)
+      end
+    end
+
+    # The lexers to prewarm: those we were asked to, plus those we've used
+    # most.
+    def prewarm_aliases
+      top = @lexer_usage.sort_by { |_, count| -count }.first(@prewarm_top).map { |name, _| name }
+      (@prewarm + top).uniq
+    end
+
+    # Have a freshly spawned worker compile the regexes of the lexers we were
+    # asked to prewarm, plus those we've used most, and wait for it to finish.
+    # The answer doubles as the signal that the worker is ready. Prewarming is
+    # best effort: if it fails, the worker just starts cold.
+    #
+    # Returns nothing.
+    def prewarm_worker(worker)
+      aliases = prewarm_aliases
+      return if aliases.empty?
+
+      Timeout::timeout(ENV["MENTOS_TIMEOUT"] || 8) do
+        if worker.protocol >= 2
+          _, res = framed_request(worker.multiplexer, :prewarm, [aliases], {}, nil)
+        else
+          res = legacy_request(worker, :prewarm, [aliases], {}, nil)
+        end
+
+        res = Yajl.load(res)
+        worker.prewarmed = res["lexers"]
+        worker.prewarm_seconds = res["seconds"]
+        @log.info "[#{Time.now.iso8601}] Prewarmed #{res["lexers"].join(', ')} in #{res["seconds"]}s on pid #{worker.pid.to_s}."
+      end
+    rescue Timeout::Error, MentosError, Errno::EPIPE, EOFError => e
+      @log.error "[#{Time.now.iso8601}] Failed to prewarm pid #{worker.pid.to_s}: #{e.message}"
+    end
+
+    # Keep count of the lexers mentos used to highlight, so we know which
+    # ones are worth prewarming.
+    #
+    # Returns nothing.
+    def record_lexer_usage(method, header)
+      return unless header
+
+      if method == :highlight || method == :tokens
+        names = [header["lexer"]]
+      elsif method == :highlight_many
+        names = header["items"].map { |item| item["lexer"] }
+      else
+        return
+      end
+
+      LOCK.synchronize do
+        names.each { |name| @lexer_usage[name] += 1 if name }
+      end
+    end
+
+    # Stop the worker's child process by issuing a kill -9, unless the child
+    # has already been replaced by a newer one. Requests that fail on a dead
+    # pipe pass the pid and multiplexer they talked to, so that a slow thread
+    # can't kill the child another thread has just started, or hang up the
+    # daemon connection it has just opened: those have no pid.
+    #
+    # We then call waitpid() with the pid, which waits for that particular
+    # child and reaps it.
+    #
+    # kill() can set errno to ESRCH if, for some reason, the file
+    # is gone; regardless the final outcome of this method
+    # will be to set the worker's pid to nil.
+    #
+    # Technically, kill() can also fail with EPERM or EINVAL (wherein
+    # the signal isn't sent); but we have permissions, and
+    # we're not doing anything invalid here.
+    #
+    # A worker connected to the daemon just hangs up; the daemon is shared,
+    # and stays up.
+    def stop_worker(worker, pid, reason, multiplexer=worker.multiplexer)
+      return unless pid == worker.pid && multiplexer.equal?(worker.multiplexer)
+      if worker.pid
+        begin
+          Process.kill('KILL', worker.pid)
+          Process.waitpid(worker.pid)
+        rescue Errno::ESRCH, Errno::ECHILD
+        end
+      end
+      @log.info "[#{Time.now.iso8601}] Killing pid: #{worker.pid.to_s}. Reason: #{reason}"
+      [worker.in, worker.out, worker.err].compact.uniq.each do |io|
+        begin
+          io.close unless io.closed?
+        rescue IOError, SystemCallError
+        end
+      end
+      worker.pid = nil
+      worker.socket = nil
+      worker.multiplexer = nil
+    end
 
-          kwargs.freeze
-          kwargs = kwargs.merge("fd" => @out.to_i, "id" => id, "bytes" => bytesize)
-          out_header = Yajl.dump(:method => method, :args => args, :kwargs => kwargs)
+    # Pick a worker for a request: the one with the fewest requests in
+    # flight, preferring live children over dead ones, or, for requests about
+    # a document, the one that holds it, or the one at index in the pool, if
+    # given. A dead child is respawned first.
+    #
+    # Returns the worker, along with the pid, protocol and multiplexer it had
+    # when it was picked.
+    def checkout_worker(document=nil, index=nil)
+      LOCK.synchronize do
+        start unless @workers
 
-          # Get the size of the header itself and write that.
-          bits = get_fixed_bits_from_header(out_header)
-          @in.write(bits)
+        if index
+          worker = @workers[index]
+        elsif document
+          worker = @workers[document.hash % @workers.size]
+        else
+          worker = @workers.min_by { |w| [w.in_flight, w.pid ? 0 : 1] }
+        end
+        if !worker.alive?
+          worker.restarts += 1 if worker.requests > 0
+          spawn_worker(worker)
+        elsif worker.fell_back_at
+          rejoin_daemon(worker)
+        end
 
-          # mentos is now waiting for the header, and, potentially, code.
-          write_data(out_header, code)
+        worker.in_flight += 1
+        worker.requests += 1
+        [worker, worker.pid, worker.protocol, worker.multiplexer]
+      end
+    end
 
-          # mentos will now return data to us. First it sends the header.
-          header = get_header
+    # The protocol version we ask mentos for.
+    def requested_protocol
+      (ENV['MENTOS_PROTOCOL'] || PROTOCOL_VERSION).to_i
+    end
 
-          # Now handle the header, any read any more data required.
-          res = handle_header_and_return(header, id)
+    # Ask mentos for the given protocol version. Versions below 2 don't have a
+    # handshake, so there's nothing to send.
+    #
+    # Returns the version mentos agreed to speak.
+    def negotiate_protocol(worker, version)
+      return 1 if version < 2
+
+      worker.in.write(PROTOCOL_MAGIC + version.chr)
+      reply = worker.out.read(PROTOCOL_MAGIC.bytesize + 1)
+
+      if reply.nil? || reply[0, PROTOCOL_MAGIC.bytesize] != PROTOCOL_MAGIC
+        @log.error "[#{Time.now.iso8601}] Protocol negotiation failed."
+        stop_worker(worker, worker.pid, "Protocol negotiation failed.")
+        raise MentosError, "Protocol negotiation failed."
+      end
+
+      # From here on, every frame is flushed exactly once.
+      worker.in.sync = false
+      reply[-1, 1].unpack("C").first
+    end
+
+    # Our 'rpc'-ish request to mentos. Requires a method name, and then optional
+    # args, kwargs, code, and the index in the pool of the worker to ask.
+    def mentos(method, args=[], kwargs={}, original_code=nil, index=nil, &block)
+      # Pick a child, opening its pipe if necessary, and take note of the
+      # process we're talking to.
+      # Requests about a document go to the process that holds it.
+      document = kwargs[:document] if kwargs.is_a?(Hash)
+      worker, pid, protocol, multiplexer = checkout_worker(document, index)
+
+      begin
+        # Timeout requests that take too long. Over the framed protocol,
+        # mentos is told the deadline and gives up on the request itself, so
+        # we only step in if it doesn't. Streams are only timed while they
+        # wait on mentos, however long the block takes over its chunks.
+        timeout_time = (ENV["MENTOS_TIMEOUT"] || 8).to_f
+        limit = protocol >= 2 ? timeout_time + TIMEOUT_GRACE : timeout_time
+
+        Timeout::timeout(protocol >= 2 && block ? nil : limit) do
+          if protocol >= 2
+            header, res = framed_request(multiplexer, method, args, kwargs, original_code, timeout_time, limit, &block)
+          else
+            header, res = nil, worker.lock.synchronize { legacy_request(worker, method, args, kwargs, original_code) }
+          end
+
+          record_lexer_usage(method, header)
 
           # Finally, return what we got.
-          return_result(res, method)
+          return_result(res, method, header)
         end
       rescue Timeout::Error
         # If we timeout, we need to clear out the pipe and start over.
         @log.error "[#{Time.now.iso8601}] Timeout on a mentos #{method} call"
-        stop "Timeout on mentos #{method} call."
+        LOCK.synchronize do
+          worker.timeouts += 1
+          stop_worker(worker, pid, "Timeout on mentos #{method} call.", multiplexer)
+        end
+        # Part of a stream may have been handed over already, so it can't
+        # just come to nothing.
+        raise MentosError, "Timeout on a mentos #{method} stream." if block
+        nil
+      rescue MentosTimeout
+        # mentos dropped the request, and the child is still good.
+        @log.error "[#{Time.now.iso8601}] Timeout on a mentos #{method} call"
+        LOCK.synchronize { worker.timeouts += 1 }
+        raise MentosError, "Timeout on a mentos #{method} stream." if block
+        nil
       end
 
+    rescue MentosError
+      LOCK.synchronize { worker.errors += 1 } if worker
+      raise
     rescue Errno::EPIPE, EOFError
-    stop "EPIPE"
-    raise MentosError, "EPIPE"
+      if worker
+        LOCK.synchronize do
+          worker.errors += 1
+          stop_worker(worker, pid, "EPIPE", multiplexer)
+        end
+      end
+      raise MentosError, "EPIPE"
+    ensure
+      LOCK.synchronize { worker.in_flight -= 1 } if worker
+    end
+
+    # Send a request using the framed (version 2) protocol and wait for its
+    # response. The request id travels in the header, so the code is sent
+    # as-is, without any padding, and the response can be matched back to
+    # this request even when other threads have requests in flight.
+    #
+    # Given a block, the response is streamed, and each chunk of it is
+    # yielded as it arrives, with Timeout::Error raised once patience
+    # seconds have gone by waiting for it. Given a timeout, in seconds,
+    # mentos gives up on the request after that long, and MentosTimeout is
+    # raised.
+    #
+    # Returns the parsed response header and the response body.
+    def framed_request(multiplexer, method, args, kwargs, code, timeout=nil, patience=nil, &block)
+      @log.info "[#{Time.now.iso8601}] Out request: #{method.to_s}"
+      if block
+        header, res = multiplexer.stream(method, args, kwargs, code, timeout, patience, &block)
+      else
+        header, res = multiplexer.call(method, args, kwargs, code, timeout)
+      end
+      @log.info "[#{Time.now.iso8601}] In header: #{Yajl.dump(header)} "
+
+      if header["error"]
+        # The frame was read in full, so the pipe is still in a consistent
+        # state and the child can stay up.
+        @log.error "[#{Time.now.iso8601}] Error from mentos: #{header["error"]}"
+        raise MentosTimeout, header["error"] if header["timeout"]
+        raise MentosError, header["error"]
+      end
+
+      [header, res]
+    end
+
+    # Send a request using the original (version 1) protocol and wait for its
+    # response.
+    #
+    # Returns the response body.
+    def legacy_request(worker, method, args, kwargs, original_code)
+      # For sanity checking on both sides of the pipe when highlighting, we prepend and
+      # append an id.  mentos checks that these are 8 character ids and that they match.
+      # It then returns the id's back to Rubyland.
+      id = (0...8).map{65.+(rand(25)).chr}.join
+      code = add_ids(original_code, id) if original_code
+
+      # Add metadata to the header and generate it.
+      if code
+        bytesize = code.bytesize
+      else
+        bytesize = 0
+      end
+
+      kwargs.freeze
+      kwargs = kwargs.merge("fd" => worker.out.to_i, "id" => id, "bytes" => bytesize)
+      out_header = Yajl.dump(:method => method, :args => args, :kwargs => kwargs)
+
+      # Get the size of the header itself and write that.
+      bits = get_fixed_bits_from_header(out_header)
+      worker.in.write(bits)
+
+      # mentos is now waiting for the header, and, potentially, code.
+      write_data(worker, out_header, code)
+
+      # mentos will now return data to us. First it sends the header.
+      header = get_header(worker)
+
+      # Now handle the header, any read any more data required.
+      handle_header_and_return(worker, header, id)
     end
 
 
@@ -268,19 +1095,19 @@ module Pygments
     # Then, do a sanity check wih the ids.
     #
     # Returns a result — either highlighted text or metadata.
-    def handle_header_and_return(header, id)
+    def handle_header_and_return(worker, header, id)
       if header
-        header = header_to_json(header)
+        header = header_to_json(worker, header)
         bytes = header["bytes"]
 
         # Read more bytes (the actual response body)
-        res = @out.read(bytes.to_i)
+        res = worker.out.read(bytes.to_i)
 
         if header["method"] == "highlight"
           # Make sure we have a result back; else consider this an error.
           if res.nil?
             @log.warn "[#{Time.now.iso8601}] No highlight result back from mentos."
-            stop "No highlight result back from mentos."
+            stop_worker(worker, worker.pid, "No highlight result back from mentos.")
             raise MentosError, "No highlight result back from mentos."
           end
 
@@ -295,7 +1122,7 @@ module Pygments
           # Sanity check.
           if not (start_id == id and end_id == id)
             @log.error "[#{Time.now.iso8601}] ID's did not match. Aborting."
-            stop "ID's did not match. Aborting."
+            stop_worker(worker, worker.pid, "ID's did not match. Aborting.")
             raise MentosError, "ID's did not match. Aborting."
           else
             # We're good. Remove the padding
@@ -307,7 +1134,7 @@ module Pygments
         res
       else
         @log.error "[#{Time.now.iso8601}] No header data back."
-        stop "No header data back."
+        stop_worker(worker, worker.pid, "No header data back.")
         raise MentosError, "No header received back."
       end
     end
@@ -325,10 +1152,10 @@ module Pygments
     # Write data to mentos, the Python Process.
     #
     # Returns nothing.
-    def write_data(out_header, code=nil)
-      @in.write(out_header)
+    def write_data(worker, out_header, code=nil)
+      worker.in.write(out_header)
       @log.info "[#{Time.now.iso8601}] Out header: #{out_header.to_s}"
-      @in.write(code) if code
+      worker.in.write(code) if code
     end
 
     # Sanity check for size (32-arity of 0's and 1's)
@@ -344,15 +1171,15 @@ module Pygments
     # Read the header via the pipe.
     #
     # Returns a header.
-    def get_header
+    def get_header(worker)
       begin
-        size = @out.read(33)
+        size = worker.out.read(33)
         size = size[0..-2]
 
         # Sanity check the size
         if not size_check(size)
           @log.error "[#{Time.now.iso8601}] Size returned from mentos.py invalid."
-          stop "Size returned from mentos.py invalid."
+          stop_worker(worker, worker.pid, "Size returned from mentos.py invalid.")
           raise MentosError, "Size returned from mentos.py invalid."
         end
 
@@ -360,26 +1187,62 @@ module Pygments
         # convert the string of bits into an integer.
         header_bytes = size.to_s.to_i(2) + 1
         @log.info "[#{Time.now.iso8601}] Size in: #{size.to_s} (#{header_bytes.to_s})"
-        @out.read(header_bytes)
+        worker.out.read(header_bytes)
       rescue
         @log.error "[#{Time.now.iso8601}] Failed to get header."
-        stop "Failed to get header."
+        stop_worker(worker, worker.pid, "Failed to get header.")
         raise MentosError, "Failed to get header."
       end
     end
 
     # Return the final result for the API. Return Ruby objects for the methods that
     # want them, text otherwise.
-    def return_result(res, method)
-      unless method == :lexer_name_for || method == :highlight || method == :css
+    def return_result(res, method, header=nil)
+      return split_batch(res, header["items"]) if method == :highlight_many
+
+      unless method == :lexer_name_for || method == :highlight || method == :css || method == :render
         res = Yajl.load(res, :symbolize_keys => true)
       end
       res = res.rstrip if res.class == String
-      res
+      timed(budgeted(res, header), header)
+    end
+
+    # Mark a result that was asked for its timings with them.
+    def timed(str, header)
+      return str unless header && header["timings"] && str.is_a?(String)
+      str.extend(Timed)
+      str.timings = header["timings"]
+      str
+    end
+
+    # Mark a highlight that was given a budget with what became of it.
+    def budgeted(str, header)
+      return str unless header && header["budget"] && str.is_a?(String)
+      str.extend(Budgeted)
+      str.fallback = header["budget"]["fallback"] && header["budget"]["fallback"].to_sym
+      str.highlighted_lines = header["budget"]["lines"]
+      str
+    end
+
+    # Split the concatenated body of a highlight_many response into one result
+    # per item, using the sizes listed in the header.
+    #
+    # Returns an array of Strings, with a MentosError for each failed item.
+    def split_batch(res, items)
+      offset = 0
+      items.map do |item|
+        if item["error"]
+          MentosError.new(item["error"])
+        else
+          str = res[offset, item["bytes"]]
+          offset += item["bytes"]
+          budgeted(str.rstrip, item)
+        end
+      end
     end
 
     # Convert a text header into JSON for easy access.
-    def header_to_json(header)
+    def header_to_json(worker, header)
       @log.info "[#{Time.now.iso8601}] In header: #{header.to_s} "
       header = Yajl.load(header)
 
@@ -387,7 +1250,7 @@ module Pygments
         # Raise this as a Ruby exception of the MentosError class.
         # Stop so we don't leave the pipe in an inconsistent state.
         @log.error "[#{Time.now.iso8601}] Failed to convert header to JSON."
-        stop header["error"]
+        stop_worker(worker, worker.pid, header["error"])
         raise MentosError, header["error"]
       else
         header
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling the rules of RegexLexers: how often each rule's regex is tried,
+how often it matches, and how long it takes.
+"""
+
+from time import time
+
+from pygments.lexer import RegexLexer, DelegatingLexer
+
+# Indexes into the counters kept for each rule.
+_ATTEMPTS, _MATCHES, _SECONDS = 0, 1, 2
+
+def _timed(rexmatch, counters):
+    """
+    Returns a stand-in for a rule's rexmatch that counts its attempts and
+    matches, and the time it takes, in counters.
+    """
+    def match(*args):
+        started = time()
+        m = rexmatch(*args)
+        counters[_SECONDS] += time() - started
+        counters[_ATTEMPTS] += 1
+        if m:
+            counters[_MATCHES] += 1
+        return m
+    return match
+
+def _regex_lexers(lexer):
+    """
+    Returns the RegexLexers that do the lexing for lexer: itself, or those
+    it delegates to.
+    """
+    if isinstance(lexer, DelegatingLexer):
+        return _regex_lexers(lexer.root_lexer) + _regex_lexers(lexer.language_lexer)
+    if isinstance(lexer, RegexLexer):
+        return [lexer]
+    return []
+
+class RuleProfile(object):
+    """
+    Counters for the rules of a lexer, by the name of the lexer whose rule it
+    is (the lexer's own, or one it delegates to, as template lexers do), the
+    state, and the rule's index in it, counting from 0 after includes and
+    inherited rules are put in place.
+
+    Lexing with a profile only changes the lexer while profile runs it, so
+    lexing without one costs nothing more than it ever did. Other lexers of
+    its class aren't changed at all, so a lexer that's shared by threads
+    that keep lexing, as mentos' are, shouldn't be profiled: make one.
+    """
+    def __init__(self, lexer):
+        self.lexer = lexer
+        self.rules = {}
+        self.patterns = {}
+        self.seconds = 0.0
+        self.chars = 0
+
+    def profile(self, text):
+        """
+        Lexes text with the lexer, adding each rule's attempts, matches and
+        time to the counters, and returns the number of tokens.
+
+        The lexer is given timed stand-ins for its rules while it lexes,
+        shadowing its class' rules, which are left as they are. Lexers with
+        token variants keep their rules on the instance already, and get
+        them back afterwards.
+        """
+        lexers = _regex_lexers(self.lexer)
+        if not lexers:
+            raise TypeError("%s isn't a RegexLexer" % self.lexer.name)
+
+        originals = []
+        try:
+            for lexer in lexers:
+                if [done for done, _ in originals if done is lexer]:
+                    continue
+                originals.append((lexer, lexer.__dict__.get('_tokens')))
+                lexer._tokens = self._instrument(lexer.name, lexer._tokens)
+
+            started = time()
+            count = 0
+            for _ in self.lexer.get_tokens(text):
+                count += 1
+            self.seconds += time() - started
+            self.chars += len(text)
+        finally:
+            for lexer, tokendefs in reversed(originals):
+                if tokendefs is None:
+                    del lexer._tokens
+                else:
+                    lexer._tokens = tokendefs
+        return count
+
+    def _instrument(self, name, tokendefs):
+        """
+        Returns a copy of the rules in tokendefs, a lexer's _tokens, with each
+        rexmatch swapped for a timed stand-in.
+        """
+        timed = {}
+        for state, rules in tokendefs.iteritems():
+            timed[state] = []
+            for index, (rexmatch, action, new_state) in enumerate(rules):
+                key = (name, state, index)
+                counters = self.rules.get(key)
+                if counters is None:
+                    counters = self.rules[key] = [0, 0, 0.0]
+                    self.patterns[key] = getattr(rexmatch, '__self__', None) and rexmatch.__self__.pattern
+                timed[state].append((_timed(rexmatch, counters), action, new_state))
+        return timed
+
+    def worst(self, count=20, by="seconds"):
+        """
+        Returns the count worst rules, as dicts of the lexer, state, index,
+        pattern, attempts, matches, failures (attempts that didn't match)
+        and seconds of each, ranked by seconds, attempts or failures.
+        """
+        rows = []
+        for (name, state, index), (attempts, matches, seconds) in self.rules.iteritems():
+            if not attempts:
+                continue
+            rows.append({
+                "lexer": name,
+                "state": state,
+                "index": index,
+                "pattern": self.patterns[(name, state, index)],
+                "attempts": attempts,
+                "matches": matches,
+                "failures": attempts - matches,
+                "seconds": seconds,
+            })
+        rows.sort(key=lambda row: row[by], reverse=True)
+        return rows[:count]
+
+    def report(self, count=20, by="seconds"):
+        """
+        Returns the count worst rules as a table, for reading.
+        """
+        lines = ["%s: %d characters in %.1f ms (with profiling)\n" % (
+                     self.lexer.name, self.chars, self.seconds * 1000),
+                 "%-12s %-20s %5s %10s %10s %10s %10s %8s  %s" % (
+                     "lexer", "state", "rule", "attempts", "matches", "failures", "total", "each",
+                     "pattern")]
+        for row in self.worst(count, by):
+            lines.append("%-12s %-20s %5d %10d %10d %10d %7.1f ms %5.2f us  %s" % (
+                row["lexer"][:12], row["state"][:20], row["index"], row["attempts"], row["matches"],
+                row["failures"], row["seconds"] * 1000, row["seconds"] * 1e6 / row["attempts"],
+                _clip(repr(row["pattern"]), 60)))
+        return "\n".join(lines)
+
+def _clip(text, width):
+    return len(text) > width and text[:width - 3] + "..." or text
+
+def profile(lexer, text):
+    """
+    Returns the RuleProfile of lexing text with lexer.
+    """
+    rules = RuleProfile(lexer)
+    rules.profile(text)
+    return rules
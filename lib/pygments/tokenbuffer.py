@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Tokens kept as arrays of positions in the text they came from, rather than
+as a (tokentype, value) pair and a substring each.
+"""
+
+from array import array
+
+class TokenBuffer(object):
+    """
+    The tokens of a text, as parallel arrays of where each token starts in
+    the text, and the index of its type in types. A token runs up to where
+    the next one starts, the last up to end. Text the lexer left out of its
+    tokens, as bygroups does for groups without a token type, is covered by
+    a token of type None, which is skipped.
+
+    Iterating over a buffer yields (tokentype, value) pairs like a lexer's
+    get_tokens does, slicing each value out of the text only then, so any
+    filter or formatter can take one. runs() yields the types and positions,
+    for those that can do without the values.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.starts = array('l')
+        self.ids = array('H')
+        self.types = [None]
+        self.end = 0
+        self._ids = {None: 0}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def type_id(self, ttype):
+        """
+        Returns the index of ttype in types, adding it if it's new.
+        """
+        index = self._ids.get(ttype)
+        if index is None:
+            index = self._ids[ttype] = len(self.types)
+            self.types.append(ttype)
+        return index
+
+    def append(self, ttype, start, end):
+        """
+        Adds a token of ttype, the text from start to end, which must be at or
+        after the end of the last token.
+        """
+        if start != self.end:
+            if start < self.end:
+                raise ValueError("Token at %d starts before the last one ends, at %d" % (start, self.end))
+            self.starts.append(self.end)
+            self.ids.append(0)
+        self.starts.append(start)
+        self.ids.append(self.type_id(ttype))
+        self.end = end
+
+    def extend(self, tokens):
+        """
+        Adds the (index, tokentype, value) triples of a lexer's
+        get_tokens_unprocessed, if each value is the text at its index,
+        raising ValueError if not.
+        """
+        text = self.text
+        for index, ttype, value in tokens:
+            if not text.startswith(value, index):
+                raise ValueError("Token at %d isn't the text there" % index)
+            self.append(ttype, index, index + len(value))
+
+    def runs(self):
+        """
+        Yields the (tokentype, start, end) of each token.
+        """
+        types = self.types
+        starts = self.starts
+        ids = self.ids
+        last = len(starts) - 1
+        for i in xrange(last):
+            ttype = types[ids[i]]
+            if ttype is not None:
+                yield ttype, starts[i], starts[i + 1]
+        if last >= 0 and ids[last]:
+            yield types[ids[last]], starts[last], self.end
+
+    def __iter__(self):
+        text = self.text
+        types = self.types
+        starts = self.starts
+        ids = self.ids
+        last = len(starts) - 1
+        for i in xrange(last):
+            ttype = types[ids[i]]
+            if ttype is not None:
+                yield ttype, text[starts[i]:starts[i + 1]]
+        if last >= 0 and ids[last]:
+            yield types[ids[last]], text[starts[last]:self.end]
+
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Ranks the rules of a RegexLexer by how much of its time they take on the
+given files: how often each rule's regex was tried, how often it matched,
+and how long it took, by state and the rule's index in it. Slow patterns
+(say, ones that backtrack) rank high by time, and rules tried too early in
+their state by failures.
+
+    python profile-rules.py [options] file ...
+
+The lexer is found by each file's name, unless given with --lexer.
+"""
+
+import sys, os
+from optparse import OptionParser
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, base_dir + "/vendor/pygments-main")
+sys.path.insert(0, base_dir + "/lib/pygments")
+
+from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
+from pygments.util import ClassNotFound
+from profiling import RuleProfile
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] file ...")
+    parser.add_option("-l", "--lexer", help="alias of the lexer to profile")
+    parser.add_option("-n", "--rules", type="int", default=20, help="rules to show (20)")
+    parser.add_option("-s", "--sort", default="seconds", choices=["seconds", "attempts", "failures"],
+                      help="rank rules by seconds, attempts or failures (seconds)")
+    options, paths = parser.parse_args(args)
+    if not paths:
+        parser.error("no files to lex")
+
+    profiles = {}
+    for path in paths:
+        try:
+            if options.lexer:
+                lexer = get_lexer_by_name(options.lexer)
+            else:
+                lexer = get_lexer_for_filename(path)
+        except ClassNotFound, e:
+            parser.error(str(e))
+
+        text = open(path, 'rb').read()
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            text = text.decode('latin1')
+
+        rules = profiles.get(lexer.name)
+        if rules is None:
+            rules = profiles[lexer.name] = RuleProfile(lexer)
+        try:
+            rules.profile(text)
+        except TypeError, e:
+            parser.error(str(e))
+
+    for name in sorted(profiles):
+        print profiles[name].report(options.rules, options.sort)
+        print
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
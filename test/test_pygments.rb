@@ -1,6 +1,8 @@
 #coding: utf-8
 
 require 'test/unit'
+require 'stringio'
+require 'fileutils'
 require File.join(File.dirname(__FILE__), '..', '/lib/pygments.rb')
 ENV['mentos-test'] = "yes"
 
@@ -29,10 +31,42 @@ class PygmentsHighlightTest < Test::Unit::TestCase
     assert_equal "<table class=\"highlighttable\"><tr><td class=\"linenos\"><div class=\"linenodiv\"><pre>1\n2</pre></div></td><td class=\"code\"><div class=\"highlight\"><pre><span class=\"c1\">#!/usr/bin/ruby</span>\n<span class=\"nb\">puts</span> <span class=\"s1\">&#39;foo&#39;</span>\n</pre></div>\n</td></tr></table>", code
   end
 
+  def test_inline_styles_highlight
+    code = P.highlight(RUBY_CODE, :options => {:noclasses => true})
+    assert_equal "<div class=\"highlight\" style=\"background: #f8f8f8\"><pre style=\"line-height: 125%\"><span style=\"color: #408080; font-style: italic\">#!/usr/bin/ruby</span>\n<span style=\"color: #008000\">puts</span> <span style=\"color: #BA2121\">&#39;foo&#39;</span>\n</pre></div>", code
+  end
+
+  def test_highlight_images
+    png = P.highlight(RUBY_CODE, :formatter => 'png')
+    assert_equal [137, 80, 78, 71], png.unpack('C4')
+    assert_equal 'GIF8', P.highlight(RUBY_CODE, :formatter => 'gif')[0, 4]
+  rescue MentosError => e
+    raise unless e.message =~ /Python Imaging Library|No usable fonts/
+    omit "Images need PIL and fonts"
+  end
+
+  def test_image_formatters_leave_pygments_own_alone
+    script = <<-PY
+import sys
+sys.path[:0] = [sys.argv[1] + '/lib/pygments', sys.argv[1] + '/vendor/pygments-main']
+import imaging
+from pygments.formatters import img
+print img.FontManager.__module__, imaging._init_with_shared_fonts.func_globals['FontManager'].__name__
+    PY
+    out = IO.popen([P.python_binary, '-c', script, File.expand_path('../..', __FILE__)]) { |io| io.read }
+    assert $?.success?
+    assert_equal "pygments.formatters.img font_manager\n", out
+  end
+
+  def test_highlight_escapes_tokens_across_lines
+    code = P.highlight("def f():\n    \"\"\"<a> & 'b'\n    \"c\"\n    \"\"\"\n", :lexer => 'python')
+    assert_equal "<div class=\"highlight\"><pre><span class=\"k\">def</span> <span class=\"nf\">f</span><span class=\"p\">():</span>\n    <span class=\"sd\">&quot;&quot;&quot;&lt;a&gt; &amp; &#39;b&#39;</span>\n<span class=\"sd\">    &quot;c&quot;</span>\n<span class=\"sd\">    &quot;&quot;&quot;</span>\n</pre></div>", code
+  end
+
   def test_highlight_works_with_larger_files
-    code = P.highlight(REDIS_CODE)
+    code = P.highlight(REDIS_CODE, :lexer => 'c')
     assert_match 'used_memory_peak_human', code
-    assert_equal 455203, code.bytesize.to_i
+    assert_equal 451717, code.bytesize.to_i
   end
 
   def test_returns_nil_on_timeout
@@ -107,6 +141,84 @@ class PygmentsHighlightTest < Test::Unit::TestCase
     assert_match '<span class="c1">#!/usr/bin/ruby</span>', code
   end
 
+  def test_highlight_many
+    res = P.highlight_many([[RUBY_CODE, {}], ['# ø', {:lexer => 'rb'}], [RUBY_CODE, {:formatter => 'terminal'}]])
+    assert_equal 3, res.size
+    assert_equal P.highlight(RUBY_CODE), res[0]
+    assert_match "# ø", res[1]
+    assert_match '39;49;00m', res[2]
+  end
+
+  def test_highlight_many_reports_errors_per_item
+    res = P.highlight_many([[RUBY_CODE, {:lexer => 'nonexistent'}], [RUBY_CODE, {:lexer => 'rb'}], ["", {}]])
+    assert_kind_of MentosError, res[0]
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', res[1]
+    assert_equal "", res[2]
+  end
+
+  def test_highlight_within_budget_is_the_full_highlight
+    code = P.highlight(RUBY_CODE, :budget => {:bytes => 1000, :line_length => 100, :seconds => 5})
+    assert_equal P.highlight(RUBY_CODE), code
+    assert_nil code.fallback
+    assert_nil code.highlighted_lines
+  end
+
+  def test_highlight_over_bytes_budget_falls_back_to_plain_text
+    code = P.highlight(RUBY_CODE + "\n" + RUBY_CODE, :lexer => 'rb', :budget => {:bytes => 30})
+    assert_equal :bytes, code.fallback
+    assert_equal 2, code.highlighted_lines
+    assert_equal 1, code.scan('<span class="c1">').size
+    assert_match "puts &#39;foo&#39;\n</pre>", code
+  end
+
+  def test_highlight_over_line_length_budget_is_plain_text
+    code = P.highlight(RUBY_CODE, :lexer => 'rb', :budget => {:line_length => 10})
+    assert_equal :line_length, code.fallback
+    assert_equal "<div class=\"highlight\"><pre>#!/usr/bin/ruby\nputs &#39;foo&#39;\n</pre></div>", code
+  end
+
+  def test_highlight_over_time_budget_falls_back_to_plain_text
+    code = P.highlight(REDIS_CODE * 20, :budget => {:seconds => 0.05})
+    assert_equal :seconds, code.fallback
+    assert code.highlighted_lines < (REDIS_CODE * 20).count("\n")
+    assert_match %r{</pre></div>\z}, code
+  end
+
+  def test_highlight_many_with_budget
+    res = P.highlight_many([[RUBY_CODE, {:lexer => 'rb', :budget => {:line_length => 10}}], [RUBY_CODE, {:lexer => 'rb'}]])
+    assert_equal :line_length, res[0].fallback
+    assert !res[1].respond_to?(:fallback)
+  end
+
+  def test_highlight_streams_chunks_to_a_block
+    chunks = []
+    P.highlight(REDIS_CODE, :chunk_size => 4096) { |chunk| chunks << chunk }
+    assert chunks.size > 1
+    assert_equal P.highlight(REDIS_CODE), chunks.join
+  end
+
+  def test_highlight_streams_to_an_io
+    out = StringIO.new
+    assert_equal out, P.highlight(RUBY_CODE, :out => out)
+    assert_equal P.highlight(RUBY_CODE), out.string
+  end
+
+  def test_highlight_keeps_serving_after_a_failed_stream
+    assert_raise(RuntimeError) do
+      P.highlight(REDIS_CODE, :chunk_size => 4096) { |chunk| raise "stop" }
+    end
+    assert_equal P.highlight(RUBY_CODE), P.highlight(RUBY_CODE) { |chunk| break chunk }
+  end
+
+  def test_highlight_options_are_not_shared_between_requests
+    first = P.highlight(RUBY_CODE, :options => {:hl_lines => [1]})
+    second = P.highlight(RUBY_CODE, :options => {:hl_lines => [2]})
+    assert_match '<span class="hll"><span class="c1">#!/usr/bin/ruby', first
+    assert_match '<span class="hll"><span class="nb">puts', second
+    assert_no_match(/hll/, P.highlight(RUBY_CODE))
+    assert_equal first, P.highlight(RUBY_CODE, :options => {:hl_lines => [1]})
+  end
+
   def test_highlight_still_works_with_invalid_code
     code = P.highlight("importr python;    wat?", :lexer => 'py')
     assert_match ">importr</span>", code
@@ -160,9 +272,751 @@ class PygmentsValidityTest < Test::Unit::TestCase
   end
 end
 
+class PygmentsProtocolTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def test_framed_protocol_is_negotiated
+    P.highlight(RUBY_CODE)
+    assert_equal [2], P.workers.map { |w| w[:protocol] }
+  end
+
+  def test_framed_protocol_error_keeps_child_alive
+    P.lexer_name_for(:lexer => 'ruby')
+    pid = P.workers.first[:pid]
+    assert_raise MentosError do
+      P.lexer_name_for(:invalid => true)
+    end
+    assert_equal pid, P.workers.first[:pid]
+    assert_equal 'rb', P.lexer_name_for(:lexer => 'ruby')
+  end
+
+  def test_slow_stream_consumers_dont_time_out
+    expected = P.highlight(PygmentsHighlightTest::REDIS_CODE, :lexer => 'c')
+    pid = P.workers.first[:pid]
+    ENV['MENTOS_TIMEOUT'] = '1'
+    chunks = []
+    started = Time.now
+    P.highlight(PygmentsHighlightTest::REDIS_CODE, :lexer => 'c', :chunk_size => 4096) do |chunk|
+      sleep 0.2
+      chunks << chunk
+    end
+    assert Time.now - started > 1 + P::Popen::TIMEOUT_GRACE
+    assert_equal expected, chunks.join
+    assert_equal pid, P.workers.first[:pid]
+    assert_equal 0, P.workers.first[:timeouts]
+  ensure
+    ENV.delete('MENTOS_TIMEOUT')
+  end
+
+  def test_streams_that_time_out_raise
+    ENV['MENTOS_TIMEOUT'] = '1'
+    assert_raise(MentosError) do
+      P.highlight(PygmentsHighlightTest::REDIS_CODE * 50, :lexer => 'c') { |chunk| }
+    end
+    assert_equal 1, P.workers.first[:timeouts]
+  ensure
+    ENV.delete('MENTOS_TIMEOUT')
+  end
+
+  def test_framed_protocol_timeout_keeps_child_alive
+    P.highlight(RUBY_CODE)
+    pid = P.workers.first[:pid]
+    ENV['MENTOS_TIMEOUT'] = '1'
+    assert_nil P.highlight(PygmentsHighlightTest::REDIS_CODE * 50)
+    assert_equal pid, P.workers.first[:pid]
+    assert_equal 1, P.workers.first[:timeouts]
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE)
+  ensure
+    ENV.delete('MENTOS_TIMEOUT')
+  end
+
+  def test_concurrent_requests_share_one_child
+    P.highlight(RUBY_CODE)
+    pid = P.workers.first[:pid]
+    threads = (1..8).map { |i| Thread.new { P.highlight("puts #{i}", :lexer => 'rb') } }
+    threads.each_with_index do |thread, i|
+      assert_match ">#{i + 1}</span>", thread.value
+    end
+    assert_equal pid, P.workers.first[:pid]
+  end
+
+  def test_concurrent_requests_with_threaded_mentos
+    P.stop "Switching to threaded mentos"
+    ENV['MENTOS_THREADS'] = '4'
+    large = Thread.new { P.highlight(PygmentsHighlightTest::REDIS_CODE, :lexer => 'c') }
+    small = (1..4).map { |i| Thread.new { P.lexer_name_for(:filename => "test#{i}.py") } }
+    assert_equal ['python'] * 4, small.map(&:value)
+    assert_equal 451717, large.value.bytesize
+  ensure
+    ENV.delete('MENTOS_THREADS')
+    P.stop "Switching to threaded mentos"
+  end
+
+  def test_legacy_protocol_still_works
+    P.stop "Switching protocols"
+    ENV['MENTOS_PROTOCOL'] = '1'
+    P.start
+    assert_equal [1], P.workers.map { |w| w[:protocol] }
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE)
+    assert_equal 'rb', P.lexer_name_for(:filename => 'test.rb')
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight_many([[RUBY_CODE, {}]]).first
+    out = StringIO.new
+    P.highlight(RUBY_CODE, :out => out)
+    assert_equal P.highlight(RUBY_CODE), out.string
+  ensure
+    ENV.delete('MENTOS_PROTOCOL')
+    P.stop "Switching protocols"
+  end
+end
+
+class PygmentsPoolTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def setup
+    P.start(:pool_size => 3)
+  end
+
+  def teardown
+    P.start
+  end
+
+  def test_pool_size
+    assert_equal 3, P.workers.size
+    assert P.workers.all? { |w| w[:alive] }
+    assert_equal 3, P.workers.map { |w| w[:pid] }.uniq.size
+  end
+
+  def test_requests_go_to_idle_workers
+    threads = (1..3).map { Thread.new { P.highlight(PygmentsHighlightTest::REDIS_CODE, :lexer => 'c') } }
+    threads.each { |thread| assert_equal 451717, thread.value.bytesize }
+    assert_equal [1, 1, 1], P.workers.map { |w| w[:requests] }
+    assert_equal [0, 0, 0], P.workers.map { |w| w[:in_flight] }
+  end
+
+  def test_dead_workers_are_respawned
+    P.highlight(RUBY_CODE)
+    worker = P.workers.find { |w| w[:requests] == 1 }
+    Process.kill('KILL', worker[:pid])
+    Process.waitpid(worker[:pid])
+
+    3.times { assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE) }
+    assert P.workers.all? { |w| w[:alive] }
+    assert_equal 1, P.workers.inject(0) { |sum, w| sum + w[:restarts] }
+  end
+
+  def test_errors_are_tracked_per_worker
+    assert_raise MentosError do
+      P.lexer_name_for(:invalid => true)
+    end
+    assert_equal 1, P.workers.inject(0) { |sum, w| sum + w[:errors] }
+  end
+end
+
+class PygmentsPrewarmTest < Test::Unit::TestCase
+  def teardown
+    P.start
+  end
+
+  def test_prewarm_list
+    P.start(:prewarm => ['ruby', 'erb', 'nonexistent'])
+    worker = P.workers.first
+    assert_equal ['ruby', 'erb'], worker[:prewarmed]
+    assert worker[:prewarm_seconds] > 0
+  end
+
+  def test_prewarm_most_used
+    P.start
+    P.instance_variable_set(:@lexer_usage, Hash.new(0))
+    3.times { P.highlight("import os", :lexer => 'python') }
+    P.highlight("puts 1", :lexer => 'ruby')
+
+    P.start(:prewarm_top => 1)
+    assert_equal ['python'], P.workers.first[:prewarmed]
+  end
+
+  def test_no_prewarm_by_default
+    P.start
+    assert_equal [], P.workers.first[:prewarmed]
+    assert_nil P.workers.first[:prewarm_seconds]
+  end
+end
+
+class PygmentsZygoteTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def setup
+    P.start(:zygote => true, :pool_size => 2, :prewarm => ['ruby'])
+  end
+
+  def teardown
+    P.start
+  end
+
+  def test_workers_are_forked_from_the_zygote
+    threads = (1..2).map { Thread.new { P.highlight(RUBY_CODE, :lexer => 'ruby') } }
+    threads.each { |thread| assert_match '<span class="c1">#!/usr/bin/ruby</span>', thread.value }
+
+    zygote = P.instance_variable_get(:@zygote)
+    assert_equal ['ruby'], zygote.prewarmed
+    P.workers.each do |worker|
+      assert worker[:alive]
+      assert_not_equal zygote.pid, worker[:pid]
+    end
+  end
+
+  def test_killed_workers_are_forked_again
+    P.highlight(RUBY_CODE)
+    pid = P.workers.first[:pid]
+    Process.kill('KILL', pid)
+    sleep 0.1
+
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE)
+    assert_not_equal pid, P.workers.first[:pid]
+    assert_equal 1, P.workers.first[:restarts]
+  end
+
+  def test_timeouts_with_zygote
+    assert_nil P.highlight(PygmentsHighlightTest::REDIS_CODE * 300)
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE)
+  end
+end
+
+class PygmentsDaemonTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+  SOCKET = File.join(Dir.tmpdir, "mentos-test-#{Process.pid}.sock")
+
+  def setup
+    @daemon = Process.spawn(P.python_binary, File.expand_path('../../lib/pygments/mentos.py', __FILE__),
+                            '--daemon', SOCKET)
+    sleep 0.05 until File.exist?(SOCKET)
+  end
+
+  def teardown
+    stop_daemon
+    P.start
+  end
+
+  def stop_daemon
+    return unless @daemon
+    Process.kill('TERM', @daemon)
+    Process.wait(@daemon)
+    @daemon = nil
+  end
+
+  def test_workers_connect_to_the_daemon
+    P.start(:socket => SOCKET, :pool_size => 2)
+    threads = (1..2).map { Thread.new { P.highlight(RUBY_CODE, :lexer => 'ruby') } }
+    threads.each { |thread| assert_match '<span class="c1">#!/usr/bin/ruby</span>', thread.value }
+
+    P.workers.each do |worker|
+      assert worker[:alive]
+      assert_nil worker[:pid]
+      assert_equal SOCKET, worker[:socket]
+    end
+
+    # A request is counted once it's been answered, so the other worker's
+    # may not be yet.
+    requests = nil
+    20.times do
+      # Both workers talk to the daemon's one process.
+      stats = P.stats
+      assert_equal 1, stats.size
+      requests = stats.values.first[:methods][:highlight][:requests]
+      break if requests == 2
+      sleep 0.05
+    end
+    assert_equal 2, requests
+  end
+
+  def test_a_failed_request_leaves_a_newer_connection_open
+    P.start(:socket => SOCKET)
+    P.highlight(RUBY_CODE)
+    worker = P.instance_variable_get(:@workers).first
+    old = worker.multiplexer
+
+    # Another thread hangs up and reconnects first.
+    P.send(:stop_worker, worker, nil, "Test.", old)
+    P.highlight(RUBY_CODE)
+    current = worker.multiplexer
+    assert !current.equal?(old)
+
+    # The request that failed on the old connection gets to stop_worker.
+    P.send(:stop_worker, worker, nil, "EPIPE", old)
+    assert current.equal?(worker.multiplexer)
+    assert !current.closed?
+    assert_equal 1, P.workers.first[:restarts]
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE)
+  end
+
+  def test_falls_back_to_a_child_without_the_daemon
+    P.start(:socket => SOCKET + '.missing')
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE)
+    assert_not_nil P.workers.first[:pid]
+    assert_nil P.workers.first[:socket]
+  end
+
+  def test_falls_back_to_a_child_once_the_daemon_is_gone
+    P.start(:socket => SOCKET)
+    P.highlight(RUBY_CODE)
+    stop_daemon
+    sleep 0.1
+
+    assert_match '<span class="c1">#!/usr/bin/ruby</span>', P.highlight(RUBY_CODE)
+    assert_not_nil P.workers.first[:pid]
+    assert_equal 1, P.workers.first[:restarts]
+  end
+end
+
+class PygmentsWithoutSetuptoolsTest < Test::Unit::TestCase
+  # A pkg_resources that can't be imported, as without setuptools.
+  SHIM = File.join(Dir.tmpdir, "mentos-no-setuptools-#{Process.pid}")
+
+  def setup
+    Dir.mkdir(SHIM) unless File.directory?(SHIM)
+    File.open(File.join(SHIM, 'pkg_resources.py'), 'w') { |f| f.puts 'raise ImportError("No module named pkg_resources")' }
+    @pythonpath = ENV['PYTHONPATH']
+    ENV['PYTHONPATH'] = [SHIM, @pythonpath].compact.join(File::PATH_SEPARATOR)
+  end
+
+  def teardown
+    ENV['PYTHONPATH'] = @pythonpath
+    P.start
+    FileUtils.rm_rf(SHIM)
+  end
+
+  def test_lexers_are_found_without_plugins
+    P.start
+    assert_equal 'python', P.lexer_name_for(:filename => 'a.py')
+    error = assert_raise(MentosError) { P.highlight('x', :lexer => 'nosuchlexer') }
+    assert_match 'ClassNotFound', error.message
+  end
+
+  def test_zygote_starts_without_plugins
+    P.start(:zygote => true)
+    assert_equal 'python', P.lexer_name_for(:filename => 'a.py')
+  end
+end
+
+class PygmentsCacheTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def setup
+    ENV['MENTOS_CACHE_BYTES'] = '4096'
+    P.start
+  end
+
+  def teardown
+    ENV.delete('MENTOS_CACHE_BYTES')
+    P.start
+  end
+
+  def test_cache_hits
+    first = P.highlight(RUBY_CODE)
+    assert_equal first, P.highlight(RUBY_CODE)
+    assert_not_equal first, P.highlight(RUBY_CODE, :options => {:linenos => true})
+
+    stats = P.cache_stats
+    assert_equal 1, stats[:hits]
+    assert_equal 2, stats[:misses]
+    assert_equal 2, stats[:entries]
+  end
+
+  def test_cache_evicts_over_budget
+    10.times { |i| P.highlight(RUBY_CODE + "\n" + ("x" * 500) + i.to_s) }
+
+    stats = P.cache_stats
+    assert stats[:evictions] > 0
+    assert stats[:bytes] <= 4096
+  end
+
+  def test_cache_disabled_by_default
+    ENV.delete('MENTOS_CACHE_BYTES')
+    P.start
+    assert_equal 0, P.cache_stats[:max_bytes]
+  end
+end
+
+class PygmentsStatsTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def setup
+    P.start
+  end
+
+  def test_stats_count_requests_per_method_and_lexer
+    2.times { P.highlight(RUBY_CODE, :lexer => 'rb') }
+    assert_raise(MentosError) { P.highlight(RUBY_CODE, :lexer => 'nonexistent') }
+
+    pid = P.workers.first[:pid]
+    assert_equal [pid], P.stats.keys
+    stats = P.stats[pid]
+    assert_equal pid, stats[:pid]
+    highlight = stats[:methods][:highlight]
+    assert_equal 3, highlight[:requests]
+    assert_equal 1, highlight[:errors]
+    assert_equal 3 * RUBY_CODE.bytesize, highlight[:bytes_in]
+    assert_equal 3, highlight[:seconds][:count]
+    assert highlight[:seconds][:p99] <= highlight[:seconds][:max]
+
+    rb = stats[:lexers][:rb]
+    assert_equal 2, rb[:requests]
+    assert_equal 0, rb[:errors]
+    [:lexer, :lex, :format, :read, :write].each do |phase|
+      assert_equal 2, rb[:phases][phase][:count]
+    end
+    assert stats[:rss_bytes] > 0
+    assert stats[:max_rss_bytes] >= stats[:rss_bytes]
+  end
+
+  def test_stats_cover_every_process_in_the_pool
+    P.start(:pool_size => 2)
+    pids = P.workers.map { |w| w[:pid] }
+    threads = (1..6).map { Thread.new { P.highlight(RUBY_CODE, :lexer => 'rb') } }
+    threads.each(&:join)
+
+    # A request is counted once it's been answered, so the last may not be
+    # yet.
+    stats = requests = nil
+    20.times do
+      stats = P.stats
+      requests = stats.values.map { |s| s[:lexers][:rb] ? s[:lexers][:rb][:requests] : 0 }.inject(:+)
+      break if requests == 6
+      sleep 0.05
+    end
+    assert_equal pids.sort, stats.keys.sort
+    assert_equal 6, requests
+  ensure
+    P.start
+  end
+
+  def test_legacy_stats_leave_out_lexers
+    P.stop "Switching protocols"
+    ENV['MENTOS_PROTOCOL'] = '1'
+    P.start(:pool_size => 2)
+    P.highlight(RUBY_CODE, :lexer => 'rb')
+
+    stats = P.stats
+    assert_equal P.workers.map { |w| w[:pid] }.sort, stats.keys.sort
+    assert_equal 1, stats.values.map { |s| s[:methods][:highlight] ? s[:methods][:highlight][:requests] : 0 }.inject(:+)
+    assert stats.values.all? { |s| s[:lexers].empty? }
+  ensure
+    ENV.delete('MENTOS_PROTOCOL')
+    P.start
+  end
+
+  def test_highlight_timings
+    code = P.highlight(RUBY_CODE, :timings => true)
+    assert_equal P.highlight(RUBY_CODE), code
+    assert_equal %w(format lex lexer read total), code.timings.keys.sort
+    assert code.timings["total"] >= code.timings["lex"] + code.timings["format"]
+    assert !P.highlight(RUBY_CODE).respond_to?(:timings)
+  end
+end
+
+class PygmentsProfileRulesTest < Test::Unit::TestCase
+  ROOT = File.expand_path('../..', __FILE__)
+  PYTHON_CODE = "def f(x):\n    \"\"\"Adds one.\"\"\"\n    return x + 1  # one\n"
+
+  # Profiles PYTHON_CODE, noting the tokens lexed with and without the
+  # rules timed, and prints what it found as JSON.
+  PROFILE = <<-PY
+import sys, json
+sys.path[:0] = [sys.argv[1] + '/lib/pygments', sys.argv[1] + '/vendor/pygments-main']
+from pygments.lexers import PythonLexer
+from profiling import RuleProfile
+
+lexer = PythonLexer()
+text = sys.argv[2].decode('utf-8')
+plain = list(lexer.get_tokens(text))
+
+class_rules = PythonLexer._tokens
+profiled = []
+only_it_timed = []
+get_tokens = lexer.get_tokens
+def profiled_tokens(text):
+    for token in get_tokens(text):
+        profiled.append(token)
+        # Other lexers of its class, lexing in the meantime, lex as ever.
+        only_it_timed.append(lexer._tokens is not class_rules and PythonLexer()._tokens is class_rules)
+        yield token
+lexer.get_tokens = profiled_tokens
+rules = RuleProfile(lexer)
+count = rules.profile(text)
+del lexer.get_tokens
+
+json.dump({'count': count, 'tokens': len(plain), 'profiled_same': profiled == plain,
+           'after_same': list(lexer.get_tokens(text)) == plain, 'chars': rules.chars,
+           'only_it_timed': all(only_it_timed), 'rules_back': '_tokens' not in vars(lexer),
+           'seconds': rules.seconds, 'rules': rules.worst(1000)}, sys.stdout)
+  PY
+
+  def test_profile_counts_and_times_each_rule
+    res = Yajl.load(IO.popen([P.python_binary, '-c', PROFILE, ROOT, PYTHON_CODE]) { |io| io.read })
+    assert $?.success?
+
+    assert res['profiled_same'], "profiling changed the tokens"
+    assert res['after_same'], "the lexer's rules weren't put back"
+    assert res['only_it_timed'], "other lexers of its class were profiled too"
+    assert res['rules_back'], "the lexer kept rules of its own"
+    assert_equal res['tokens'], res['count']
+    assert_equal PYTHON_CODE.size, res['chars']
+
+    rules = res['rules']
+    assert !rules.empty?
+    rules.each do |rule|
+      assert_equal 'Python', rule['lexer']
+      assert_equal rule['attempts'] - rule['matches'], rule['failures']
+      assert rule['seconds'] >= 0
+    end
+    assert rules.map { |rule| rule['seconds'] }.inject(:+) <= res['seconds']
+    assert_equal rules.map { |rule| rule['seconds'] }.sort.reverse, rules.map { |rule| rule['seconds'] }
+
+    comment = rules.find { |rule| rule['state'] == 'root' && rule['pattern'] =~ /\A#/ }
+    assert_equal 1, comment['matches']
+  end
+
+  def test_profile_rules_reports_the_worst_rules
+    path = File.join(Dir.tmpdir, "profile-rules-#{Process.pid}.py")
+    File.write(path, PYTHON_CODE)
+    out = IO.popen([P.python_binary, File.join(ROOT, 'profile-rules.py'), '-n', '3', '-s', 'attempts', path]) { |io| io.read }
+    assert $?.success?
+
+    lines = out.split("\n").reject(&:empty?)
+    assert_match /\APython: #{PYTHON_CODE.size} characters in [\d.]+ ms/, lines[0]
+    assert_match /\Alexer +state +rule +attempts/, lines[1]
+    assert_equal 3, lines[2..-1].size
+    attempts = lines[2..-1].map { |line| line.split[3].to_i }
+    assert_equal attempts.sort.reverse, attempts
+  ensure
+    FileUtils.rm_f(path)
+  end
+end
+
+class PygmentsTokensTest < Test::Unit::TestCase
+  RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
+
+  def test_tokens_are_types_and_lengths_of_the_text
+    res = P.tokens(RUBY_CODE, :lexer => 'ruby')
+    assert_equal "#{RUBY_CODE}\n", res[:text]
+    assert_equal 'Comment.Single', res[:types][res[:tokens][0]]
+    assert_equal 15, res[:tokens][1]
+    assert_equal res[:text].bytesize, res[:tokens].each_slice(2).map { |_, length| length }.inject(:+)
+  end
+
+  def test_render_formats_tokens_like_highlight
+    res = P.tokens(RUBY_CODE, :lexer => 'ruby')
+    assert_equal P.highlight(RUBY_CODE, :lexer => 'ruby'), P.render(res)
+    assert_equal P.highlight(RUBY_CODE, :lexer => 'ruby', :formatter => 'terminal'),
+                 P.render(res, :formatter => 'terminal')
+    assert_equal P.highlight(RUBY_CODE, :lexer => 'ruby', :options => {:noclasses => true}),
+                 P.render(res, :options => {:noclasses => true})
+  end
+
+  def test_render_tokens_stored_as_json
+    code = "# café ☃\nputs 'ü'\n"
+    res = Yajl.load(Yajl.dump(P.tokens(code, :lexer => 'ruby')))
+    assert_equal P.highlight(code, :lexer => 'ruby'), P.render(res)
+  end
+
+  def test_render_tokens_that_dont_match_their_text
+    res = P.tokens(RUBY_CODE, :lexer => 'ruby')
+    assert_raise MentosError do
+      P.render(res.merge(:text => "puts"))
+    end
+  end
+end
+
+class PygmentsIncrementalTest < Test::Unit::TestCase
+  PYTHON_CODE = "def foo():\n    return 1\n\nx = foo()\ny = 2\n"
+
+  def teardown
+    P.start
+  end
+
+  def open_document(document, code = PYTHON_CODE)
+    P.highlight_incremental(code, :lexer => 'python', :document => document)
+  end
+
+  def test_open_highlights_every_line
+    res = open_document('open')
+    assert_equal 0, res[:start]
+    assert_equal 0, res[:removed]
+    assert_equal 5, res[:line_count]
+    assert_equal 5, res[:lines].size
+    assert_equal '<span class="k">def</span> <span class="nf">foo</span><span class="p">():</span>', res[:lines][0]
+  end
+
+  def test_edit_returns_only_changed_lines
+    open_document('edit')
+    res = P.highlight_incremental("y = 'two'", :document => 'edit', :edit => [4, 5])
+    assert_equal 4, res[:start]
+    assert_equal 1, res[:removed]
+    assert_equal ['<span class="n">y</span> <span class="o">=</span> <span class="s">&#39;two&#39;</span>'], res[:lines]
+    assert_equal 5, res[:line_count]
+  end
+
+  def test_edits_add_up_to_highlighting_from_scratch
+    lines = open_document('edits')[:lines]
+    code = PYTHON_CODE.split("\n")
+
+    [[[1, 1], ['    """']], [[3, 4], ['"""', 'x = foo()']], [[0, 2], []], [[1, 1], ["'", '#']]].each do |edit, text|
+      res = P.highlight_incremental(text.join("\n"), :document => 'edits', :edit => edit)
+      lines[res[:start], res[:removed]] = res[:lines]
+      code[edit.first...edit.last] = text
+    end
+
+    assert_equal open_document('fresh', code.join("\n"))[:lines], lines
+  end
+
+  def test_closing_a_comment_in_a_later_edit_rehighlights_the_lines_it_opened
+    # An unclosed comment matches nothing in JavaScript, and falls back to
+    # the next rule in CSS, lexing each line the same way it did before.
+    {'js' => ['/* start', 'end */'], 'css' => ['a { /* start', 'end */ }']}.each do |lexer, (open, close)|
+      code = ['var a = 1;', 'var b = 2;', 'var c = 3;', 'var d = 4;']
+      lines = P.highlight_incremental(code.join("\n"), :lexer => lexer, :document => "close-#{lexer}")[:lines]
+
+      [[[1, 1], [open]], [[4, 4], [close]]].each do |edit, text|
+        res = P.highlight_incremental(text.join("\n"), :document => "close-#{lexer}", :edit => edit)
+        lines[res[:start], res[:removed]] = res[:lines]
+        code[edit.first...edit.last] = text
+      end
+
+      fresh = P.highlight_incremental(code.join("\n"), :lexer => lexer, :document => "fresh-#{lexer}")[:lines]
+      assert_equal fresh, lines, lexer
+      assert_match(/\A<span class="cm?">var c = 3;<\/span>\z/, lines[3], lexer)
+    end
+  end
+
+  def test_edits_go_to_the_process_holding_the_document
+    P.start(:pool_size => 3)
+    open_document('pooled')
+    3.times { |i| assert_equal 5, P.highlight_incremental("z = #{i}", :document => 'pooled', :edit => [0, 1])[:line_count] }
+  end
+
+  def test_unknown_documents
+    assert_raise(MentosError) { P.highlight_incremental("x", :document => 'unknown', :edit => [0, 0]) }
+
+    open_document('closed')
+    P.close_document('closed')
+    assert_raise(MentosError) { P.highlight_incremental("x", :document => 'closed', :edit => [0, 0]) }
+  end
+end
+
+class PygmentsParallelTest < Test::Unit::TestCase
+  EXAMPLES = Dir[File.join(File.dirname(__FILE__), '..', 'vendor/pygments-main/tests/examplefiles/*')].sort
+
+  def teardown
+    ENV.delete('MENTOS_PARALLEL')
+    ENV.delete('MENTOS_PARALLEL_BYTES')
+    ENV.delete('MENTOS_DISPATCH')
+    P.start
+  end
+
+  def highlight_examples
+    EXAMPLES.map do |path|
+      begin
+        P.highlight(File.read(path), :options => {:filename => File.basename(path)})
+      rescue MentosError => e
+        e.class
+      end
+    end
+  end
+
+  def test_dispatched_lexing_matches_pygments_lexing
+    ENV['MENTOS_DISPATCH'] = '0'
+    P.start
+    expected = highlight_examples
+
+    ENV.delete('MENTOS_DISPATCH')
+    P.start
+
+    highlight_examples.each_with_index do |res, i|
+      assert_equal expected[i], res, File.basename(EXAMPLES[i])
+    end
+  end
+
+  def test_dispatch_follows_lexer_options
+    code = "class Ābc { int āx = 1; }\n"
+    ENV['MENTOS_DISPATCH'] = '0'
+    P.start
+    expected = %w(none basic).map { |level| P.highlight(code, :lexer => 'csharp', :options => {:unicodelevel => level}) }
+    assert_not_equal expected[0], expected[1]
+
+    ENV.delete('MENTOS_DISPATCH')
+    P.start
+    # Both orders, so neither level's rules are dispatched for the other's.
+    assert_equal expected, %w(none basic).map { |level| P.highlight(code, :lexer => 'csharp', :options => {:unicodelevel => level}) }
+    assert_equal expected.reverse, %w(basic none).map { |level| P.highlight(code, :lexer => 'csharp', :options => {:unicodelevel => level}) }
+  end
+
+  def test_parallel_lexing_matches_sequential_lexing
+    ENV['MENTOS_DISPATCH'] = '0'
+    P.start
+    expected = highlight_examples
+
+    ENV['MENTOS_PARALLEL'] = '2'
+    ENV['MENTOS_PARALLEL_BYTES'] = '1'
+    P.start
+
+    highlight_examples.each_with_index do |res, i|
+      assert_equal expected[i], res, File.basename(EXAMPLES[i])
+    end
+  end
+
+  def test_parallel_lexing_of_many_chunks_matches_sequential_lexing
+    # Each is split into eight chunks of over 8KB, so stitching them
+    # together is done for real; the examples above are mostly one chunk.
+    examples = %w(example.c example.rb linecontinuation.py test.css).map do |name|
+      code = File.read(File.join(File.dirname(__FILE__), '..', 'vendor/pygments-main/tests/examplefiles', name))
+      [name, code * (65536 / code.size + 1)]
+    end
+
+    ENV['MENTOS_DISPATCH'] = '0'
+    P.start
+    expected = examples.map { |name, code| P.highlight(code, :options => {:filename => name}) }
+
+    ENV['MENTOS_PARALLEL'] = '2'
+    ENV['MENTOS_PARALLEL_BYTES'] = '1'
+    P.start
+
+    # Twice, for the second job to be lexed in the pool the first made.
+    2.times do
+      examples.each_with_index do |(name, code), i|
+        assert_equal expected[i], P.highlight(code, :options => {:filename => name}), name
+      end
+    end
+  end
+end
+
 class PygmentsLexerTest < Test::Unit::TestCase
   RUBY_CODE = "#!/usr/bin/ruby\nputs 'foo'"
 
+  # Prints, as JSON, the builtin lexers with an analyse_text of their own
+  # that _NEEDS leaves out, and the lexers it lists that aren't those.
+  NEEDS = <<-PY
+import sys, json
+sys.path[:0] = [sys.argv[1] + '/lib/pygments', sys.argv[1] + '/vendor/pygments-main']
+from pygments.lexer import Lexer
+from pygments.lexers._mapping import LEXERS
+from lexer_index import _NEEDS
+
+analysers = set()
+for name, info in LEXERS.iteritems():
+    cls = getattr(__import__(info[0], None, None, [name]), name)
+    if cls.analyse_text is not Lexer.analyse_text:
+        analysers.add(name)
+
+json.dump({'missing': sorted(analysers - set(_NEEDS)),
+           'stale': sorted(set(_NEEDS) - analysers)}, sys.stdout)
+  PY
+
+  def test_needs_cover_every_analyser
+    res = Yajl.load(IO.popen([P.python_binary, '-c', NEEDS, File.expand_path('../..', __FILE__)]) { |io| io.read })
+    assert $?.success?
+    assert_equal [], res['missing'], "lexers with an analyse_text missing from _NEEDS"
+    assert_equal [], res['stale'], "lexers in _NEEDS without an analyse_text"
+  end
+
   def test_lexer_by_mimetype
     assert_equal 'rb', P.lexer_name_for(:mimetype => 'text/x-ruby')
     assert_equal 'json', P.lexer_name_for(:mimetype => 'application/json')
@@ -179,14 +1033,63 @@ class PygmentsLexerTest < Test::Unit::TestCase
     assert_equal 'c', P.lexer_name_for(:lexer => 'c')
   end
 
+  def test_lexer_by_filename_pattern
+    assert_equal 'make', P.lexer_name_for(:filename => 'Makefile')
+    assert_equal 'make', P.lexer_name_for(:filename => 'src/Makefile.am')
+    assert_equal 'php', P.lexer_name_for(:filename => 'index.php5')
+    assert_equal 'rb', P.lexer_name_for(:filename => 'lib/pygments.rb.rb')
+  end
+
+  def test_lexer_by_unknown_filename
+    assert_raise MentosError do
+      P.lexer_name_for(:filename => 'test.unknown-extension')
+    end
+  end
+
   def test_lexer_by_filename_and_content
     assert_equal 'rb', P.lexer_name_for(RUBY_CODE, :filename => 'test.rb')
   end
 
+  def test_lexer_by_alias_filename_and_content
+    assert_equal 'rhtml', P.lexer_name_for('<%= @foo %>', :filename => 'test.html')
+  end
+
   def test_lexer_by_content
     assert_equal 'rb', P.lexer_name_for(RUBY_CODE)
   end
 
+  def test_lexer_by_shebang
+    assert_equal 'python3', P.lexer_name_for("#!/usr/bin/env python3\nprint(1)\n")
+    assert_equal 'rb', P.lexer_name_for("#!/usr/bin/ruby1.9 -w\nputs 1\n")
+    assert_equal 'bash', P.lexer_name_for("#!/bin/sh\necho 1\n")
+  end
+
+  def test_lexer_by_modeline
+    assert_equal 'rb', P.lexer_name_for("x = 1\n# vim: set ft=ruby:\n")
+  end
+
+  def test_lexer_by_document_type
+    assert_equal 'html', P.lexer_name_for("<!DOCTYPE html>\n<html><body><p>hi</p></body></html>\n")
+    assert_equal 'xml', P.lexer_name_for("<?xml version=\"1.0\"?>\n<root><a>1</a></root>\n")
+    assert_equal 'xslt', P.lexer_name_for("<?xml version=\"1.0\"?>\n<xsl:stylesheet version=\"1.0\"></xsl:stylesheet>\n")
+  end
+
+  def test_lexer_by_content_analysis
+    assert_equal 'python', P.lexer_name_for("import os\nprint os.getcwd()\n")
+    assert_equal 'diff', P.lexer_name_for("Index: foo\n--- a\n+++ b\n")
+  end
+
+  def test_lexer_by_content_looks_at_the_start_of_the_text
+    code = "#include <stdio.h>\n\n" + (1..400).map { |i| "int x#{i} = #{i};\n" }.join
+    assert_equal 'c', P.lexer_name_for(code + "/* a :- b */\n")
+    assert_equal 'prolog', P.lexer_name_for("#include <stdio.h>\n/* a :- b */\n")
+  end
+
+  def test_lexer_by_content_is_remembered
+    code = "<?php echo 1; ?>\n"
+    assert_equal P.lexer_name_for(code), P.lexer_name_for(code)
+  end
+
   def test_lexer_by_nothing
     assert_raise MentosError do
       P.lexer_name_for(:invalid => true)
@@ -260,6 +1163,12 @@ class PygmentsCssTest < Test::Unit::TestCase
   def test_css_colorful
     assert_match '.c { color: #888888 }', P.css(:style => 'colorful')
   end
+
+  def test_css_is_not_shared_between_styles
+    assert_equal P.css(:style => 'colorful'), P.css(:style => 'colorful')
+    assert_match '.c { color: #408080; font-style: italic }', P.css
+    assert_match '.c { color: #888888 }', P.css(:style => 'colorful')
+  end
 end
 
 class PygmentsConfigTest < Test::Unit::TestCase